@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+""" The CommandTracker follows each command from the HAL to
+the hardware.  Every command gets a host sequence id when it is
+queued (run_cmd), the websocket server records when it goes out
+on the wire, and the hardware echoes the sequence id of the last
+command it applied in the last_cmd_seq field of the status Header.
+The hardware applies commands in the order they arrive, the
+server records that wire order in shared memory so a command
+counts as applied once any command sent at or after it has been
+acknowledged, whatever lane it went through.  A set command
+coalesced away before being sent counts as applied along with the
+command that replaced it.
+The time spent queued (enqueue -> wire) and on the wire and in
+the hardware (wire -> applied) is kept in latency histograms
+per subsystem.
+Until the hardware acks a command, firmware that does not echo
+last_cmd_seq never does, a wait for a command is capped to the
+[WSServer] ack_fallback seconds, the fixed delay used before acks.
+"""
+import copy
+import time
+import bisect
+import threading
+from multiprocessing import Array
+from pyelixys.hal.elixysobject import ElixysObject
+
+
+class LatencyHistogram(object):
+    """ Counts latencies in buckets with upper bounds
+    in milliseconds, the last bucket is unbounded """
+
+    buckets = (0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 50.0, 100.0,
+               200.0, 500.0, 1000.0, float('inf'))
+
+    def __init__(self):
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        ms = seconds * 1000.0
+        self.counts[bisect.bisect_left(self.buckets, ms)] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def get_mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    mean = property(get_mean)
+
+    def percentile(self, pct):
+        """ Upper bound of the bucket holding the percentile """
+        if not self.count:
+            return 0.0
+        target = pct / 100.0 * self.count
+        seen = 0
+        for upper, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= target:
+                return min(upper, self.max)
+        return self.max
+
+    def as_dict(self):
+        return {'count': self.count, 'mean': self.mean, 'max': self.max,
+                'p50': self.percentile(50), 'p99': self.percentile(99),
+                'buckets': zip(self.buckets, self.counts)}
+
+    def __repr__(self):
+        return "LatencyHistogram(n=%d, mean=%.3f, p50<=%.3f, " \
+            "p99<=%.3f, max=%.3f ms)" % (self.count, self.mean,
+                                         self.percentile(50),
+                                         self.percentile(99), self.max)
+
+
+class CommandTracker(ElixysObject):
+    """ Tracks the commands of one synthesizer unit.
+    enqueue runs in the HAL, on_wire in the websocket server
+    (the wire order lives in shared memory so it works with the
+    server in its own process) and on_status in the status thread.
+    """
+
+    def __init__(self, window=None, fallback=None):
+        if window is None:
+            window = self.sysconf['WSServer']['ack_window']
+        if fallback is None:
+            fallback = self.sysconf['WSServer']['ack_fallback']
+        self.window = window
+        self.fallback = fallback
+        # Written by the server, the sequence id held by each
+        # slot, its position in the wire order and when it was sent
+        self.wire_seq = Array('L', window, lock=False)
+        self.wire_idx = Array('L', window, lock=False)
+        self.wire_time = Array('d', window, lock=False)
+        self.wire_count = Array('L', 1, lock=False)
+        # HAL side, seq -> (sub_system, enqueue time) of the
+        # commands not applied yet
+        self.next_seq = 1
+        self.pending = dict()
+        # Commands older than this are no longer tracked
+        self.forgotten_seq = 0
+        self.acked_seq = 0
+        # Set once the hardware acked a command
+        self.acking = False
+        self.cond = threading.Condition()
+        self.histograms = dict()
+
+    def enqueue(self, cmd):
+        """ Returns a copy of the command stamped with
+        the next sequence id """
+        cmd = copy.copy(cmd)
+        with self.cond:
+            cmd.seq_id = self.next_seq
+            self.next_seq += 1
+            self.pending[cmd.seq_id] = (cmd.sub_system, time.time())
+            if len(self.pending) > self.window:
+                self.forget(cmd.seq_id - self.window)
+        return cmd
+
+    def forget(self, seq):
+        """ Stop tracking the commands up to seq, their wire
+        slots are being reused (the hardware may not ack) """
+        for pending_seq in self.pending.keys():
+            if pending_seq <= seq:
+                del self.pending[pending_seq]
+        self.forgotten_seq = seq
+
+    def on_wire(self, cmds):
+        """ Record the commands just sent, in order """
+        now = time.time()
+        for cmd in cmds:
+            self.wire_count[0] += 1
+            for seq in cmd.superseded + (cmd.seq_id,):
+                slot = seq % self.window
+                self.wire_seq[slot] = seq
+                self.wire_idx[slot] = self.wire_count[0]
+                self.wire_time[slot] = now
+
+    def get_wire(self, seq):
+        """ Returns (wire position, send time) of a command,
+        None if it was not sent yet or fell out of the window """
+        slot = seq % self.window
+        if self.wire_seq[slot] != seq:
+            return None
+        return self.wire_idx[slot], self.wire_time[slot]
+
+    def get_histogram(self, sub_system, stage):
+        key = (sub_system, stage)
+        if not key in self.histograms:
+            self.histograms[key] = LatencyHistogram()
+        return self.histograms[key]
+
+    def on_status(self, status):
+        """ Status packet callback, handles a new
+        last_cmd_seq from the hardware """
+        seq = status.store['Header'].get('last_cmd_seq', 0)
+        if seq == self.acked_seq:
+            return
+        self.acked_seq = seq
+        self.acking = True
+        acked = self.get_wire(seq)
+        if acked is None:
+            return
+        now = time.time()
+        with self.cond:
+            for pending_seq, (sub_system, queued) in self.pending.items():
+                wire = self.get_wire(pending_seq)
+                if wire is None or wire[0] > acked[0]:
+                    continue
+                del self.pending[pending_seq]
+                self.get_histogram(sub_system, 'wire').add(wire[1] - queued)
+                self.get_histogram(sub_system, 'applied').add(now - wire[1])
+                self.get_histogram(sub_system, 'total').add(now - queued)
+            self.cond.notify_all()
+
+    def is_applied(self, seq):
+        """ Commands no longer tracked are never reported applied """
+        return (self.forgotten_seq < seq < self.next_seq and
+                not seq in self.pending)
+
+    def wait_applied(self, seq, timeout=None):
+        """ Block until the hardware applied the command,
+        returns False if the timeout expired first.  While the
+        hardware has not acked anything the wait is capped to
+        the fallback delay """
+        if not self.acking:
+            timeout = self.fallback if timeout is None else \
+                min(timeout, self.fallback)
+        deadline = None if timeout is None else time.time() + timeout
+        with self.cond:
+            while not self.is_applied(seq):
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                self.cond.wait(remaining)
+        return True
+
+    def latency_report(self):
+        """ Returns {sub_system: {stage: histogram}} """
+        report = dict()
+        for (sub_system, stage), hist in self.histograms.items():
+            report.setdefault(sub_system, dict())[stage] = hist
+        return report
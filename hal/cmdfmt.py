@@ -8,7 +8,6 @@ elixys websocket hardware server
 """
 import sys
 import struct
-import jinja2
 from pyelixys.hal.fmt_lookup import fmt_chr
 from pyelixys.hal.elixysobject import ElixysObject
 
@@ -35,19 +34,28 @@ class CommandFormatFactory(ElixysObject):
                  for sec, vals in 
                  self.sysconf.items() if "Commands" in
                  vals if vals["Commands"].keys()]        
+        cmds.append(("System", self.sysconf['Commands']))
         return dict(cmds)
+
+    def get_template_vars(self):
+        """ Variables used to render both the header
+        and the source templates """
+        return {"cmds":self.parse_for_cmds(),
+                "cmdfmt":self.sysconf['Command Format']['Packet Structure'],
+                "fmtchr": fmt_chr,
+                "parameter_sz":self.sysconf['Command Format']['parameter_sz'],
+                "batch_cmd_id":self.sysconf['Command Format']['batch_cmd_id']}
         
     def generate_c_header(self,filename=None):
+        # Only the code generators need jinja2
+        import jinja2
         template_loader = jinja2.FileSystemLoader(searchpath=".")
         template_env = jinja2.Environment(loader=template_loader,
                                           trim_blocks=True,
                                           lstrip_blocks=True)
         TEMPLATE_FILE = self.sysconf['c_cmd_header_template']
         template = template_env.get_template(TEMPLATE_FILE)
-        template_vars = {"cmds":self.parse_for_cmds(),
-                         "cmdfmt":self.sysconf['Command Format']['Packet Structure'],
-                         "fmtchr": fmt_chr,
-                         "parameter_sz":self.sysconf['Command Format']['parameter_sz']}        
+        template_vars = self.get_template_vars()
         output_text = template.render(template_vars)
         
         if filename:
@@ -58,13 +66,15 @@ class CommandFormatFactory(ElixysObject):
         return output_text
 
     def generate_c_src(self, filename=None):
+        # Only the code generators need jinja2
+        import jinja2
         template_loader = jinja2.FileSystemLoader(searchpath=".")
         template_env = jinja2.Environment(loader=template_loader,
                                           trim_blocks=True,
                                           lstrip_blocks=True)
         TEMPLATE_FILE = self.sysconf['c_cmd_source_template']
         template = template_env.get_template(TEMPLATE_FILE)
-        template_vars = {}        
+        template_vars = self.get_template_vars()
         output_text = template.render(template_vars)
         
         if filename:
@@ -1,23 +1,114 @@
 #!/usr/bin/env python
 import sys
 import struct
-import copy
 from pyelixys.hal.elixysobject import ElixysObject
+from pyelixys.hal.hwconf import config, config_cache
 from pyelixys.elixysexceptions import ElixysValueError
 
+# Parameter of a command not given one yet
+default_param = "\x00"
+
+
+def header_format(*names):
+    """ The struct format of the [Command Format] Packet Structure
+    fields named, by default every field before the parameter """
+    fields = config['Command Format']['Packet Structure']
+    if not names:
+        names = [name for name in fields if name != 'parameter']
+    return "<" + "".join(fields[name] for name in names)
+
+
+# Header of every command, and of a batch frame (a cmd_id
+# and a device_id holding the number of commands)
+cmd_header_format = header_format()
+cmd_header_size = struct.calcsize(cmd_header_format)
+cmd_header_count = len(struct.unpack(cmd_header_format,
+                                     "\x00" * cmd_header_size))
+batch_header_format = header_format('cmd_id', 'device_id')
+
+
+class CommandEncoder(ElixysObject):
+    """ What all the commands of one (subsystem, command) type
+    share, compiled once: the Struct packing them, the number of
+    values the parameter packs to, the unit count and the command
+    bound to each device.  An encoder is pickled by its key so
+    a command sent to the server process finds the encoder of
+    that process """
+
+    def __init__(self, sub_system, cmd_name, cmd_id):
+        self.key = (sub_system, cmd_name, cmd_id)
+        self.cmd_id = cmd_id[0]
+        # The command header (command identifier, device id, host
+        # sequence id) then the parameter
+        self.struct = struct.Struct(cmd_header_format + cmd_id[1])
+        self.size = self.struct.size
+        # Above one the parameter is a tuple of the values
+        self.arity = len(self.struct.unpack("\x00" * self.size)) - \
+            cmd_header_count
+        self.count = self.sysconf.get(sub_system, {}).get('count', 0)
+        # Flyweights of the command with the default parameter
+        # bound to each device, by device_id
+        self.devices = dict()
+
+    def __reduce__(self):
+        return (get_encoder, self.key)
+
+    def pack(self, device_id, seq_id, param):
+        """ The bytes of a command """
+        try:
+            if self.arity == 1 and not isinstance(param, (tuple, list)):
+                return self.struct.pack(self.cmd_id, device_id, seq_id,
+                                        param)
+            return self.struct.pack(self.cmd_id, device_id, seq_id, *param)
+        except (struct.error, TypeError) as e:
+            raise ElixysValueError("Bad parameter: %s" % e)
+
+    def pack_into(self, buf, offset, device_id, seq_id, param):
+        """ Pack a command in buf at offset,
+        returns the offset after it """
+        try:
+            if self.arity == 1 and not isinstance(param, (tuple, list)):
+                self.struct.pack_into(buf, offset, self.cmd_id, device_id,
+                                      seq_id, param)
+            else:
+                self.struct.pack_into(buf, offset, self.cmd_id, device_id,
+                                      seq_id, *param)
+        except (struct.error, TypeError) as e:
+            raise ElixysValueError("Bad parameter: %s" % e)
+        return offset + self.size
+
+
+# CommandEncoder of each (subsystem, command, (id, format character))
+encoders = dict()
+
+
+def get_encoder(sub_system, cmd_name, cmd_id):
+    """ The CommandEncoder shared by the commands of a type """
+    key = (sub_system, cmd_name, cmd_id)
+    try:
+        return encoders[key]
+    except KeyError:
+        return encoders.setdefault(key, CommandEncoder(*key))
+
 
 class Command(ElixysObject):
     """ The command object allows the system to create
     correctly formatted hardware commands and send them
     to the websocket command queue for transmission to
     the synthesizer hardware """
+
+    # Host sequence id, set when the command is queued,
+    # and the ids of the set commands it replaced in its lane
+    seq_id = 0
+    superseded = ()
     
-    def __init__(self, sub_system, cmd_name, cmd_id, device_id=None, parameter="\x00"):
+    def __init__(self, sub_system, cmd_name, cmd_id, device_id=None, parameter=default_param):
         self.sub_system = sub_system
         self.cmd_name = cmd_name
         self.cmd_id = cmd_id
         self.device_id_ = device_id
         self.param = parameter
+        self.encoder = get_encoder(sub_system, cmd_name, cmd_id)
         
 
     def set_device_id(self, device_id):
@@ -25,7 +116,7 @@ class Command(ElixysObject):
         only valid for commands where the count parameter
         in the INI file in set to a value greater than 0 """
         
-        if not(device_id >=0 and device_id < self.sysconf[self.sub_system].get('count', 0)):
+        if not(device_id >=0 and device_id < self.encoder.count):
             raise ElixysValueError("System has no unit with device_id = %s" % str(device_id))                    
         self.device_id_ = device_id
     
@@ -43,9 +134,18 @@ class Command(ElixysObject):
         The device_id is set the the value of key.
         This will raise an exception if the device_id (key)
         is not allowed due to the count parameter in the INI file.        
+        Without a parameter the command of each device is only
+        created and checked once and then shared, it is read only.
         """
-        new_cmd = copy.copy(self)
+        if self.param is default_param:
+            try:
+                return self.encoder.devices[key]
+            except (KeyError, TypeError):
+                pass
+        new_cmd = self.__copy__()
         new_cmd.device_id = key
+        if self.param is default_param:
+            self.encoder.devices.setdefault(key, new_cmd)
         return new_cmd
         
     def __setitem__(self, ket, value):
@@ -54,35 +154,49 @@ class Command(ElixysObject):
         raise ElixysValueError("Command device_ids are read only")
     
     device_id = property(get_device_id, set_device_id)
+
+    def get_is_idempotent(self):
+        """ Set commands only carry the new value of a setting,
+        sending the latest one is the same as sending them all.
+        Other commands (turn_on, home_axis...) are events """
+        return self.cmd_name.startswith('set_')
+
+    is_idempotent = property(get_is_idempotent)
         
         
     def __call__(self, parameter=None):
         """ Allows the use of the cmd[device_id](param) syntax,
         for the returning of a new Command object.
-        This command can then be place in the queue for transmission
+        This command can then be place in the queue for transmission.
+        The looked up command is left untouched, so a command
+        still waiting to be sent never changes under the server.
+        Without a parameter the shared command itself is returned,
+        copy.copy it before changing it.
         """
-        if not parameter is None:
-            self.param = parameter
-        return self
+        if parameter is None:
+            return self
+        new_cmd = self.__copy__()
+        new_cmd.param = parameter
+        return new_cmd
+
+    def __copy__(self):
+        """ Shallow copy without going through __reduce_ex__,
+        commands are copied for every call and every send """
+        new_cmd = Command.__new__(self.__class__)
+        new_cmd.__dict__.update(self.__dict__)
+        return new_cmd
 
     def __str__(self):
         """ Converts the command to a byte string.
         These byte can then be sent to the synthesizer
         """       
-        try:
-            cmd_pkt =  self.struct_.pack(self.cmd_id[0],
-                                         self.device_id,
-                                         self.param)
-        except struct.error:
-		    try:
-			    cmd_pkt =  self.struct_.pack(self.cmd_id[0],
-                                         self.device_id,
-                                         *self.param)
-		    except TypeError as e:
-			    cmd_pkt = None
-			    raise ElixysValueError("Bad parameter: %s" % e)
-			
-        return cmd_pkt        
+        return self.encoder.pack(self.device_id, self.seq_id, self.param)
+
+    def pack_into(self, buf, offset=0):
+        """ Pack the command in a buffer, e.g. a bytearray
+        reused for every frame, returns the offset after it """
+        return self.encoder.pack_into(buf, offset, self.device_id,
+                                      self.seq_id, self.param)
     
     def get_fmt_str(self):
         """ Uses the format character from the INI file
@@ -90,9 +204,8 @@ class Command(ElixysObject):
         for generating a struct that can properly
         pack the bytes for transmission
         """
-        self.fmt_str_ = "<"  # Endianess-> Little         
-        self.fmt_str_ += "i"  # Command identifier
-        self.fmt_str_ += "i"  # Device id
+        # Little endian command header from [Command Format]
+        self.fmt_str_ = cmd_header_format
         self.fmt_str_ += self.cmd_id[1]  # Parameter type
         return self.fmt_str_
 
@@ -101,9 +214,10 @@ class Command(ElixysObject):
     def get_struct(self):
         """ Returns the struct associated with the
         proper format string for packing the command
-        for transmission to the hardware
+        for transmission to the hardware, compiled once
+        per command type
         """
-        return struct.Struct(self.fmt_str)
+        return self.encoder.struct
     
     struct_ = property(get_struct)
     
@@ -118,6 +232,75 @@ class Command(ElixysObject):
                                             str(self.device_id),
                                             self.param)
 
+class CommandBatch(ElixysObject):
+    """ A batch of commands sent to the hardware in a
+    single frame.  The frame starts with a header packed
+    like a command, its cmd_id is the batch_cmd_id and its
+    device_id is the number of commands in the batch.
+    The commands follow back to back, each packed exactly
+    as it would be on its own.
+    """
+
+    header_struct = struct.Struct(batch_header_format)
+    # Scheduled as one event, nothing is coalesced with it
+    is_idempotent = False
+
+    def __init__(self, cmds=None):
+        self.cmds = list(cmds) if cmds else []
+
+    def get_sub_system(self):
+        return self.cmds[0].sub_system
+
+    sub_system = property(get_sub_system)
+
+    def append(self, cmd):
+        self.cmds.append(cmd)
+
+    def __len__(self):
+        return len(self.cmds)
+
+    def __iter__(self):
+        return iter(self.cmds)
+
+    def get_size(self):
+        return self.header_struct.size + sum(cmd.encoder.size
+                                             for cmd in self.cmds)
+
+    size = property(get_size)
+
+    def pack_into(self, buf, offset=0):
+        """ Pack the batch in a buffer of at least size bytes,
+        returns the offset after it """
+        self.header_struct.pack_into(
+            buf, offset, self.sysconf['Command Format']['batch_cmd_id'],
+            len(self.cmds))
+        offset += self.header_struct.size
+        for cmd in self.cmds:
+            offset = cmd.pack_into(buf, offset)
+        return offset
+
+    def __str__(self):
+        """ Converts the batch to a byte string,
+        every command packed in one buffer """
+        buf = bytearray(self.size)
+        self.pack_into(buf)
+        return str(buf)
+
+    def __repr__(self):
+        return "CommandBatch(%s)" % ", ".join(repr(cmd) for cmd in self.cmds)
+
+
+class CommandTable(dict):
+    """ The commands of a subsystem by name, shared by every
+    caller of the CommandLookup so it can not be changed """
+
+    def read_only(self, *args, **kwargs):
+        raise ElixysValueError("The command tables are read only")
+
+    __setitem__ = __delitem__ = read_only
+    clear = pop = popitem = setdefault = update = read_only
+
+
 class CommandLookup(ElixysObject, dict):
     """ The CommandLookup object has a dictionary like
     interface for accessing the the commands defined in the INI
@@ -130,8 +313,11 @@ class CommandLookup(ElixysObject, dict):
         self.update(*args, **kwargs)
 
     def __getitem__(self, key):
-        val = dict.__getitem__(self, key)        
-        return copy.copy(val)
+        """ The CommandTable of a subsystem, shared and read only.
+        The commands in it, and the commands of each device indexing
+        them gives, are shared too and must not be changed, calling
+        one with a parameter gives a new command """
+        return dict.__getitem__(self, key)
 
     def __setitem__(self, key, val):        
         dict.__setitem__(self, key, val)
@@ -150,6 +336,14 @@ class CommandLookup(ElixysObject, dict):
         objects.  These objects are directly accessible from this object
         using the standard dictionary interface
         """
+        table = config_cache.cached('commands', self.parse_cmd_table)
+        return dict((key, CommandTable((name, Command(key, name, cmd_id))
+                                       for name, cmd_id in cmds.iteritems()))
+                    for key, cmds in table.iteritems())
+
+    def parse_cmd_table(self):
+        """ The (id, format character) of each command by
+        subsystem and name, what the config cache keeps """
         secs = ((name, value['Commands']) for
                 name, value in self.sysconf.iteritems()
                 if isinstance(value, dict)
@@ -159,15 +353,13 @@ class CommandLookup(ElixysObject, dict):
             secdict = dict()
             for subkey, subval in val.iteritems():
                 if subkey != 'Repeat':
-                    secdict[subkey] = Command(key, subkey, subval) #subsubvalsubval
+                    secdict[subkey] = subval
                 else:
                     for subsubkey, subsubval in val["Repeat"].iteritems():
-                        secdict[subsubkey] = Command(key, subsubkey, subsubval) #subsubval
+                        secdict[subsubkey] = subsubval
             cmddict[key] = secdict
         
-        cmddict["System"] = dict()
-        for key, val in self.sysconf['Commands'].iteritems():
-            cmddict["System"][key] =  Command("System", key, val)
+        cmddict["System"] = dict(self.sysconf['Commands'])
             
         return cmddict
 
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+""" The CommandScheduler paces the commands sent to
+the synthesizer hardware.  It lives on the tornado IOLoop
+of the websocket server and uses timeouts instead of sleeping,
+so the IOLoop is always free to receive status packets.
+Each subsystem has its own lane with a token bucket,
+the minimum gap between commands and the burst allowance
+are read from the [WSServer] section of the hwconf and can
+be overridden per subsystem with min_cmd_gap and cmd_burst.
+Idempotent "set" commands waiting in a lane are coalesced,
+only the latest value for each (cmd_id, device_id) is sent.
+All the commands released by one flush are handed to the
+sender together so they can go out in a single frame.
+A CommandBatch is put as one entry of the lane of its first
+command, it takes one token and its commands are released
+together, in order.
+"""
+import time
+import collections
+from multiprocessing import Array
+import tornado.ioloop
+from pyelixys.hal.elixysobject import ElixysObject
+from pyelixys.hal.cmds import CommandBatch
+
+
+class TokenBucket(object):
+    """ Allows `burst` commands back to back, then
+    one command every `min_gap` seconds """
+
+    def __init__(self, min_gap, burst):
+        self.min_gap = min_gap
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.last = time.time()
+
+    def refill(self, now):
+        if self.min_gap > 0:
+            self.tokens = min(self.burst, self.tokens +
+                              (now - self.last) / self.min_gap)
+        else:
+            self.tokens = float(self.burst)
+        self.last = now
+
+    def consume(self, now):
+        """ Take a token, returns 0 if one was available
+        otherwise the number of seconds until one is """
+        self.refill(now)
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return 0.0
+        return (1.0 - self.tokens) * self.min_gap
+
+
+class CommandCounters(object):
+    """ Command counters kept in shared memory so the
+    process that owns the websocket server can update them
+    and the HAL process can read them """
+
+    names = ('queued', 'coalesced', 'sent')
+
+    def __init__(self):
+        self.values = Array('L', len(self.names), lock=False)
+
+    def increment(self, name, value=1):
+        self.values[self.names.index(name)] += value
+
+    def __getitem__(self, name):
+        return self.values[self.names.index(name)]
+
+    def as_dict(self):
+        return dict(zip(self.names, self.values))
+
+
+class CommandLane(object):
+    """ FIFO of commands for one subsystem.  A pending set
+    command is overwritten by a newer one with the same
+    (cmd_id, device_id), event commands (turn_on, home_axis...)
+    are barriers, nothing is coalesced across them so events
+    stay strictly in order with the set commands around them.
+    """
+
+    def __init__(self):
+        self.entries = collections.deque()
+        self.latest = dict()
+
+    def append(self, cmd):
+        """ Add a command, returns True if it replaced
+        a pending command """
+        if not cmd.is_idempotent:
+            self.latest.clear()
+            self.entries.append([cmd])
+            return False
+        key = (cmd.cmd_id, cmd.device_id)
+        entry = self.latest.get(key, None)
+        if not entry is None:
+            # The replaced command is applied along with this one
+            cmd.superseded = entry[0].superseded + (entry[0].seq_id,)
+            entry[0] = cmd
+            return True
+        entry = [cmd]
+        self.latest[key] = entry
+        self.entries.append(entry)
+        return False
+
+    def popleft(self):
+        entry = self.entries.popleft()
+        cmd = entry[0]
+        if cmd.is_idempotent:
+            key = (cmd.cmd_id, cmd.device_id)
+            if self.latest.get(key, None) is entry:
+                del self.latest[key]
+        return cmd
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return (entry[0] for entry in self.entries)
+
+
+class CommandScheduler(ElixysObject):
+    """ Holds the outbound commands in per subsystem
+    lanes and releases them to `send` as fast as the
+    token buckets allow.  `send` is called with the list
+    of released commands and should return False
+    when no client is connected, the commands are then
+    kept until flush is called again.
+    """
+
+    def __init__(self, send, ioloop=None, counters=None):
+        self.send = send
+        self.ioloop = ioloop or tornado.ioloop.IOLoop.instance()
+        self.counters = counters or CommandCounters()
+        self.lanes = collections.OrderedDict()
+        self.buckets = dict()
+        self.timeout = None
+        self.deadline = None
+
+    def get_pacing(self, sub_system):
+        """ Return the (min_gap, burst) for a subsystem """
+        conf = self.sysconf['WSServer']
+        subconf = self.sysconf.get(sub_system, None)
+        if not isinstance(subconf, dict):
+            subconf = {}
+        min_gap = subconf.get('min_cmd_gap', None)
+        burst = subconf.get('cmd_burst', None)
+        if min_gap is None:
+            min_gap = conf['min_cmd_gap']
+        if burst is None:
+            burst = conf['cmd_burst']
+        return min_gap, burst
+
+    def get_bucket(self, sub_system):
+        if not sub_system in self.buckets:
+            self.buckets[sub_system] = TokenBucket(*self.get_pacing(sub_system))
+        return self.buckets[sub_system]
+
+    def put(self, cmd):
+        """ Queue a command (or a CommandBatch) and send
+        it as soon as allowed """
+        if isinstance(cmd, CommandBatch):
+            self.counters.increment('queued', len(cmd))
+        else:
+            self.counters.increment('queued')
+        if self.lanes.setdefault(cmd.sub_system, CommandLane()).append(cmd):
+            self.counters.increment('coalesced')
+        self.flush()
+
+    def pending(self):
+        return sum(len(lane) for lane in self.lanes.values())
+
+    def flush(self):
+        """ Send every command whose lane has a token,
+        then set a timeout for when the next token is available """
+        now = time.time()
+        wait = None
+        ready = []
+        for sub_system, lane in self.lanes.items():
+            bucket = self.get_bucket(sub_system)
+            for cmd in lane:
+                delay = bucket.consume(now)
+                if delay > 0:
+                    wait = delay if wait is None else min(wait, delay)
+                    break
+                ready.append((lane, bucket, cmd))
+        if ready:
+            cmds = []
+            for lane, bucket, cmd in ready:
+                if isinstance(cmd, CommandBatch):
+                    cmds.extend(cmd)
+                else:
+                    cmds.append(cmd)
+            if self.send(cmds) is False:
+                # No client, give the tokens back and wait for one
+                for lane, bucket, cmd in ready:
+                    bucket.tokens = min(bucket.burst, bucket.tokens + 1.0)
+                return
+            for lane, bucket, cmd in ready:
+                lane.popleft()
+            self.counters.increment('sent', len(cmds))
+        if wait is not None:
+            self.schedule(now + wait)
+
+    def schedule(self, deadline):
+        """ Make sure flush runs again at deadline """
+        if self.timeout is not None:
+            if self.deadline <= deadline:
+                return
+            self.ioloop.remove_timeout(self.timeout)
+        self.deadline = deadline
+        self.timeout = self.ioloop.add_timeout(deadline, self.on_timeout)
+
+    def on_timeout(self):
+        self.timeout = None
+        self.deadline = None
+        self.flush()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+""" The communication stack of the HAL, the websocket hardware
+server (process or thread) with the status transport of each
+unit and the Status objects fed from it.  Importing the HAL
+creates none of it, the stack is built when it is first used,
+get_comm_stack() gives the one the SynthesizerObjects share,
+or a stack is built and run explicitly:
+
+    with CommStack() as comms:
+        comms.status().wait_for_packet(timeout=5.0)
+
+Tornado, numpy and the server modules are only imported
+when a stack is built.
+"""
+import threading
+import collections
+from pyelixys.hal.hwconf import config
+from pyelixys.logs import hallog as log
+
+# The unit commands and status go to when none is given
+default_unit = config['WSServer']['units'][0]
+
+
+class CommStack(object):
+    """ The websocket server, the status queue and the Status
+    of each unit.  Nothing runs until start, the status threads
+    and the server stop together """
+
+    def __init__(self, conf=None):
+        from pyelixys.hal.wsserver import create_server, \
+            create_status_queue
+        from pyelixys.hal.status import Status
+        if conf is None:
+            conf = config['WSServer']
+        self.status_queues = collections.OrderedDict(
+            (unit, create_status_queue(conf)) for unit in conf['units'])
+        self.default_unit = conf['units'][0]
+        self.server = create_server(self.status_queues, conf)
+        self.statuses = collections.OrderedDict()
+        for unit in self.status_queues:
+            self.statuses[unit] = Status()
+            self.statuses[unit].add_packet_callback(
+                self.server.cmd_trackers[unit].on_status)
+        self.updating = False
+
+    def status(self, unit=None):
+        """ The Status of a unit, by default the first one """
+        return self.statuses[unit or self.default_unit]
+
+    def start(self):
+        """ Start the status threads and the server,
+        if they are not running yet """
+        if not self.updating:
+            for unit, queue in self.status_queues.items():
+                self.statuses[unit].update_from_queue(
+                    queue, self.server.status_arrivals[unit])
+            self.updating = True
+        if not self.server.is_alive():
+            log.debug("Starting the Websocket communication %s"
+                      % self.server.mode)
+            self.server.start()
+        else:
+            log.debug("The Websocket communication %s is active"
+                      % self.server.mode)
+
+    def stop(self):
+        """ Ask the status threads and the server to stop """
+        if self.updating:
+            for status in self.statuses.values():
+                status.stop_update()
+            self.updating = False
+        self.server.stop()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+comm_stack = None
+comm_stack_lock = threading.Lock()
+
+
+def get_comm_stack():
+    """ The CommStack shared by the HAL, built on the first call """
+    global comm_stack
+    with comm_stack_lock:
+        if comm_stack is None:
+            comm_stack = CommStack()
+        return comm_stack
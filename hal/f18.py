@@ -4,7 +4,6 @@ of abstraction of F18 injection valve system.
 Everything should only access it through this object.
 Each reactor has access to this object.
 """
-import time
 from pyelixys.logs import hallog as log
 from pyelixys.hal.systemobject import SystemObject
 
@@ -24,21 +23,21 @@ class F18(SystemObject):
         """ Turn on the F18 transfer valve """
         log.debug("Turn on F18 transfer valve")
         self.synth.valves[self._valve_id].on = True
-        time.sleep(0.2)
+        self.synth.valves.wait_applied()
 
     def turn_off(self):
         """ Turn off the F18 transfer valve """
         log.debug("Turn off F18 transfer valve")
         self.synth.valves[self._valve_id].on = False
-        time.sleep(0.2)
+        self.synth.valves.wait_applied()
 
     def _is_on(self):
         """ Is F18 transfer valve on """
-        return self.synth.valve[self._valve_id].on
+        return self.synth.valves[self._valve_id].on
 
     def _is_off(self):
         """ Is F18 transfer valve off """
-        return not self.synth.valve[self._valve_id].on
+        return not self.synth.valves[self._valve_id].on
 
     is_on = property(_is_on)
     is_off = property(_is_off)
@@ -18,4 +18,26 @@ fmt_chr = {
     's': 'char[]',
     'p': 'char[]',
     'P': 'void *'
-}
\ No newline at end of file
+}
+
+# The numpy dtype of each struct format character,
+# little endian with the struct standard sizes
+fmt_dtype = {
+    'x': 'V1',
+    'c': 'S1',
+    'b': 'i1',
+    'B': 'u1',
+    '?': '?',
+    'h': '<i2',
+    'H': '<u2',
+    'i': '<i4',
+    'I': '<u4',
+    'l': '<i4',
+    'L': '<u4',
+    'q': '<i8',
+    'Q': '<u8',
+    'f': '<f4',
+    'd': '<f8',
+    's': 'S1',
+    'p': 'S1'
+}
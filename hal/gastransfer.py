@@ -4,7 +4,6 @@ the gas transfer head, lift, lower, open, close,
 transfer on or transfer off.  It also give access
 to all the position sensors on the gas transfer head.
 """
-import time
 from pyelixys.logs import hallog as log
 from pyelixys.hal.pneumaticactuator import PneumaticActuator
 
@@ -26,9 +25,9 @@ class GasTransfer(PneumaticActuator):
     def start_transfer(self):
         """ Turn on the transfer valve """
         self.synth.valves[self._transfer_valve_id].on = True
-        time.sleep(0.2)
+        self.synth.valves.wait_applied()
 
     def stop_transfer(self):
         """ Turn off the transfer valve """
         self.synth.valves[self._transfer_valve_id].on = False
-        time.sleep(0.2)
+        self.synth.valves.wait_applied()
@@ -4,9 +4,7 @@ lift, lower, open, and close the gripper,
 It is also possible to check the open, close,
 up and down sensor.
 """
-import time
 from datetime import timedelta
-from datetime import datetime
 
 from pyelixys.logs import hallog as log
 from pyelixys.hal.hal import SynthesizerHAL
@@ -38,17 +36,16 @@ class Gripper(PneumaticActuator):
 
     def open(self):
         """ Open the gripper and make sure it opens """
-        for i in xrange(self.conf['retry_count']):
-            begintime = datetime.now()
-            self.open_no_check()
-            while self.timeout > datetime.now() - begintime:
-                time.sleep(0.1)
-                if self.is_open:
+        with self.synth.status_rate:
+            for i in xrange(self.conf['retry_count']):
+                self.open_no_check()
+                if self.synth.status.wait_for(lambda: self.is_open,
+                                              self.timeout.total_seconds()):
                     log.debug("Open actuator %s success", repr(self))
                     return
 
-            log.info("Failed to open actautor %s before timeout, retry %d",
-                        repr(self), i)
+                log.info("Failed to open actautor %s before timeout, retry %d",
+                            repr(self), i)
         log.error("Failed to open actuator %s after retrys", repr(self))
         #raise ElixysPneumaticError("Failed to open %s" % repr(self))
 
@@ -56,23 +53,22 @@ class Gripper(PneumaticActuator):
         """ Open the gripper and don't check sensors"""
         log.debug("Gripper Open | Turn on valve:%d, Turn off valve:%d",
                 self._open_valve_id, self._close_valve_id)
-        self.synth.valves[self._close_valve_id].on = False
-        time.sleep(0.2)
-        self.synth.valves[self._open_valve_id].on = True
-        time.sleep(0.2)
+        with self.synth.valves.transaction():
+            self.synth.valves[self._close_valve_id].on = False
+            self.synth.valves[self._open_valve_id].on = True
+        self.synth.valves.wait_applied()
 
     def close(self):
         """ Close the gripper and make sure it closes """
-        for i in xrange(self.conf['retry_count']):
-            begintime = datetime.now()
-            self.close_no_check()
-            while self.timeout > datetime.now() - begintime:
-                time.sleep(0.1)
-                if self.is_closed:
+        with self.synth.status_rate:
+            for i in xrange(self.conf['retry_count']):
+                self.close_no_check()
+                if self.synth.status.wait_for(lambda: self.is_closed,
+                                              self.timeout.total_seconds()):
                     log.debug("Close actuator %s success", repr(self))
                     return
-            log.info("Failed to close actuator %s before timeout, retry %d",
-                        repr(self), i)
+                log.info("Failed to close actuator %s before timeout, retry %d",
+                            repr(self), i)
         log.error("Failed to close actuator %s after retrys", repr(self))
         #raise ElixysPneumaticError("Failed to close %s" % repr(self))
 
@@ -80,10 +76,10 @@ class Gripper(PneumaticActuator):
         """ Close the gripper and don't check the sensors """
         log.debug("Gripper Close | Turn off valve:%d, Turn on valve:%d",
                 self._open_valve_id, self._close_valve_id)
-        self.synth.valves[self._open_valve_id].on = False
-        time.sleep(0.2)
-        self.synth.valves[self._close_valve_id].on = True
-        time.sleep(0.2)
+        with self.synth.valves.transaction():
+            self.synth.valves[self._open_valve_id].on = False
+            self.synth.valves[self._close_valve_id].on = True
+        self.synth.valves.wait_applied()
 
     def _is_open(self):
         """ Check if the gripper is open """
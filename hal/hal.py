@@ -1,9 +1,11 @@
 #!/usr/bin/env python
 import sys
+import threading
 from pyelixys.hal.hwconf import config
 from pyelixys.logs import hallog as log
 from pyelixys.hal.elixysobject import ElixysObject
-from pyelixys.hal.wsserver import wscomproc, status, cmd_lookup
+from pyelixys.hal.comms import get_comm_stack, default_unit
+from pyelixys.hal.cmds import cmd_lookup
 
 # All set_methods will send commands to hardware to change state
 # they will not return (block( until hardware reflects changes,
@@ -24,19 +26,62 @@ from pyelixys.hal.wsserver import wscomproc, status, cmd_lookup
 
 
 class SynthesizerObject(ElixysObject):
-    status = status
+    """ Base of the objects talking to a synthesizer unit,
+    one websocket server serves every unit, the unit
+    picks the status and the commands go to.
+    The server is built on first use (get_comm_stack) """
     cmd_lookup = cmd_lookup
-    comproc = wscomproc
-    
-    def start_com_proc(self):
-        if not self.comproc.is_alive():
-            log.debug("Starting the Websocket communication process")
-            self.comproc.start()
+    unit = None
+
+    def get_comproc(self):
+        return get_comm_stack().server
+
+    comproc = property(get_comproc)
+
+    def get_status(self):
+        return get_comm_stack().status(self.unit)
+
+    status = property(get_status)
+
+    def run_cmd(self, cmd):
+        """ Send a command to this object's unit,
+        returns its sequence id """
+        self.last_seq_id = self.comproc.run_cmd(cmd, self.unit)
+        return self.last_seq_id
+
+    def run_cmds(self, cmds):
+        """ Send several commands to this object's unit as
+        one unit, in order and not paced between them,
+        returns the sequence id of the last one """
+        self.last_seq_id = self.comproc.run_cmds(cmds, self.unit)
+        return self.last_seq_id
+
+    def wait_applied(self, seq=None, timeout=None):
+        """ Wait for the hardware to apply a command, by default
+        the last one this object sent, instead of sleeping a fixed
+        time.  Returns False if the timeout expired first, until
+        the hardware acks a command the wait only lasts the
+        [WSServer] ack_fallback """
+        if seq is None:
+            seq = getattr(self, 'last_seq_id', 0)
+        if self.comproc.wait_applied(seq, self.unit, timeout):
+            return True
+        if self.comproc.is_acking(self.unit):
+            log.warning("%s command %d not applied after %s s"
+                        % (self.__class__.__name__, seq, timeout))
         else:
-            log.debug("The Websocket communication process is active")
+            log.debug("%s command %d not acked, the hardware does "
+                      "not ack commands" % (self.__class__.__name__, seq))
+        return False
+
+    def start_com_proc(self):
+        """ Start the status threads and the websocket server,
+        in its own process or on a thread depending on the
+        [WSServer] mode """
+        get_comm_stack().start()
         
     def stop_com_proc(self):
-        self.comproc.stop()
+        get_comm_stack().stop()
         
                       
 class SynthesizerSubObject(SynthesizerObject):
@@ -48,7 +93,8 @@ class SynthesizerSubObject(SynthesizerObject):
     synthesizer_objects = []
     
 
-    def __init__(self, id, configname=None):
+    def __init__(self, id, configname=None, unit=None):
+        self.unit = unit
         self.set_id(id)
         self.synthesizer_objects.append(self)
         self.configname = configname
@@ -72,7 +118,10 @@ class SynthesizerSubObject(SynthesizerObject):
     unit_conf = property(get_unit_config)
 
     def __repr__(self):
-        return "<%s(%s)>" % (self.__class__.__name__, str(self.id_))
+        if self.unit is None:
+            return "<%s(%s)>" % (self.__class__.__name__, str(self.id_))
+        return "<%s(%s, unit=%s)>" % (self.__class__.__name__,
+                                      str(self.id_), self.unit)
 
 
 class StateMessageParser(ElixysObject):
@@ -87,8 +136,8 @@ class Mixer(SynthesizerSubObject):
     """ The synthesizer has mixers for agitating
     the contents of the reactors.
     """
-    def __init__(self, id):
-        super(Mixer, self).__init__(id, "Mixers")
+    def __init__(self, id, unit=None):
+        super(Mixer, self).__init__(id, "Mixers", unit)
         self.duty_ = 0
         self.period_ = 0
         self.on_ = False
@@ -98,7 +147,7 @@ class Mixer(SynthesizerSubObject):
         if value >= 0.0 and value <= 100.0:
             self.duty_ = value
             cmd = self.cmd_lookup['Mixers']['set_duty_cycle'][self.id_](value)
-            self.comproc.run_cmd(cmd)
+            self.run_cmd(cmd)
         else:
             # Raise Exception, value out of range!
             log.error("Mixer %d duty cycle -> %f out of range" % (self.id_, value))                
@@ -140,52 +189,33 @@ class Mixer(SynthesizerSubObject):
 class Valve(SynthesizerSubObject):
     """ The system uses pnuematic valves to drive
     actuators, the valve objects give access to
-    turn them on or off an monitor the status
+    turn them on or off an monitor the status.
+    The state words are kept by the ValveBank of the unit,
+    shared with the SynthesizerHAL and the other valves
     """
-    def __init__(self, id):
-        super(Valve, self).__init__(id, "Valves")
+
+    def __init__(self, id, unit=None, bank=None):
+        super(Valve, self).__init__(id, "Valves", unit)
         self.on_ = False
-        Valve.valve_state0 = 0
-        Valve.valve_state1 = 0
-        Valve.valve_state2 = 0
-        
+        if bank is None:
+            bank = ValveBank.get_bank(unit)
+        self.bank = bank
+
+    def get_valve_states(self):
+        return self.bank.words
+
+    valve_states_ = property(get_valve_states,
+                             doc="State words of this valve's unit")
+
     def set_on(self, value):
-        if not hasattr(self,'valve_state0') or not hasattr(self,'valve_state1') \
-            or not hasattr(self,'valve_state2'):
-            self.load_states()
         log.debug("Set Valve %d on -> %s" % (self.id_, value))
-        self.on_ = value
-        if self.id_ < 16:
-            log.debug("Before Set Valve %d (state0) on -> %s" % (self.id_, bin(Valve.valve_state0)))
-            if value is True:
-                Valve.valve_state0 |= (1<<(self.id_%16))            
-            else:
-                Valve.valve_state0 &= ~(1<<(self.id_%16))
-            self.comproc.run_cmd(self.cmd_lookup['Valves']['set_state0'](Valve.valve_state0))
-            log.debug("After Set Valve %d (state0) on -> %s" % (self.id_, bin(Valve.valve_state0)))
-            self.on_ = True
-        elif self.id_ < 32:
-            if value is True:
-                Valve.valve_state1 |= (1<< (self.id_%16))
-            else:                
-                Valve.valve_state1 &= ~(1<<(self.id_%16))
-            self.comproc.run_cmd(self.cmd_lookup['Valves']['set_state1'](Valve.valve_state1))
-            log.debug("Set Valve %d (state1) on -> %s" % (self.id_, bin(Valve.valve_state1)))
-            self.on_ = True
-        elif self.id_ < 48:            
-            if value is True:
-                Valve.valve_state2 |= (1<< (self.id_%16))                     
-            else:                
-                Valve.valve_state2 &= ~(1<<(self.id_%16))
-            self.comproc.run_cmd(self.cmd_lookup['Valves']['set_state2'](Valve.valve_state2))
-            log.debug("Set Valve %d (state2) on -> %s" % (self.id_, bin(Valve.valve_state2)))
-            self.on_ = True
-           
-        
-    def get_on(self):        
-        if not hasattr(self,'valve_state0') or not hasattr(self,'valve_state1') \
-            or not hasattr(self,'valve_state2'):
-            self.load_states()
+        with self.bank.lock:
+            self.bank.touch(self)
+            self.on_ = value
+            if self.id_ < 48:
+                self.bank.set(self.id_, value is True)
+
+    def get_on(self):
         val = False
         if self.id_ < 16:
             valve_state = self.status.Valves['state0']
@@ -210,14 +240,160 @@ class Valve(SynthesizerSubObject):
                   doc="Turn valve on")
 
 
+class ValveBank(SynthesizerObject):
+    """ The valves of a unit and their three 16 bit state words,
+    hal.valves[i].on = True.  Each change sends the word of the
+    valve, within a transaction the changes are only applied to
+    the words and the words changed are sent together when the
+    outermost transaction ends, at most one command per word,
+    handed to the server together so they are not paced apart:
+
+        with hal.valves.transaction():
+            hal.valves[3].on = False
+            hal.valves[4].on = True
+
+    The bank lock is held for the transaction, the valve changes
+    of other threads wait for it.  The words only turning valves
+    off are sent first, then the others in the order they were
+    first changed, so a valve and its opposite in another word
+    (a reactor's up and down) are never on together.
+    If the transaction raises the words and the on_ of the valves
+    are restored and nothing is sent.
+    get_bank gives the bank of a unit, shared by everything
+    setting its valves.
+    """
+    # The bank of each unit
+    banks = dict()
+    banks_lock = threading.Lock()
+
+    def __init__(self, count, unit=None):
+        self.unit = unit
+        self.words = [0, 0, 0]
+        self.lock = threading.RLock()
+        # Nesting of the transactions, the words to send in the
+        # order they were first changed, their value before the
+        # transaction and the (valve, on_) to restore on rollback
+        self.depth = 0
+        self.changed = []
+        self.saved = None
+        self.touched = []
+        self.valves = []
+        self.add_valves(count)
+
+    @classmethod
+    def get_bank(cls, unit=None, count=0):
+        """ The bank of a unit, built on the first call,
+        with at least count valves """
+        with cls.banks_lock:
+            bank = cls.banks.get(unit or default_unit)
+            if bank is None:
+                bank = cls.banks[unit or default_unit] = cls(0, unit)
+        bank.add_valves(count)
+        return bank
+
+    def add_valves(self, count):
+        """ Create the valves up to count """
+        with self.lock:
+            self.valves.extend(Valve(i, self.unit, self) for i in
+                               range(len(self.valves), count))
+
+    def __getitem__(self, idx):
+        return self.valves[idx]
+
+    def __len__(self):
+        return len(self.valves)
+
+    def __iter__(self):
+        return iter(self.valves)
+
+    def set(self, valve_id, value):
+        """ Turn a valve on or off """
+        word = valve_id // 16
+        with self.lock:
+            log.debug("Before Set Valve %d (state%d) on -> %s" %
+                      (valve_id, word, bin(self.words[word])))
+            if value:
+                self.words[word] |= (1<<(valve_id%16))
+            else:
+                self.words[word] &= ~(1<<(valve_id%16))
+            if self.depth:
+                if not word in self.changed:
+                    self.changed.append(word)
+            else:
+                self.send(word)
+
+    def touch(self, valve):
+        """ Remember the on_ of a valve changed in a transaction """
+        with self.lock:
+            if self.depth:
+                self.touched.append((valve, valve.on_))
+
+    def word_cmd(self, word):
+        cmd_name = 'set_state%d' % word
+        log.debug("After Set Valve (state%d) on -> %s" %
+                  (word, bin(self.words[word])))
+        return self.cmd_lookup['Valves'][cmd_name](self.words[word])
+
+    def send(self, word):
+        self.run_cmd(self.word_cmd(word))
+
+    def send_changed(self, changed):
+        """ Send the words changed by a transaction, those only
+        clearing bits first, in one run_cmds """
+        clearing = [word for word in changed
+                    if not self.words[word] & ~self.saved[word]]
+        setting = [word for word in changed if not word in clearing]
+        if len(changed) == 1:
+            self.send(changed[0])
+        elif changed:
+            self.run_cmds([self.word_cmd(word)
+                           for word in clearing + setting])
+
+    def transaction(self):
+        """ Context manager collapsing the valve changes made in
+        it into one write per state word """
+        return self
+
+    def __enter__(self):
+        self.lock.acquire()
+        if self.depth == 0:
+            self.saved = list(self.words)
+        self.depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.depth -= 1
+            if self.depth == 0:
+                changed = self.changed
+                touched = self.touched
+                self.changed = []
+                self.touched = []
+                if exc_type is not None:
+                    self.words[:] = self.saved
+                    for valve, on in reversed(touched):
+                        valve.on_ = on
+                else:
+                    self.send_changed(changed)
+        finally:
+            self.lock.release()
+
+    def wait_applied(self, seq=None, timeout=None):
+        """ Wait for the last write of the bank to be applied, by
+        default for up to the [Valves] apply_timeout """
+        if timeout is None:
+            timeout = self.sysconf['Valves']['apply_timeout']
+        return super(ValveBank, self).wait_applied(seq, timeout)
+
+
 class Thermocouple(SynthesizerSubObject):
     """ Each reactor has multiple thermocouples to
     monitor the temperature of each individual collet.
     This object is read-only but allows the monitoring
     of the collet temperatures
     """
-    def __init__(self, id, configname="Thermocouples"):
-        super(Thermocouple, self).__init__(id, configname)
+    def __init__(self, id, configname="Thermocouples", unit=None):
+        super(Thermocouple, self).__init__(id, configname, unit)
         self.temperature_ = 25.0
 
     def get_temperature(self):
@@ -234,8 +410,8 @@ class AuxThermocouple(Thermocouple):
     for monitoring user define temperatures such
     as thermocouples place with in the vials
     """
-    def __init__(self, id):
-        super(AuxThermocouple, self).__init__(id,  "AuxThermocouples")
+    def __init__(self, id, unit=None):
+        super(AuxThermocouple, self).__init__(id,  "AuxThermocouples", unit)
         
     def get_temperature(self):
         log.debug("Get AuxThermocouple %d temperature -> %f"
@@ -255,8 +431,8 @@ class Heater(SynthesizerSubObject):
     on heaters.  This prevents a user from purposely or
     accidentally generating a 'run away' heater.
     """
-    def __init__(self, id):
-        super(Heater, self).__init__(id, "Heaters")
+    def __init__(self, id, unit=None):
+        super(Heater, self).__init__(id, "Heaters", unit)
         self.on_ = False
 
     def get_on(self):        
@@ -275,9 +451,10 @@ class TemperatureController(SynthesizerSubObject):
     you to set the set-point and activate
     or deactivate the controller.
     """
-    def __init__(self, id):
+    def __init__(self, id, unit=None):
         super(TemperatureController, self).__init__(id,
-                                                    "TemperatureControllers")
+                                                    "TemperatureControllers",
+                                                    unit)
 
         self.setpoint_ = 25.0
         self.temperature_ = 25.0
@@ -300,7 +477,7 @@ class TemperatureController(SynthesizerSubObject):
         log.debug("Set Temperature Controller %d setpoint -> %f"
                   % (self.id_, self.setpoint_))
         cmd = self.cmd_lookup['TemperatureControllers']['set_setpoint'][self.id_](value)
-        self.comproc.run_cmd(cmd)
+        self.run_cmd(cmd)
         
     setpoint = property(get_setpoint, set_setpoint,
                         doc="Set the temperature controller setpoint")
@@ -332,7 +509,7 @@ class TemperatureController(SynthesizerSubObject):
             cmd = self.cmd_lookup['TemperatureControllers']['turn_on'][self.id_]()
         else:
             cmd = self.cmd_lookup['TemperatureControllers']['turn_off'][self.id_]()
-        self.comproc.run_cmd(cmd)
+        self.run_cmd(cmd)
     on = property(get_on, set_on,
                   doc="Turn temperature controller on/off")
 
@@ -344,8 +521,8 @@ class SMCInterface(SynthesizerSubObject):
     outputs. Additional methods allow the pressure to the read or set
     in psi.
     """
-    def __init__(self, id):
-        super(SMCInterface, self).__init__(id, "SMCInterfaces")
+    def __init__(self, id, unit=None):
+        super(SMCInterface, self).__init__(id, "SMCInterfaces", unit)
         self.analog_out_ = 0        
 
     def set_analog_out(self, value):
@@ -353,7 +530,7 @@ class SMCInterface(SynthesizerSubObject):
             # Should raise exception in future!!!!
             log.error("SMC Analog setpoint (%f) out of range" % value)
             return
-        self.comproc.run_cmd(self.cmd_lookup['SMCInterfaces']['set_analog_out'][self.id_](value))
+        self.run_cmd(self.cmd_lookup['SMCInterfaces']['set_analog_out'][self.id_](value))
         log.debug("Set SMC Analog out %d on -> %s"
                   % (self.id_, value))
         
@@ -387,8 +564,8 @@ class Fan(SynthesizerSubObject):
     """ Elixys can get hot, lets help it blow off
     some steam by enabling or disabling the fans
     """
-    def __init__(self, id):
-        super(Fan, self).__init__(id, "Fans")
+    def __init__(self, id, unit=None):
+        super(Fan, self).__init__(id, "Fans", unit)
         self.on_ = False
 
     def get_on(self):
@@ -407,7 +584,7 @@ class Fan(SynthesizerSubObject):
             log.debug("Turn Off")
             cmd = self.cmd_lookup['Fans']['turn_off'][self.id_]()
         
-        self.comproc.run_cmd(cmd)
+        self.run_cmd(cmd)
         
     on = property(get_on, set_on,
                   doc="Turn on/off fan")
@@ -417,8 +594,8 @@ class LinearActuator(SynthesizerSubObject):
     """ The system has multiple linear actuators that
     can have their positions set, and read.
     """
-    def __init__(self, id):
-        super(LinearActuator, self).__init__(id, "LinearActuators")
+    def __init__(self, id, unit=None):
+        super(LinearActuator, self).__init__(id, "LinearActuators", unit)
 
     def set_position(self, value):
         log.debug("Set Actuator %d Position -> %s"
@@ -451,8 +628,8 @@ class DigitalInput(SynthesizerSubObject):
     """ The pneumatically controlled axis have up/down
     sensors for feedback on position.
     """
-    def __init__(self, id):
-        super(DigitalInput, self).__init__(id, "DigitalInputs")
+    def __init__(self, id, unit=None):
+        super(DigitalInput, self).__init__(id, "DigitalInputs", unit)
         self.tripped_ = False
 
     def get_tripped(self):        
@@ -484,8 +661,8 @@ class LiquidSensor(SynthesizerSubObject):
     """ Liquid sensors can be used as feedback on
     the processes
     """
-    def __init__(self, id):
-        super(LiquidSensor, self).__init__(id, "LiquidSensors")
+    def __init__(self, id, unit=None):
+        super(LiquidSensor, self).__init__(id, "LiquidSensors", unit)
         self.analog_out_ = 0
 
     def get_analog_out(self):
@@ -498,46 +675,88 @@ class LiquidSensor(SynthesizerSubObject):
                           doc="Liquid sensor ADC value")
 
 
+class StatusRate(SynthesizerObject):
+    """ The hardware streams status every idle_status_period ms,
+    while any wait on a sensor is in progress it streams every
+    active_status_period ms so transitions are seen sooner.
+    Used as a context manager around the waits, they nest
+    and can run on several threads.
+    """
+    def __init__(self, unit=None):
+        self.unit = unit
+        self.waits = 0
+        self.lock = threading.Lock()
+        self.period_ = None
+
+    def set_period(self, value):
+        log.debug("Set status period -> %d ms" % value)
+        self.period_ = value
+        cmd = self.cmd_lookup['System']['set_status_period'](value)
+        self.run_cmd(cmd)
+
+    def get_period(self):
+        return self.period_
+
+    period = property(get_period, set_period,
+                      doc="Time between status packets in ms")
+
+    def __enter__(self):
+        with self.lock:
+            self.waits += 1
+            if self.waits == 1:
+                self.period = self.sysconf['Header']['active_status_period']
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        with self.lock:
+            self.waits -= 1
+            if self.waits == 0:
+                self.period = self.sysconf['Header']['idle_status_period']
+
+
 class SynthesizerHAL(SynthesizerObject):
     """ The is the Synthesizer object giving
-    access to all the sub systems.
+    access to all the sub systems of one synthesizer unit,
+    by default the first unit in the [WSServer] config.
     """
-    def __init__(self):
+    def __init__(self, unit=None):
         
         super(SynthesizerHAL, self).__init__()        
+        self.unit = unit
         
         log.debug("Initializing SynthesizerHAL")
-        self.mixer_motors = [Mixer(i) for i in
+        self.mixer_motors = [Mixer(i, unit=unit) for i in
                              range(self.sysconf['Mixers']['count'])]
-        self.valves = [Valve(i) for i in
-                       range(self.sysconf['Valves']['count'])]
-        self.thermocouples = [Thermocouple(i) for i in
+        self.valves = ValveBank.get_bank(unit,
+                                         self.sysconf['Valves']['count'])
+        self.thermocouples = [Thermocouple(i, unit=unit) for i in
                               range(self.sysconf['Thermocouples']['count'])]
         self.aux_thermocouples = [
-            AuxThermocouple(i) for i in
+            AuxThermocouple(i, unit=unit) for i in
             range(self.sysconf['AuxThermocouples']['count'])]
 
-        self.heaters = [Heater(i) for i in
+        self.heaters = [Heater(i, unit=unit) for i in
                         range(self.sysconf['Heaters']['count'])]
 
         self.temperature_controllers = [
-            TemperatureController(i) for i in
+            TemperatureController(i, unit=unit) for i in
             range(self.sysconf['TemperatureControllers']['count'])]
 
-        self.smc_interfaces = [SMCInterface(i) for i in
+        self.smc_interfaces = [SMCInterface(i, unit=unit) for i in
                                range(self.sysconf['SMCInterfaces']['count'])]
 
-        self.fans = [Fan(i) for i in
+        self.fans = [Fan(i, unit=unit) for i in
                      range(self.sysconf['Fans']['count'])]
 
-        self.linear_axis = [LinearActuator(i) for i in
+        self.linear_axis = [LinearActuator(i, unit=unit) for i in
                             range(self.sysconf['LinearActuators']['count'])]
 
-        self.digital_inputs = [DigitalInput(i) for i in
+        self.digital_inputs = [DigitalInput(i, unit=unit) for i in
                                range(self.sysconf['DigitalInputs']['count'])]
 
-        self.liquid_sensors = [LiquidSensor(i) for i in
+        self.liquid_sensors = [LiquidSensor(i, unit=unit) for i in
                                range(self.sysconf['LiquidSensors']['count'])]
+        self.status_rate = StatusRate(unit)
         self.start_com_proc()
         
 if __name__ == '__main__':
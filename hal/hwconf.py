@@ -1,13 +1,28 @@
 #!/usr/bin/env python
-
+""" Loads the validated hwconf.  Parsing and validating the
+INI files is most of the startup time, the validated config and
+the tables derived from it (status struct format, decode plan,
+command table) are kept in a cache file, keyed by the hash of
+hwconf.ini, hwconfspec.ini and the source of the modules building
+the tables, and loaded with a single read.  Loading the cache only
+creates the configobj classes, any other object in the file fails
+the load and the cache is rebuilt.  It is written once, at exit,
+if a table was built.
+The validate module is only imported when the cache is stale.
+Set ELIXYS_HWCONF_CACHE to another cache file, or to an empty
+string to always load the INI files.
+"""
+import os
+import atexit
+import hashlib
+import cPickle
+import configobj
 from configobj import ConfigObj
-from validate import Validator
-import re
-from validate import ValidateError
 
 
 def command_check(vals):
     # Validates the commands in the config file
+    from validate import ValidateError
     #print "Running command check"
     #print vals
     try:
@@ -32,6 +47,7 @@ def command_check(vals):
     
 def list3ints_check(vals):
     # Validates that we recieve a list of 3 ints
+    from validate import ValidateError
     # print "Running list of 3 ints validation"
     if len(vals) != 3:
         raise ValidateError("Expecting a list of 3 integers.  Did not receive 3 integers.")
@@ -44,10 +60,127 @@ def list3ints_check(vals):
     return idxs
 
 
+
+# The classes the cache file may hold, only the config
+cache_globals = ('ConfigObj', 'Section', 'ConfigParserInterpolation',
+                 'TemplateInterpolation')
+
+
+def find_cache_global(module, name):
+    """ Loads the cache_globals, any other global fails the load """
+    if module != 'configobj' or not name in cache_globals:
+        raise cPickle.UnpicklingError("%s.%s is not allowed in the "
+                                      "config cache" % (module, name))
+    return getattr(configobj, name)
+
+
+class ConfigCache(object):
+    """ Tables derived from the config, pickled in filename
+    under the hash of the source files (the INI files and the
+    modules building the tables).  A missing, stale or
+    unreadable cache file is rebuilt, a cache that can not be
+    written (read only install) only costs the cold start """
+
+    def __init__(self, filename, sources):
+        self.filename = filename
+        self.key = self.get_key(sources)
+        if self.key is None:
+            self.filename = None
+        self.tables = self.load()
+        # Tables built since the cache was loaded
+        self.dirty = False
+
+    def get_key(self, sources):
+        """ Hash of the sources, None if one can not be read """
+        digest = hashlib.sha1()
+        for source in sources:
+            try:
+                with open(source, 'rb') as f:
+                    digest.update(f.read())
+            except IOError:
+                return None
+        return digest.hexdigest()
+
+    def load(self):
+        """ The tables of the cache file if it matches the sources """
+        if not self.filename:
+            return dict()
+        try:
+            with open(self.filename, 'rb') as f:
+                unpickler = cPickle.Unpickler(f)
+                unpickler.find_global = find_cache_global
+                key, tables = unpickler.load()
+        except Exception:
+            # Missing, truncated, pickled by other code
+            # or holding other objects
+            return dict()
+        if key != self.key:
+            return dict()
+        return tables
+
+    def save(self):
+        """ Write the cache if a table was built, through a rename
+        so a process starting at the same time never reads half
+        of it """
+        if not self.filename or not self.dirty:
+            return
+        self.dirty = False
+        tmpname = "%s.%d" % (self.filename, os.getpid())
+        try:
+            with open(tmpname, 'wb') as f:
+                cPickle.dump((self.key, self.tables), f,
+                             cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmpname, self.filename)
+        except (IOError, OSError):
+            pass
+
+    def cached(self, name, build):
+        """ The table name, build() is only called when it is
+        not in the cache yet, the cache is written by save.
+        Only plain data, the cache is loaded while importing
+        hwconf and can not import the modules using it """
+        try:
+            return self.tables[name]
+        except KeyError:
+            pass
+        table = self.tables[name] = build()
+        self.dirty = True
+        return table
+
+
+def load_config():
+    """ Parse and validate the INI files, returns
+    the config and the validation results """
+    from validate import Validator
+    config = ConfigObj(configfile, configspec=configspec)
+    validator = Validator({'command': command_check,
+                           'list3ints': list3ints_check})
+    results = config.validate(validator,preserve_errors=True)
+    # The parsed spec is only needed to validate, it would be
+    # most of the cache and of the time to load it
+    drop_validation(config)
+    return config, results
+
+
+def drop_validation(section):
+    """ Remove what validate left on the sections, loading
+    the cache would import validate for it """
+    section.configspec = None
+    section.__dict__.pop('_vdtMissingValue', None)
+    for name in section.sections:
+        drop_validation(section[name])
+
+
 configspec = "pyelixys/hal/hwconfspec.ini"
 configfile = "pyelixys/hal/hwconf.ini"
-config = ConfigObj(configfile, configspec=configspec)
-validator = Validator({'command': command_check,
-                       'list3ints': list3ints_check})
-results = config.validate(validator,preserve_errors=True)
+cachefile = os.environ.get("ELIXYS_HWCONF_CACHE", "pyelixys/hal/hwconf.cache")
+# The modules building the cached tables
+table_sources = [os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              name) for name in
+                 ("hwconf.py", "statusfmt.py", "status.py", "cmds.py")]
+config_cache = ConfigCache(cachefile, [configfile, configspec] +
+                           table_sources)
+config, results = config_cache.cached('config', load_config)
+# Written once, with the tables built while starting up
+atexit.register(config_cache.save)
 
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+""" The PacketStats object accounts for the status packets of
+one hardware connection from the packet_id of their Header.
+The hardware increments packet_id for every packet it sends, the
+host counts the ids it never got (lost), the ids it got twice
+(duplicates) and the ids that showed up after a later one
+(reordered, these are no longer counted as lost).
+An id far behind the last one means the hardware reconnected and
+started counting again, the stats of the new connection start
+from zero.
+The time between two packets, per packet_id step so a lost packet
+does not count as a late one, is kept in a histogram of the last
+stats_window packets along with a smoothed jitter estimate
+(RFC 3550 style, the mean deviation between consecutive intervals).
+The ArrivalTimes of a unit are written by the websocket server when
+a packet comes in (in shared memory, the server may run in its own
+process), the StatusThread reads them back to know how long the
+packets it takes off the queue waited and keeps the ConsumerLag.
+"""
+import time
+import collections
+from multiprocessing import Array
+from pyelixys.hal.elixysobject import ElixysObject
+from pyelixys.hal.cmdack import LatencyHistogram
+
+
+class PacketStats(ElixysObject):
+    """ Loss, duplicate, reorder and jitter accounting,
+    on_packet is called with the packet_id of every packet """
+
+    def __init__(self, window=None, reorder_window=None):
+        if window is None:
+            window = self.sysconf['Header']['stats_window']
+        if reorder_window is None:
+            reorder_window = self.sysconf['Header']['reorder_window']
+        self.window = window
+        self.reorder_window = reorder_window
+        self.connections = 0
+        self.reset()
+
+    def reset(self):
+        """ Start the stats of a new connection """
+        self.received = 0
+        self.lost = 0
+        self.duplicates = 0
+        self.reordered = 0
+        self.last_id = None
+        self.last_time = None
+        self.last_interval = None
+        self.jitter = 0.0
+        # Ids skipped over that may still arrive late
+        self.missing = set()
+        # Ids seen lately, to tell duplicates apart
+        self.seen = collections.deque(maxlen=self.reorder_window)
+        self.intervals = collections.deque(maxlen=self.window)
+
+    def on_packet(self, packet_id, now=None):
+        """ Account for a packet, returns False for a duplicate
+        or late packet, its state is older than the last one """
+        if now is None:
+            now = time.time()
+        if self.last_id is None or \
+                packet_id + self.reorder_window < self.last_id:
+            self.reset()
+            self.connections += 1
+            self.last_id = packet_id - 1
+
+        if packet_id in self.seen:
+            self.duplicates += 1
+            return False
+        self.seen.append(packet_id)
+        self.received += 1
+
+        if packet_id <= self.last_id:
+            # Late, it was counted as lost when skipped over
+            if packet_id in self.missing:
+                self.missing.discard(packet_id)
+                self.lost -= 1
+            self.reordered += 1
+            return False
+
+        step = packet_id - self.last_id
+        if step > 1:
+            self.lost += step - 1
+            self.missing.update(range(max(self.last_id + 1,
+                                          packet_id - self.reorder_window),
+                                      packet_id))
+            self.missing = set(i for i in self.missing
+                               if i >= packet_id - self.reorder_window)
+        if self.last_time is not None:
+            interval = (now - self.last_time) / step
+            self.intervals.append(interval)
+            if self.last_interval is not None:
+                deviation = abs(interval - self.last_interval)
+                self.jitter += (deviation - self.jitter) / 16.0
+            self.last_interval = interval
+        self.last_id = packet_id
+        self.last_time = now
+        return True
+
+    def get_loss_rate(self):
+        expected = self.received + self.lost
+        return float(self.lost) / expected if expected else 0.0
+
+    loss_rate = property(get_loss_rate)
+
+    def interval_histogram(self):
+        """ Histogram of the intervals between the last packets """
+        hist = LatencyHistogram()
+        for interval in self.intervals:
+            hist.add(interval)
+        return hist
+
+    def as_dict(self):
+        return {'connections': self.connections,
+                'received': self.received,
+                'lost': self.lost,
+                'duplicates': self.duplicates,
+                'reordered': self.reordered,
+                'loss_rate': self.loss_rate,
+                'jitter': self.jitter * 1000.0,
+                'interval': self.interval_histogram().as_dict()}
+
+    def __repr__(self):
+        return "PacketStats(received=%d, lost=%d, duplicates=%d, " \
+            "reordered=%d, jitter=%.3f ms)" % (self.received, self.lost,
+                                               self.duplicates,
+                                               self.reordered,
+                                               self.jitter * 1000.0)
+
+
+class ArrivalTimes(ElixysObject):
+    """ Time each of the last window status packets of a unit
+    reached the websocket server, by arrival index """
+
+    def __init__(self, window=None):
+        if window is None:
+            window = self.sysconf['Header']['stats_window']
+        self.window = window
+        self.times = Array('d', window, lock=False)
+        self.count_ = Array('L', 1, lock=False)
+
+    def get_count(self):
+        """ Packets received since the start """
+        return self.count_[0]
+
+    count = property(get_count)
+
+    def on_packet(self, now=None):
+        """ Server side, a packet came in """
+        if now is None:
+            now = time.time()
+        self.times[self.count_[0] % self.window] = now
+        self.count_[0] += 1
+
+    def get_time(self, index):
+        """ Arrival time of packet index, None if it
+        fell out of the window """
+        count = self.count_[0]
+        if not count - self.window <= index < count:
+            return None
+        return self.times[index % self.window]
+
+
+class ConsumerLag(object):
+    """ How far behind the server the status consumer runs,
+    the packets waiting when it took the queue and the age of
+    the packet it decoded, in milliseconds """
+
+    def __init__(self):
+        self.age = LatencyHistogram()
+        self.packets = 0
+        self.max_packets = 0
+        self.skipped = 0
+        self.last_age = 0.0
+
+    def add(self, packets, age=None, skipped=0):
+        self.packets = packets
+        self.max_packets = max(self.max_packets, packets)
+        self.skipped += skipped
+        if age is not None:
+            self.age.add(age)
+            self.last_age = age * 1000.0
+
+    def as_dict(self):
+        return {'packets': self.packets,
+                'max_packets': self.max_packets,
+                'skipped': self.skipped,
+                'age': self.last_age,
+                'age_histogram': self.age.as_dict()}
+
+    def __repr__(self):
+        return "ConsumerLag(packets=%d, max=%d, skipped=%d, " \
+            "age=%.3f ms)" % (self.packets, self.max_packets,
+                              self.skipped, self.last_age)
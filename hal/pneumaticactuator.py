@@ -5,9 +5,7 @@ The current elixys system has 5 of these axis.
 Eache reactor, the gripper and the gas transfer inherit from
 this object
 """
-import time
 from datetime import timedelta
-from datetime import datetime
 
 from pyelixys.logs import hallog as log
 from pyelixys.hal.systemobject import SystemObject
@@ -45,17 +43,16 @@ class PneumaticActuator(SystemObject):
 
     def lift(self):
         """ Move the actuator up and ensure it gets there """
-        for i in xrange(self.conf['retry_count']):
-            begintime = datetime.now()
-            self.lift_no_check()
-            while self.timeout > datetime.now() - begintime:
-                time.sleep(0.1)
-                if self.is_up:
+        with self.synth.status_rate:
+            for i in xrange(self.conf['retry_count']):
+                self.lift_no_check()
+                if self.synth.status.wait_for(lambda: self.is_up,
+                                              self.timeout.total_seconds()):
                     log.debug("Lift actuator %s success", repr(self))
                     return
 
-            log.info("Failed to raise actautor %s before timeout, retry %d",
-                        repr(self), i)
+                log.info("Failed to raise actautor %s before timeout, retry %d",
+                            repr(self), i)
         log.error("Failed to raise actuator %s after retrys", repr(self))
         #raise ElixysPneumaticError("Failed to lift %s" % repr(self))
 
@@ -64,22 +61,21 @@ class PneumaticActuator(SystemObject):
         """ Lift actuator but don't wait """
         log.debug("Actuator %s lift | Turn on valve:%d, Turn off valve:%d",
                 repr(self), self._up_valve_id, self._down_valve_id)
-        self.synth.valves[self._down_valve_id].on = False
-        time.sleep(0.2)
-        self.synth.valves[self._up_valve_id].on = True
+        with self.synth.valves.transaction():
+            self.synth.valves[self._down_valve_id].on = False
+            self.synth.valves[self._up_valve_id].on = True
 
     def lower(self):
         """ Lower actuator and unsure it gets there """
-        for i in xrange(self.conf['retry_count']):
-            begintime = datetime.now()
-            self.lower_no_check()
-            while self.timeout > datetime.now() - begintime:
-                time.sleep(0.1)
-                if self.is_down:
+        with self.synth.status_rate:
+            for i in xrange(self.conf['retry_count']):
+                self.lower_no_check()
+                if self.synth.status.wait_for(lambda: self.is_down,
+                                              self.timeout.total_seconds()):
                     log.debug("Lower actuator %s success", repr(self))
                     return
-            log.info("Failed to raise actuator %s before timeout, retry %d",
-                        repr(self), i)
+                log.info("Failed to raise actuator %s before timeout, retry %d",
+                            repr(self), i)
         log.error("Failed to lower actuator %s after retrys", repr(self))
         #raise ElixysPneumaticError("Failed to lower %s" % repr(self))
 
@@ -87,9 +83,9 @@ class PneumaticActuator(SystemObject):
         """ Move the actuator down but don't wait """
         log.debug("Actuator %s lower | Turn on valve:%d, Turn off valve:%d",
                 repr(self), self._down_valve_id, self._up_valve_id)
-        self.synth.valves[self._up_valve_id].on = False
-        time.sleep(0.2)
-        self.synth.valves[self._down_valve_id].on = True
+        with self.synth.valves.transaction():
+            self.synth.valves[self._up_valve_id].on = False
+            self.synth.valves[self._down_valve_id].on = True
 
     def _is_up(self):
         """ Check if actuator is up """
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+""" The StatusRing and StatusSlot move the status packets from the
+websocket server process to the HAL process without
+pickling them.  They live in an anonymous shared mmap,
+created before the server process is forked so
+both processes map the same memory.
+The StatusRing is a fixed slot ring buffer, the server copies each
+raw packet into the next slot and bumps a sequence counter,
+the HAL copies the packets out of the slots and checks the
+slot was not overwritten while it was copying.
+The StatusSlot only keeps the latest packet, in a double buffer
+guarded by a seqlock, the HAL always reads the freshest
+complete packet and counts the packets it never saw.
+A pipe is used to wake up the reader when packets arrive.
+They have the same put/get interface as a Queue so the
+StatusThread can consume from any of them.
+"""
+import os
+import mmap
+import time
+import fcntl
+import errno
+import select
+import struct
+from Queue import Empty
+from pyelixys.logs import wsslog as log
+
+
+class SharedStatusBuffer(object):
+    """ Base for the shared memory status transports,
+    sets up the mmap and the pipe used to wake the reader """
+
+    header_struct = struct.Struct("<Q")
+
+    def __init__(self, size, slot_size):
+        self.slot_size = slot_size
+        self.buf = mmap.mmap(-1, size)
+        self.notify_r, self.notify_w = os.pipe()
+        for fd in (self.notify_r, self.notify_w):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        # Reader side count of packets it never got
+        self.skipped = 0
+        # Writer side count of packets too big to be stored
+        self.dropped = 0
+
+    def get_write_seq(self):
+        return self.header_struct.unpack_from(self.buf, 0)[0]
+
+    write_seq = property(get_write_seq)
+
+    def check_size(self, pkt):
+        if len(pkt) > self.slot_size:
+            self.dropped += 1
+            log.error("Status packet of %d bytes does not fit "
+                      "in the %d byte slots", len(pkt), self.slot_size)
+            return False
+        return True
+
+    def notify(self):
+        try:
+            os.write(self.notify_w, "\x00")
+        except OSError as e:
+            # The pipe is full, the reader has plenty of wake ups
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def wait(self, timeout=None):
+        """ Block until the writer signals a new packet """
+        try:
+            select.select([self.notify_r], [], [], timeout)
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+
+    def drain_notify(self):
+        try:
+            while os.read(self.notify_r, 4096):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def wait_deadline(self, deadline):
+        """ Wait for a packet until the deadline, raises
+        Empty once it has passed """
+        remaining = None
+        if deadline is not None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise Empty
+        self.wait(remaining)
+
+    def put_nowait(self, pkt):
+        return self.put(pkt, False)
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def empty(self):
+        return self.qsize() <= 0
+
+
+class StatusRing(SharedStatusBuffer):
+    """ Single producer, single consumer ring of status packets.
+    The memory layout is a header holding the sequence number
+    of the next packet to be written, then the slots.  Each slot
+    holds the sequence number of the packet in it, its length
+    and the packet bytes.
+    """
+
+    slot_header_struct = struct.Struct("<QI")
+
+    def __init__(self, slots=64, slot_size=512):
+        self.slots = slots
+        self.slot_stride = self.slot_header_struct.size + slot_size
+        super(StatusRing, self).__init__(self.header_struct.size +
+                                         slots * self.slot_stride, slot_size)
+        self.read_seq = 0
+
+    def slot_offset(self, seq):
+        return self.header_struct.size + (seq % self.slots) * self.slot_stride
+
+    def put(self, pkt, block=True, timeout=None):
+        """ Copy a packet into the next slot, never blocks,
+        the oldest packets are overwritten if the reader
+        falls a whole ring behind """
+        if not self.check_size(pkt):
+            return
+        seq = self.get_write_seq()
+        offset = self.slot_offset(seq)
+        data_offset = offset + self.slot_header_struct.size
+        # Mark the slot as being written so a lapped reader
+        # can not mistake it for a complete packet
+        self.slot_header_struct.pack_into(self.buf, offset, 0, 0)
+        self.buf[data_offset:data_offset + len(pkt)] = pkt
+        self.slot_header_struct.pack_into(self.buf, offset, seq + 1, len(pkt))
+        self.header_struct.pack_into(self.buf, 0, seq + 1)
+        self.notify()
+
+    def qsize(self):
+        return self.get_write_seq() - self.read_seq
+
+    def get(self, block=True, timeout=None):
+        """ Return a copy of the next packet.  The slot sequence
+        is read again after the copy, a packet the writer started
+        overwriting meanwhile is skipped like one it lapped.
+        If the reader fell more than a ring behind the oldest
+        packets are skipped and counted.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            self.drain_notify()
+            write_seq = self.get_write_seq()
+            if write_seq - self.read_seq > self.slots:
+                skipped = write_seq - self.slots - self.read_seq
+                self.skipped += skipped
+                self.read_seq += skipped
+            while self.read_seq < write_seq:
+                offset = self.slot_offset(self.read_seq)
+                seq, length = self.slot_header_struct.unpack_from(self.buf,
+                                                                  offset)
+                self.read_seq += 1
+                if seq == self.read_seq:
+                    data_offset = offset + self.slot_header_struct.size
+                    pkt = self.buf[data_offset:data_offset + length]
+                    # The writer zeroes the slot sequence first
+                    if self.slot_header_struct.unpack_from(
+                            self.buf, offset)[0] == seq:
+                        return pkt
+                # Overwritten while we were looking at it
+                self.skipped += 1
+            if not block:
+                raise Empty
+            self.wait_deadline(deadline)
+
+
+class StatusSlot(SharedStatusBuffer):
+    """ Latest value status transport.  Only the newest packet
+    is kept, older packets are overwritten and the reader counts
+    the ones it skipped.  The writer fills the buffer not being
+    read and publishes it with a seqlock, the sequence number is
+    odd while a write is in progress and goes up by two per packet.
+    With an even sequence number S the complete packet is in
+    buffer (S / 2) % 2.
+    """
+
+    buffer_header_struct = struct.Struct("<I")
+
+    def __init__(self, slot_size=512):
+        self.buffer_stride = self.buffer_header_struct.size + slot_size
+        super(StatusSlot, self).__init__(self.header_struct.size +
+                                         2 * self.buffer_stride, slot_size)
+        # Number of the last packet read, the first packet is 1
+        self.read_pkt = 0
+
+    def buffer_offset(self, idx):
+        return self.header_struct.size + idx * self.buffer_stride
+
+    def put(self, pkt, block=True, timeout=None):
+        """ Publish a packet, never blocks """
+        if not self.check_size(pkt):
+            return
+        seq = self.get_write_seq()
+        offset = self.buffer_offset((seq // 2 + 1) % 2)
+        data_offset = offset + self.buffer_header_struct.size
+        self.header_struct.pack_into(self.buf, 0, seq + 1)
+        self.buffer_header_struct.pack_into(self.buf, offset, len(pkt))
+        self.buf[data_offset:data_offset + len(pkt)] = pkt
+        self.header_struct.pack_into(self.buf, 0, seq + 2)
+        self.notify()
+
+    def qsize(self):
+        return 1 if self.get_write_seq() // 2 > self.read_pkt else 0
+
+    def read_latest(self):
+        """ Returns (packet number, packet) for the latest complete
+        packet, (0, None) if nothing was published yet """
+        while True:
+            seq = self.get_write_seq() & ~1
+            if seq == 0:
+                return 0, None
+            offset = self.buffer_offset((seq // 2) % 2)
+            length = self.buffer_header_struct.unpack_from(self.buf, offset)[0]
+            data_offset = offset + self.buffer_header_struct.size
+            pkt = self.buf[data_offset:data_offset + length]
+            # The writer only comes back to this buffer at seq + 3
+            if self.get_write_seq() < seq + 3:
+                return seq // 2, pkt
+
+    def get(self, block=True, timeout=None):
+        """ Return a copy of the freshest complete packet
+        newer than the last one read """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            self.drain_notify()
+            pkt_num, pkt = self.read_latest()
+            if pkt_num > self.read_pkt:
+                self.skipped += pkt_num - self.read_pkt - 1
+                self.read_pkt = pkt_num
+                return pkt
+            if not block:
+                raise Empty
+            self.wait_deadline(deadline)
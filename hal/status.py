@@ -12,14 +12,20 @@ the hwconf
 import sys
 import time
 import threading
-import copy
+import json
 import collections
-from Queue import Empty
-from pyelixys.hal.statusfmt import StatusMessageFormatFactory
+from Queue import Queue, Empty
+from pyelixys.hal.statusfmt import StatusMessageFormatFactory, \
+                                    StatusDeltaCodec
+from pyelixys.hal.linkstats import PacketStats, ConsumerLag
+from pyelixys.hal.statushistory import StatusHistory
+from pyelixys.hal.statusrecord import make_record_class, \
+                                      make_view_class, make_status_view
 from pyelixys.elixysexceptions import ElixysValueError, \
                                         ElixysCommError
 
 from pyelixys.hal.elixysobject import ElixysObject
+from pyelixys.hal.hwconf import config_cache
 from pyelixys.utils.elixysthread import ElixysStoppableThread
 from pyelixys.logs import statlog as log
 
@@ -28,44 +34,194 @@ class ElixysReadOnlyError(ElixysValueError):
     pass
 
 
-class StatusThread(ElixysStoppableThread):
+# Format characters of the fields a bit can be subscribed to
+int_fmts = "bBhHiIlLqQ"
+
+
+class StatusThread(ElixysStoppableThread, ElixysObject):
     """ The status thread is a consumer of packets from
     the websocket server.  It continuously reads from the
-    queue and properly parse the packets into the Status object"""
-    def __init__(self, status, status_queue):
+    queue (or StatusRing) and properly parse the packets
+    into the Status object.
+    In the latest consumer mode it takes every packet waiting
+    and only decodes the newest, so it catches up when the HAL
+    fell behind.  With the ArrivalTimes of the unit it keeps
+    the consumer lag, packets waiting and age of the packets """
+
+    # Longest time to block, the stop event is checked this often
+    get_timeout = 0.1
+
+    def __init__(self, status, status_queue, arrivals=None):
         super(StatusThread, self).__init__()
         self.queue = status_queue
         self.status = status
+        self.arrivals = arrivals
+        conf = self.sysconf['WSServer']
+        self.skip_to_latest = conf['status_consumer'] == 'latest'
+        self.fold_history = conf['status_fold_history']
+        # Packets taken off the queue
+        self.consumed = 0
+        self.lag = ConsumerLag()
 
     def loop(self):
-        """ Main loop, parse packet then wait some time """
+        """ Main loop, wait for a packet then parse it,
+        or the newest of the packets waiting """
         try:
-            # todo timeout from hwconf
-            statpkt = self.queue.get(block=False, timeout=0.1)
-            self.status.parse_packet(statpkt)
+            pkts = [self.queue.get(block=True, timeout=self.get_timeout)]
         except Empty:
-            # todo sleep time from hwconf
-            time.sleep(0.1)
+            return
+        if self.skip_to_latest:
+            pkts.extend(self.drain())
+        self.record_lag(len(pkts))
+        # A bad packet is logged and skipped, the thread keeps going
+        try:
+            for statpkt in pkts[:-1]:
+                self.status.fold_packet(statpkt, self.fold_history)
+            self.status.parse_packet(pkts[-1])
+        except Exception:
+            log.exception("Failed to parse a status packet")
+
+    def drain(self):
+        """ Returns the packets waiting on the queue """
+        pkts = []
+        while True:
+            try:
+                pkts.append(self.queue.get_nowait())
+            except Empty:
+                return pkts
+
+    def record_lag(self, taken):
+        """ The packets are numbered in arrival order on the
+        server, the ones a StatusSlot skipped included """
+        self.consumed += taken
+        newest = self.consumed + getattr(self.queue, 'skipped', 0) - 1
+        if self.arrivals is None:
+            self.lag.add(taken, skipped=taken - 1)
+            return
+        arrived = self.arrivals.get_time(newest)
+        age = None if arrived is None else time.time() - arrived
+        waiting = self.arrivals.count - (newest - taken + 1)
+        self.lag.add(waiting, age, taken - 1)
+
+class SubscriptionThread(ElixysStoppableThread):
+    """ Runs the status subscription callbacks, off the
+    thread parsing the packets """
+
+    # Longest time to block, the stop event is checked this often
+    get_timeout = 0.1
+
+    def __init__(self):
+        super(SubscriptionThread, self).__init__()
+        self.queue = Queue()
+
+    def put(self, callback, *args):
+        self.queue.put((callback, args))
+
+    def loop(self):
+        try:
+            callback, args = self.queue.get(block=True,
+                                            timeout=self.get_timeout)
+        except Empty:
+            return
+        try:
+            callback(*args)
+        except Exception:
+            log.exception("Status subscription callback %r failed",
+                          callback)
+
+
+class StatusSnapshot(collections.Mapping):
+    """ The status of the hardware as of one packet.  Each parsed
+    packet is published as a new snapshot, none is ever modified,
+    reading several fields of a snapshot never mixes two packets.
+    The subsystems are available as items or attributes
+    (snap['Valves'], snap.Valves), the records inside are shared
+    with the Status and must be treated as read only.
+    """
+
+    def __init__(self, store, data, received):
+        # Decoded subsystems, flat unpacked data, host receive time
+        object.__setattr__(self, 'store', store)
+        object.__setattr__(self, 'data', data)
+        object.__setattr__(self, 'received', received)
+
+    def __setattr__(self, name, value):
+        raise ElixysReadOnlyError("Status snapshots are read only")
+
+    def __getitem__(self, key):
+        return self.store[key]
+
+    def __iter__(self):
+        return iter(self.store)
+
+    def __len__(self):
+        return len(self.store)
+
+    def __getattr__(self, name):
+        try:
+            return self.store[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def get_packet_id(self):
+        return self.store['Header']['packet_id']
+
+    packet_id = property(get_packet_id)
+
+    def __repr__(self):
+        return "StatusSnapshot(packet_id=%d, received=%f)" % \
+            (self.packet_id, self.received)
+
 
 class Status(ElixysObject, collections.MutableMapping):
     """ The Status object has a dictionary interface,
     it is capable of properly parsing the binary packets from
-    the client hardware an converting them into python data types """
+    the client hardware an converting them into python data types.
+    Each packet is published as a StatusSnapshot, readers never
+    take a lock, they get the store of the last packet. """
     def __init__(self, *args, **kwargs):
         self.fmt = StatusMessageFormatFactory()
         self.struct = self.fmt.get_struct()
+        self.delta = StatusDeltaCodec(self.fmt)
+        # Where each field of the unpacked data goes, the record
+        # classes and a decode function generated for that layout
+        self.plan = config_cache.cached('status_plan', self.compile_plan)
+        self.records = self.compile_records(self.plan)
+        self.decode = self.compile_decoder(self.plan)
+        # Or a view over the raw packet, decoding on access
+        self.view = self.compile_view(self.plan)
+        self.lazy = self.sysconf['WSServer']['status_decode'] == 'lazy'
+        # Data of the last packet, delta packets apply on top of it
+        self.last_data = None
+        # The last full packet, None when it came as a delta
+        self.last_pkt = None
+        # Delta packets that could not be applied, malformed or
+        # waiting for a full packet after a lost packet
+        self.deltas_dropped = 0
+        # Lost, duplicate, late packets and jitter
+        self.packet_stats = PacketStats()
+        # The last packets, for trends
+        self.ring = StatusHistory(fmt_factory=self.fmt)
         self.store = dict()
         self.update(dict(*args, **kwargs))
         self.lock = threading.Lock()
         self.is_valid = False
+        # Snapshot of the last packet, replaced for every packet
+        self.snap = None
+        # (data index, bit, on, callback, path) of each subscription,
+        # replaced (not modified) when subscribing
+        self.subscriptions = ()
+        self.dispatcher = None
+        self.subscribe_lock = threading.Lock()
+        self.packet_callbacks = []
+        # Notified after every parsed packet
+        self.packet_cond = threading.Condition()
+        self.packet_count = 0
 
     def __getitem__(self, key):
         if self.is_valid is False:
             return None
-        self.lock.acquire()
-        val = self.store[self.__keytransform__(key)]
-        self.lock.release()
-        return val
+        return self.store[self.__keytransform__(key)]
 
     def __setitem__(self, key, value):
         #raise ElixysReadOnlyError("Status Packet only updated"
@@ -87,17 +243,135 @@ class Status(ElixysObject, collections.MutableMapping):
         return key
 
     def __getattr__(self, name):
-        if self.is_valid:
-            super(Status, self).__getattr__(self, name)
-        else:
+        """ The subsystems of the last packet, status.Valves """
+        if not self.__dict__.get('is_valid'):
             raise ElixysCommError("The status packet is invalid, is a client connected?")
+        try:
+            return self.__dict__['store'][name]
+        except KeyError:
+            raise AttributeError(name)
 
-    def parse_packet(self, pkt):
-        """ Maybe the most complicates function, read the config and
-        properly parses the binary packet from the hardware accordingly """
-        #Todo: rework this, too complicated!
+    def unpack_packet(self, pkt):
+        """ Returns the flat data of a full packet, or of the
+        previous packet updated by a delta packet.  A delta packet
+        that does not follow the last packet can not be applied,
+        None is returned until the next full packet """
+        header = self.delta.unpack_header(pkt)
+        self.packet_stats.on_packet(header[self.delta.id_idx])
+        if not self.delta.is_delta(header):
+            data = self.struct.unpack(pkt)
+            self.last_pkt = pkt
+        elif (self.last_data is None or header[self.delta.id_idx] !=
+              (self.last_data[self.delta.id_idx] + 1) & 0xFFFFFFFF):
+            self.deltas_dropped += 1
+            self.last_data = None
+            return None
+        else:
+            try:
+                data = self.delta.unpack(pkt, self.last_data)
+            except ElixysValueError as e:
+                log.warning("Dropped delta status packet %d: %s"
+                            % (header[self.delta.id_idx], e))
+                self.deltas_dropped += 1
+                self.last_data = None
+                return None
+            self.last_pkt = None
+        self.last_data = data
+        return data
+
+    def compile_plan(self):
+        """ Walk the config once, returns for each subsystem
+        (name, ((key, data index), ...), repeat keys, index of the
+        first repeated field, count) in packet order """
+        plan = []
+        data_idx = 0
+        for subsystem, count, messagefmt in self.fmt.subsystems:
+            fields = []
+            for key, value in messagefmt.items():
+                if isinstance(value, str):
+                    fields.append((key, data_idx))
+                    data_idx += 1
+            repeat_keys = ()
+            repeat_idx = data_idx
+            if "Repeat" in messagefmt:
+                repeat_keys = tuple(messagefmt['Repeat'].keys())
+                data_idx += count * len(repeat_keys)
+            plan.append((subsystem, tuple(fields), repeat_keys,
+                         repeat_idx, count))
+        return plan
+
+    def compile_records(self, plan):
+        """ Generate the StatusRecord classes of the plan, returns
+        {subsystem: (record class, unit record class or None)} """
+        records = dict()
+        for subsystem, fields, repeat_keys, repeat_idx, count in plan:
+            unit_cls = None
+            if repeat_keys:
+                unit_cls = make_record_class(subsystem + "Unit",
+                                             repeat_keys)
+            else:
+                count = None
+            cls = make_record_class(subsystem,
+                                    [key for key, idx in fields], count)
+            records[subsystem] = (cls, unit_cls)
+        return records
+
+    def compile_decoder(self, plan):
+        """ Generate decode(data), a function placing the unpacked
+        data in the subsystem records with every data index a
+        constant, e.g.
+            return {'Mixers': Mixers(data[4], (MixersUnit(data[5],
+                        data[6]), ...)), ...}
+        """
+        namespace = dict()
+        subs = []
+        for subsystem, fields, repeat_keys, repeat_idx, count in plan:
+            cls, unit_cls = self.records[subsystem]
+            # Classes under generated names, whatever the subsystems
+            # are called in the hwconf
+            name = "record%d" % len(subs)
+            namespace[name] = cls
+            args = ["data[%d]" % idx for key, idx in fields]
+            if unit_cls is not None:
+                namespace[name + "unit"] = unit_cls
+                step = len(repeat_keys)
+                units = []
+                for i in range(count):
+                    idx = repeat_idx + i * step
+                    units.append("%sunit(%s)" % (name, ", ".join(
+                        "data[%d]" % (idx + j) for j in range(step))))
+                args.append("(%s,)" % ", ".join(units))
+            subs.append("%r: %s(%s)" % (subsystem, name, ", ".join(args)))
+        self.decoder_src = "def decode(data):\n    return {%s}" % \
+            ",\n            ".join(subs)
+        exec self.decoder_src in namespace
+        return namespace['decode']
+
+    def compile_view(self, plan):
+        """ Generate the StatusView class of the plan, the
+        byte offset of every field from the struct format """
+        offsets = self.fmt.get_field_offsets()
+        views = dict()
+        for subsystem, fields, repeat_keys, repeat_idx, count in plan:
+            units = unit_cls = None
+            if repeat_keys:
+                step = len(repeat_keys)
+                units = [offsets[repeat_idx + i * step][0]
+                         for i in range(count)]
+                unit_cls = make_view_class(subsystem + "UnitView", [
+                    (key, offsets[repeat_idx + j][0] - units[0],
+                     offsets[repeat_idx + j][1])
+                    for j, key in enumerate(repeat_keys)])
+            views[subsystem] = make_view_class(
+                subsystem + "View",
+                [(key,) + offsets[idx] for key, idx in fields],
+                units, unit_cls)
+        return make_status_view(views)
+
+    def decode_walk(self, data):
+        """ Same as decode but walks the config for every packet,
+        kept as the reference for the tests and benchmark """
         subsystems = self.fmt.subsystems
-        data = self.struct.unpack(pkt)
         data_dict = dict()
         data_idx = 0
         for subsystem, count, messagefmt in subsystems:
@@ -124,30 +398,218 @@ class Status(ElixysObject, collections.MutableMapping):
                     sub_dict['Subs'] = units
                     sub_dict['count'] = count
             data_dict[subsystem] = sub_dict
-        self.lock.acquire()
+        return data_dict
+
+    def parse_packet(self, pkt):
+        """ Unpack a full or delta packet from the hardware
+        and update the status with it """
+        data = self.unpack_packet(pkt)
+        if data is None:
+            return None
+        self.ring.add(data)
+        if self.lazy:
+            # A delta packet is repacked, the view needs all fields
+            if self.last_pkt is None:
+                buf = self.struct.pack(*data)
+            else:
+                buf = str(self.last_pkt)
+            data_dict = self.view(buf)
+        else:
+            data_dict = self.decode(data)
+        # Publish, a single reference assignment each
+        prev_snap = self.snap
+        self.snap = StatusSnapshot(data_dict, data, time.time())
         self.store = data_dict
-        for key, value in data_dict.items():
-            setattr(self,key,value)
-        self.lock.release()
         self.is_valid = True
+        if self.subscriptions and prev_snap is not None:
+            self.check_subscriptions(prev_snap.data, self.snap)
+        with self.packet_cond:
+            self.packet_count += 1
+            self.packet_cond.notify_all()
+        for callback in self.packet_callbacks:
+            try:
+                callback(self)
+            except Exception:
+                log.exception("Status packet callback %r failed", callback)
         return data_dict
 
-    def update_from_queue(self, queue):
-        self.thread = StatusThread(self, queue)
+    def field_index(self, path):
+        """ Returns (data index, bit) of a field path, the bit is
+        None unless the path ends with the bit number of an integer
+        field, ('DigitalInputs', 'state', 6) or 'DigitalInputs.state.6'.
+        A field repeated per unit takes the unit number,
+        ('Thermocouples', 2, 'temperature') """
+        if isinstance(path, basestring):
+            path = tuple(int(part) if part.isdigit() else part
+                         for part in path.split('.'))
+        for subsystem, fields, repeat_keys, repeat_idx, count in self.plan:
+            if subsystem != path[0]:
+                continue
+            rest = path[1:]
+            idx = None
+            if len(rest) >= 2 and isinstance(rest[0], int):
+                unit, key = rest[0], rest[1]
+                rest = rest[2:]
+                if 0 <= unit < count and key in repeat_keys:
+                    idx = repeat_idx + unit * len(repeat_keys) + \
+                        repeat_keys.index(key)
+            elif rest:
+                idx = dict(fields).get(rest[0])
+                rest = rest[1:]
+            if idx is not None and len(rest) <= 1:
+                bit = rest[0] if rest else None
+                if bit is not None and not (
+                        isinstance(bit, int) and bit >= 0 and
+                        self.fmt.get_field_fmts()[idx] in int_fmts):
+                    raise ElixysValueError("No bit %s in status field %s"
+                                           % (bit, str(path)))
+                return idx, bit
+        raise ElixysValueError("No status field %s" % str(path))
+
+    def subscribe(self, path, callback, on='change'):
+        """ Call callback(path, value, snapshot) when the field
+        changes between two packets ('change'), goes from false to
+        true ('rising'), from true to false ('falling'), or when
+        on(value) becomes true for a predicate on.
+        The callbacks run on a dispatcher thread.
+        Returns the subscription for unsubscribe """
+        if not (callable(on) or on in ('change', 'rising', 'falling')):
+            raise ElixysValueError("Unknown subscription trigger %s" % on)
+        idx, bit = self.field_index(path)
+        subscription = (idx, bit, on, callback, path)
+        with self.subscribe_lock:
+            if self.dispatcher is None:
+                self.dispatcher = SubscriptionThread()
+                self.dispatcher.start()
+            self.subscriptions = self.subscriptions + (subscription,)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.subscribe_lock:
+            self.subscriptions = tuple(sub for sub in self.subscriptions
+                                       if sub is not subscription)
+
+    def check_subscriptions(self, prev, snap):
+        """ Compare the subscribed fields of the last two packets,
+        only their flat data is looked at.  A subscription failing
+        (a predicate raising) is logged, the others still run """
+        for subscription in self.subscriptions:
+            try:
+                self.check_subscription(subscription, prev, snap)
+            except Exception:
+                log.exception("Status subscription %r failed",
+                              subscription[-1])
+
+    def check_subscription(self, subscription, prev, snap):
+        """ Queue the callback of a subscription if it triggers """
+        idx, bit, on, callback, path = subscription
+        value, old = snap.data[idx], prev[idx]
+        if value == old:
+            return
+        if bit is not None:
+            value, old = value >> bit & 1, old >> bit & 1
+            if value == old:
+                return
+        if on == 'change':
+            fire = True
+        elif on == 'rising':
+            fire = not old and value
+        elif on == 'falling':
+            fire = old and not value
+        else:
+            fire = on(value) and not on(old)
+        if fire:
+            self.dispatcher.put(callback, path, value, snap)
+
+    def wait_for(self, predicate, timeout=None):
+        """ Block until predicate() is true, it is checked again
+        on every new packet.  Returns False if the timeout expired
+        first.  A predicate reading the status before the first
+        packet (ElixysCommError) is taken as false """
+        deadline = None if timeout is None else time.time() + timeout
+        with self.packet_cond:
+            while True:
+                try:
+                    if predicate():
+                        return True
+                except ElixysCommError:
+                    pass
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                self.packet_cond.wait(remaining)
+
+    def wait_for_packet(self, after_id=None, timeout=None):
+        """ Block until a packet other than after_id was parsed,
+        by default until the next packet.  Returns the new
+        packet_id, None if the timeout expired first """
+        if after_id is None:
+            count = self.packet_count
+            applied = lambda: self.packet_count != count
+        else:
+            applied = lambda: (self.packet_count and
+                               self.store['Header']['packet_id'] != after_id)
+        if not self.wait_for(applied, timeout):
+            return None
+        return self.store['Header']['packet_id']
+
+    def fold_packet(self, pkt, history=True):
+        """ A packet skipped for a newer one, it is unpacked
+        for the delta chain and the packet stats (and history)
+        but not decoded, nor is anyone notified """
+        data = self.unpack_packet(pkt)
+        if history and data is not None:
+            self.ring.add(data)
+
+    def history(self, subsystem, unit, field, n=None, seconds=None,
+                copy=False):
+        """ Values of a field of one unit over the last n packets
+        or seconds, e.g. history('Thermocouples', 3, 'temperature',
+        seconds=60), a numpy view into the history ring the status
+        thread keeps overwriting, copy=True for a stable copy """
+        return self.ring.history(subsystem, unit, field, n, seconds, copy)
+
+    def window(self, subsystem, field, n=None, seconds=None, copy=False):
+        """ Values of a subsystem field over the last n packets
+        or seconds, e.g. window('DigitalInputs', 'state', n=50) """
+        return self.ring.window(subsystem, field, n, seconds, copy)
+
+    def history_times(self, n=None, seconds=None, copy=False):
+        """ Receive times of the packets of the same query """
+        return self.ring.get_times(n, seconds, copy)
+
+    def add_packet_callback(self, callback):
+        """ Call callback(status) after every parsed packet """
+        self.packet_callbacks.append(callback)
+
+    def update_from_queue(self, queue, arrivals=None):
+        self.thread = StatusThread(self, queue, arrivals)
         self.thread.start()
 
     def stop_update(self):
-        log.debug("Starting update thread")
+        log.debug("Stopping update thread")
         self.thread.stop()
+        if self.dispatcher is not None:
+            self.dispatcher.stop()
+
+    def snapshot(self):
+        """ The StatusSnapshot of the last packet, None before
+        the first one """
+        return self.snap
 
     def as_json(self):
-        return json.dumps(self.store, indent=2)
+        return json.dumps(self.as_dict(), indent=2)
 
     def as_dict(self):
-        return copy.deepcopy(self.store)
+        """ A copy of the last packet's status as nested dicts that
+        can be modified, snapshot() gives a read only one without
+        copying """
+        return dict((subsystem, record.as_dict())
+                    for subsystem, record in self.store.items())
 
-status = Status()
 
 if __name__ == '__main__':
     from IPython import embed
-    import json
+    status = Status()
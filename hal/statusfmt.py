@@ -136,9 +136,10 @@ Additional information can be found in the comments below.
 
 
 import struct
-import jinja2
-from pyelixys.hal.fmt_lookup import fmt_chr
-from pyelixys.hal.hwconf import config
+import numpy
+from pyelixys.hal.fmt_lookup import fmt_chr, fmt_dtype
+from pyelixys.hal.hwconf import config, config_cache
+from pyelixys.elixysexceptions import ElixysValueError
 
 class StatusMessageFormatFactory(object):
     """ Returns an object capable of generating struct
@@ -165,8 +166,14 @@ class StatusMessageFormatFactory(object):
 
     def parse_config_fmt_str(self):
         """ Reads the configuration dictionary and constructs the format string
-        for converting binary packet data to python types
+        for converting binary packet data to python types,
+        from the config cache for the hwconf
         """
+        if self.conf is config:
+            return config_cache.cached('status_fmt', self.build_fmt_str)
+        return self.build_fmt_str()
+
+    def build_fmt_str(self):
         msg = [self.parse_subsystem(name, sub) for name,
                sub in self.conf.items() if(self.messagefmtsection in sub)]
         return "<"+"".join(msg) # Little endian!
@@ -190,15 +197,78 @@ class StatusMessageFormatFactory(object):
                 msg.append("".join(vals))
         return "".join(msg)
 
+    def get_dtype(self):
+        """ Returns a numpy dtype with the layout of a full status
+        packet, a record per subsystem holding its fields and, for
+        the subsystems with a Repeat section, a 'Subs' array of
+        count records """
+        subs = []
+        for name, count, msgsec in self.subsystems:
+            fields = [(str(key), fmt_dtype[value])
+                      for key, value in msgsec.items()
+                      if not isinstance(value, dict)]
+            if self.repeatfmtsection in msgsec:
+                rpsec = msgsec[self.repeatfmtsection]
+                fields.append(('Subs', [(str(key), fmt_dtype[value])
+                                        for key, value in rpsec.items()],
+                               (count,)))
+            subs.append((str(name), fields))
+        return numpy.dtype(subs)
+
+    def unpack_array(self, buf, count=-1):
+        """ Decode full status packets recorded back to back
+        in buf with a single numpy.frombuffer call, returns a
+        structured array, e.g. arr['Mixers']['Subs']['duty_cycle'].
+        numpy strips trailing NULs, a '\\x00' char field reads '' """
+        return numpy.frombuffer(buf, dtype=self.get_dtype(), count=count)
+
+    def get_field_fmts(self):
+        """ The format character of each field of a
+        full status packet, in packet order """
+        return list(self.parse_config_fmt_str()[1:])
+
+    def get_header_fmts(self):
+        """ The format characters of the Header fields """
+        return self.parse_subsystem('Header', self.conf['Header'])
+
+    def get_field_offsets(self):
+        """ (offset, format character) of each field of a
+        full status packet, in packet order """
+        offsets = []
+        offset = 0
+        for fmt in self.get_field_fmts():
+            offsets.append((offset, fmt))
+            offset += struct.calcsize("<" + fmt)
+        return offsets
+
+    def get_delta_fields(self):
+        """ (offset, size) in the status struct of every field
+        after the Header, the fields a delta packet bitmap covers """
+        offsets = self.get_field_offsets()[len(self.get_header_fmts()):]
+        return [(offset, struct.calcsize("<" + fmt))
+                for offset, fmt in offsets]
+
+    def get_template_vars(self):
+        """ Variables used to render both the header
+        and the source templates """
+        header = self.conf['Header']
+        return {"systems": self.subsystems,
+                "fmt_chr": fmt_chr,
+                "delta_fields": self.get_delta_fields(),
+                "full_packet_type": header['full_packet_type'],
+                "delta_packet_type": header['delta_packet_type'],
+                "keyframe_interval": header['keyframe_interval']}
+
     def generate_c_header(self, filename=None):
+        # Only the code generators need jinja2
+        import jinja2
         template_loader = jinja2.FileSystemLoader(searchpath=".")
         template_env = jinja2.Environment(loader=template_loader,
                                           trim_blocks=True,
                                           lstrip_blocks=True)
         TEMPLATE_FILE = self.conf['c_status_header_template']
         template = template_env.get_template(TEMPLATE_FILE)
-        template_vars = {"systems": self.subsystems,
-                         "fmt_chr": fmt_chr}
+        template_vars = self.get_template_vars()
         output_text = template.render(template_vars)
 
         if filename:
@@ -209,14 +279,15 @@ class StatusMessageFormatFactory(object):
     
     
     def generate_c_src(self, filename=None):
+        # Only the code generators need jinja2
+        import jinja2
         template_loader = jinja2.FileSystemLoader(searchpath=".")
         template_env = jinja2.Environment(loader=template_loader,
                                           trim_blocks=True,
                                           lstrip_blocks=True)
         TEMPLATE_FILE = self.conf['c_status_source_template']
         template = template_env.get_template(TEMPLATE_FILE)
-        template_vars = {"systems": self.subsystems,
-                         "fmt_chr": fmt_chr}
+        template_vars = self.get_template_vars()
         output_text = template.render(template_vars)
 
         if filename:
@@ -225,6 +296,95 @@ class StatusMessageFormatFactory(object):
             f.close()
         return output_text
 
+
+class StatusDeltaCodec(object):
+    """ Packs and unpacks the delta status packets.
+    A delta packet holds the whole Header, a bitmap with
+    a bit per field after the Header (lsb first) and the values
+    of the fields whose bit is set, packed back to back.
+    Packets are handled as flat tuples of field values,
+    in the order of the full status struct.
+    """
+
+    def __init__(self, fmt_factory=None):
+        self.fmt = fmt_factory or StatusMessageFormatFactory()
+        conf = self.fmt.conf['Header']
+        self.full_packet_type = conf['full_packet_type']
+        self.delta_packet_type = conf['delta_packet_type']
+        header_keys = [key for key, value in
+                       conf[self.fmt.messagefmtsection].items()
+                       if not isinstance(value, dict)]
+        self.type_idx = header_keys.index('packet_type')
+        self.id_idx = header_keys.index('packet_id')
+        header_fmts = self.fmt.get_header_fmts()
+        self.header_count = len(header_fmts)
+        self.header_struct = struct.Struct("<" + header_fmts)
+        self.field_structs = [struct.Struct("<" + fmt) for fmt in
+                              self.fmt.get_field_fmts()[self.header_count:]]
+        self.bitmap_len = (len(self.field_structs) + 7) // 8
+        # Bits of the last bitmap byte past the last field
+        spare_bits = self.bitmap_len * 8 - len(self.field_structs)
+        self.spare_mask = (0xFF << (8 - spare_bits)) & 0xFF
+
+    def unpack_header(self, pkt):
+        return self.header_struct.unpack_from(pkt)
+
+    def is_delta(self, header):
+        return header[self.type_idx] == self.delta_packet_type
+
+    def pack(self, prev, data):
+        """ Delta packet taking prev to data """
+        header = list(data[:self.header_count])
+        header[self.type_idx] = self.delta_packet_type
+        bitmap = bytearray(self.bitmap_len)
+        values = []
+        changed = zip(self.field_structs, prev[self.header_count:],
+                      data[self.header_count:])
+        for idx, (field_struct, old, new) in enumerate(changed):
+            if old != new:
+                bitmap[idx >> 3] |= 1 << (idx & 7)
+                values.append(field_struct.pack(new))
+        return (self.header_struct.pack(*header) + str(bitmap) +
+                "".join(values))
+
+    def unpack(self, pkt, prev):
+        """ Apply the delta packet to prev, the data of the
+        previous packet, and return the new data.  Raises
+        ElixysValueError for a malformed or truncated packet """
+        if len(pkt) < self.header_struct.size + self.bitmap_len:
+            raise ElixysValueError("Delta status packet of %d bytes is "
+                                   "truncated" % len(pkt))
+        data = list(prev)
+        data[:self.header_count] = self.header_struct.unpack_from(pkt)
+        offset = self.header_struct.size
+        bitmap = bytearray(pkt[offset:offset + self.bitmap_len])
+        offset += self.bitmap_len
+        if bitmap and bitmap[-1] & self.spare_mask:
+            raise ElixysValueError("Delta status packet bitmap has bits "
+                                   "past the %d fields"
+                                   % len(self.field_structs))
+        field_idx = self.header_count
+        for byte in bitmap:
+            bit = 0
+            while byte:
+                if byte & 1:
+                    field_struct = self.field_structs[field_idx + bit -
+                                                      self.header_count]
+                    if offset + field_struct.size > len(pkt):
+                        raise ElixysValueError("Delta status packet of %d "
+                                               "bytes is truncated"
+                                               % len(pkt))
+                    data[field_idx + bit] = field_struct.unpack_from(
+                        pkt, offset)[0]
+                    offset += field_struct.size
+                byte >>= 1
+                bit += 1
+            field_idx += 8
+        if offset != len(pkt):
+            raise ElixysValueError("Delta status packet is %d bytes, "
+                                   "its bitmap says %d" % (len(pkt), offset))
+        return tuple(data)
+
 if __name__ == '__main__':
     fmt_factory = StatusMessageFormatFactory()
     stat_struct = fmt_factory.get_struct()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+""" The StatusHistory object keeps the last history_length status
+packets of a unit in a numpy structured array (the dtype from
+StatusMessageFormatFactory.get_dtype) along with the host time each
+one was received.  The memory is allocated once, the oldest packet
+is overwritten by the newest.
+Every packet is written twice, at its slot and capacity slots
+further, so the last n packets are always contiguous in the
+array and the queries return views without copying.
+The views share the memory of the ring and are not stable, the
+parse thread keeps overwriting it: a view of the last n packets
+only holds them until capacity - n more packets came in (a view
+of the whole history until the next one).  Pass copy=True for
+values copied while the ring is locked, to keep them or to read
+them alongside the parse thread.
+"""
+import time
+import threading
+import numpy
+from pyelixys.hal.elixysobject import ElixysObject
+from pyelixys.hal.statusfmt import StatusMessageFormatFactory
+
+
+class StatusHistory(ElixysObject):
+    """ Ring of the last decoded status packets,
+    add is called with the flat data of every packet """
+
+    def __init__(self, capacity=None, fmt_factory=None):
+        if capacity is None:
+            capacity = self.sysconf['Header']['history_length']
+        if fmt_factory is None:
+            fmt_factory = StatusMessageFormatFactory()
+        self.capacity = capacity
+        self.struct = fmt_factory.get_struct()
+        self.dtype = fmt_factory.get_dtype()
+        self.buf = bytearray(2 * capacity * self.dtype.itemsize)
+        self.records = numpy.frombuffer(self.buf, dtype=self.dtype)
+        self.times = numpy.zeros(2 * capacity)
+        # Packets added since the start
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def add(self, data, now=None):
+        """ Record the data of a packet """
+        if now is None:
+            now = time.time()
+        slot = self.count % self.capacity
+        size = self.dtype.itemsize
+        with self.lock:
+            self.struct.pack_into(self.buf, slot * size, *data)
+            self.struct.pack_into(self.buf, (slot + self.capacity) * size,
+                                  *data)
+            self.times[slot] = now
+            self.times[slot + self.capacity] = now
+            self.count += 1
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def get_span(self, n=None, seconds=None):
+        """ Returns (start, stop) in the records of the last n
+        packets, or of the packets received in the last seconds """
+        with self.lock:
+            return self.find_span(n, seconds)
+
+    def find_span(self, n, seconds):
+        """ get_span, with the lock held """
+        length = len(self)
+        if n is not None:
+            length = min(n, length)
+        stop = (self.count - 1) % self.capacity + 1 + self.capacity
+        start = stop - length
+        if seconds is not None:
+            start += numpy.searchsorted(self.times[start:stop],
+                                        time.time() - seconds)
+        return start, stop
+
+    def query(self, array, n, seconds, copy):
+        """ The rows of the times or records a query selects """
+        with self.lock:
+            start, stop = self.find_span(n, seconds)
+            if copy:
+                return array[start:stop].copy()
+        return array[start:stop]
+
+    def get_times(self, n=None, seconds=None, copy=False):
+        """ Receive times matching the values of the same query """
+        return self.query(self.times, n, seconds, copy)
+
+    def get_records(self, n=None, seconds=None, copy=False):
+        """ Whole packets, e.g. records['Header']['packet_id'] """
+        return self.query(self.records, n, seconds, copy)
+
+    def window(self, subsystem, field, n=None, seconds=None, copy=False):
+        """ Values of a subsystem field, i.e. not repeated per unit """
+        return self.get_records(n, seconds, copy)[subsystem][field]
+
+    def history(self, subsystem, unit, field, n=None, seconds=None,
+                copy=False):
+        """ Values of a field of one unit of a subsystem """
+        return self.get_records(n, seconds, copy)[subsystem]['Subs'][
+            :, unit][field]
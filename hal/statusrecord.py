@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+""" Compact records for the decoded status packets.  A class
+with __slots__ is generated for every subsystem of the
+[[Message Format]] in the hwconf, and one for the units of the
+subsystems with a Repeat section.  The fields of a record are
+attributes stored without an instance dict,
+status.Thermocouples[3].temperature, and the records keep the
+item interface of the dicts used before them,
+status['Thermocouples'][3]['temperature'],
+status.Mixers['Subs'] and status.Mixers['count'].
+The records of a packet are shared by the Status and its
+snapshot, treat them as read only, as_dict gives a copy.
+The views have the same interface over the raw packet, they
+hold the buffer and a field is only unpacked (struct.unpack_from
+at its offset) when it is read, for consumers reading a few
+fields of every packet.
+"""
+import struct
+
+
+class StatusRecord(object):
+    """ Base of the generated record classes,
+    the dict like interface over the slots """
+    __slots__ = ()
+    # Fields, and keys of the dict interface,
+    # set on the generated classes
+    _fields = ()
+    _keys = ()
+    _keyset = frozenset()
+
+    def __getitem__(self, key):
+        if key.__class__ is int:
+            # A unit of a subsystem, sub[3]
+            if key in self._keyset:
+                return self.Subs[key]
+            raise KeyError(key)
+        if key in self._keyset:
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return key in self._keyset
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def keys(self):
+        return list(self._keys)
+
+    def values(self):
+        return [self[key] for key in self._keys]
+
+    def items(self):
+        return [(key, self[key]) for key in self._keys]
+
+    def as_dict(self):
+        """ The record as the nested dicts of the previous decoder,
+        the units are the same dicts under their index and in Subs """
+        data = dict((key, getattr(self, key)) for key in self._fields)
+        if 'Subs' in data:
+            units = [unit.as_dict() for unit in self.Subs]
+            data['Subs'] = units
+            data['count'] = len(units)
+            data.update(enumerate(units))
+        return data
+
+    def __eq__(self, other):
+        if isinstance(other, StatusRecord):
+            other = other.as_dict()
+        return self.as_dict() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__.__name__, ", ".join(
+            "%s=%r" % (key, getattr(self, key)) for key in self._fields))
+
+
+def make_record_class(name, fields, count=None):
+    """ A StatusRecord subclass with a slot per field and an
+    __init__ taking the fields in order.  Subsystems with a Repeat
+    section pass their count, their units go in the Subs slot """
+    fields, keys = record_keys(fields, count)
+    # A generated __init__ assigns every slot without a loop
+    lines = ["def __init__(%s):" % ", ".join(('self',) + fields)]
+    lines.extend("    self.%s = %s" % (field, field) for field in fields)
+    if not fields:
+        lines.append("    pass")
+    namespace = dict()
+    exec "\n".join(lines) in namespace
+    attrs = dict(__slots__=fields, __init__=namespace['__init__'],
+                 _fields=fields, _keys=keys, _keyset=frozenset(keys))
+    if count is not None:
+        attrs['count'] = count
+    return type(name, (StatusRecord,), attrs)
+
+
+def record_keys(fields, count=None):
+    """ The fields and the dict keys of a record """
+    fields = tuple(fields)
+    keys = fields
+    if count is not None:
+        fields += ('Subs',)
+        keys = fields + ('count',) + tuple(range(count))
+    return fields, keys
+
+
+class StatusRecordView(StatusRecord):
+    """ Base of the generated views, a record whose fields
+    are unpacked from the raw packet when they are read """
+    __slots__ = ('_buf', '_base')
+    # Offset in the packet of each unit, and their view class
+    _units = ()
+    _unit_cls = None
+
+    def __init__(self, buf, base=0):
+        self._buf = buf
+        self._base = base
+
+    def __getitem__(self, key):
+        if key.__class__ is int:
+            # Only the unit asked for
+            if key in self._keyset:
+                return self._unit_cls(self._buf, self._units[key])
+            raise KeyError(key)
+        return StatusRecord.__getitem__(self, key)
+
+    def get_subs(self):
+        return tuple(self._unit_cls(self._buf, base) for base in self._units)
+
+
+def field_property(unpack_from, offset):
+    """ A property unpacking the field at offset from the base """
+    return property(
+        lambda self: unpack_from(self._buf, self._base + offset)[0])
+
+
+def make_view_class(name, fields, units=None, unit_cls=None):
+    """ A StatusRecordView subclass for ((key, offset, format
+    character), ...), the offsets from the start of the record.
+    Subsystems with a Repeat section pass the offset in the
+    packet of each unit and the view class of the units """
+    count = None if units is None else len(units)
+    keys = record_keys([field[0] for field in fields], count)
+    attrs = dict(__slots__=(), _fields=keys[0], _keys=keys[1],
+                 _keyset=frozenset(keys[1]))
+    for key, offset, fmt in fields:
+        attrs[key] = field_property(struct.Struct("<" + fmt).unpack_from,
+                                    offset)
+    if units is not None:
+        attrs.update(_units=tuple(units), _unit_cls=unit_cls, count=count,
+                     Subs=property(StatusRecordView.get_subs))
+    return type(name, (StatusRecordView,), attrs)
+
+
+class StatusView(object):
+    """ Base of the generated packet views, the subsystem
+    views of a raw status packet by name """
+    __slots__ = ('buf',)
+    # {subsystem: view class}, set on the generated class
+    _subsystems = {}
+
+    def __init__(self, buf):
+        self.buf = buf
+
+    def __getitem__(self, key):
+        return self._subsystems[key](self.buf)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return key in self._subsystems
+
+    def __iter__(self):
+        return iter(self._subsystems)
+
+    def __len__(self):
+        return len(self._subsystems)
+
+    def keys(self):
+        return self._subsystems.keys()
+
+    def values(self):
+        return [self[key] for key in self._subsystems]
+
+    def items(self):
+        return [(key, self[key]) for key in self._subsystems]
+
+    def as_dict(self):
+        """ Every field decoded in the nested dicts """
+        return dict((key, self[key].as_dict()) for key in self._subsystems)
+
+    def __eq__(self, other):
+        if isinstance(other, StatusView):
+            other = other.as_dict()
+        return self.as_dict() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+
+def make_status_view(subsystems):
+    """ A StatusView subclass for {subsystem: view class} """
+    return type('StatusView', (StatusView,),
+                dict(__slots__=(), _subsystems=subsystems))
@@ -7,7 +7,6 @@ reactor objects.
 The sub system allows you to rotate the
 stopcocks either clockwise or counter clockwise.
 """
-import time
 from pyelixys.logs import hallog as log
 from pyelixys.hal.systemobject import SystemObject
 
@@ -25,18 +24,18 @@ class Stopcock(SystemObject):
     def turn_clockwise(self):
         """ Turn the stopcock clockwise """
         log.debug("Turn stopcock %d clockwise", self.id_)
-        self.synth.valves[self._ccw_valve_id].on = False
-        time.sleep(0.2)
-        self.synth.valves[self._cw_valve_id].on = True
-        time.sleep(0.2)
+        with self.synth.valves.transaction():
+            self.synth.valves[self._ccw_valve_id].on = False
+            self.synth.valves[self._cw_valve_id].on = True
+        self.synth.valves.wait_applied()
 
     def turn_counter_clockwise(self):
         """ Turn the stopcock counter clockwise """
         log.debug("Turn stopcock %d counter-clockwise", self.id_)
-        self.synth.valves[self._cw_valve_id].on = False
-        time.sleep(0.2)
-        self.synth.valves[self._ccw_valve_id].on = True
-        time.sleep(0.2)
+        with self.synth.valves.transaction():
+            self.synth.valves[self._cw_valve_id].on = False
+            self.synth.valves[self._ccw_valve_id].on = True
+        self.synth.valves.wait_applied()
 
     def _is_counter_clockwise(self):
         """ Check if the stopcock is clockwise """
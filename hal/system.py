@@ -23,11 +23,13 @@ class System(SystemObject):
     access the hardware according to the physical
     mechanisms on the synthesize, i.e. Reactors,
     Gas Transfer, Gripper, Reagent Delivery, and etc.
+    The unit selects which synthesizer connected to the
+    websocket server this system drives.
     """
-    def __init__(self):
+    def __init__(self, unit=None):
 
         # Initialize the hw api
-        synthesizer = SynthesizerHAL()
+        synthesizer = SynthesizerHAL(unit)
 
         # Call the constructor
         super(System, self).__init__(synthesizer)
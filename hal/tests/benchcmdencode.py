@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+""" Microbenchmark of the command encoding, a tight loop
+toggling a valve bank the way the HAL does it, the command
+is looked up, given its parameter and packed for the wire.
+Reported in commands per second for single commands, for a
+command bound to a device, and for commands packed 16 to a
+CommandBatch frame.
+
+Run from the directory containing the pyelixys package:
+    python pyelixys/hal/tests/benchcmdencode.py [commands]
+"""
+import sys
+import timeit
+
+from pyelixys.hal.cmds import cmd_lookup, CommandBatch
+
+
+def toggle_valves(commands):
+    for i in xrange(commands):
+        str(cmd_lookup['Valves']['set_state0'](0xFFFF if i & 1 else 0))
+
+
+def set_mixers(commands):
+    for i in xrange(commands):
+        str(cmd_lookup['Mixers']['set_duty_cycle'][i & 3](50.0))
+
+
+def toggle_batches(commands):
+    for i in xrange(commands / 16):
+        str(CommandBatch(cmd_lookup['Valves']['set_state0'](1 << j)
+                         for j in range(16)))
+
+
+def per_second(fxn, commands):
+    """ Best of 3 runs """
+    return commands / min(timeit.repeat(lambda: fxn(commands),
+                                        number=1, repeat=3))
+
+
+if __name__ == "__main__":
+    commands = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    print "valve toggle    %10.0f cmds/s" % per_second(toggle_valves,
+                                                       commands)
+    print "mixer [device]  %10.0f cmds/s" % per_second(set_mixers, commands)
+    print "batches of 16   %10.0f cmds/s" % per_second(toggle_batches,
+                                                       commands)
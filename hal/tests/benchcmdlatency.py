@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+""" Loopback benchmark of the command latency through the
+websocket hardware server.  A WSServerProcess is started on
+a spare port, this script connects to it as the hardware client,
+and measures the time between run_cmd and the command arriving
+on the websocket.  The old timer driven dispatch (commands picked
+up every 100 ms) is reproduced by PollingWSServerProcess
+so the two distributions can be compared.
+
+Run from the directory containing the pyelixys package:
+    python pyelixys/hal/tests/benchcmdlatency.py [samples]
+"""
+import sys
+import time
+import random
+import datetime
+from multiprocessing import Queue
+
+import tornado.ioloop
+from websocket import create_connection
+
+from pyelixys.hal.wsserver import WSServerProcess
+from pyelixys.hal.cmds import cmd_lookup
+
+
+class PollingWSServerProcess(WSServerProcess):
+    """ Reproduces the previous behaviour, the command
+    queue is only checked when a 100 ms timeout fires """
+
+    poll_period = 0.1
+
+    def setup_cmd_dispatch(self):
+        self.poll_cmds()
+
+    def poll_cmds(self):
+        self.on_cmd_ready(None, None)
+        tornado.ioloop.IOLoop.instance().add_timeout(
+            datetime.timedelta(seconds=self.poll_period), self.poll_cmds)
+
+
+def connect(port, retries=50):
+    """ Connect to the server as the hardware client """
+    for i in range(retries):
+        try:
+            return create_connection("ws://localhost:%d/ws" % port)
+        except Exception:
+            time.sleep(0.1)
+    raise RuntimeError("Could not connect to server on port %d" % port)
+
+
+def measure(server_cls, port, samples):
+    """ Return the list of command latencies in milliseconds """
+    proc = server_cls(Queue(), port=port)
+    proc.start()
+    ws = connect(port)
+    cmd = cmd_lookup['Valves']['set_state0'](0xAA)
+    latencies = []
+    try:
+        for i in range(samples):
+            # Space commands out past any pacing delay after a send,
+            # and do not stay in phase with any server side timer
+            time.sleep(random.uniform(0.1, 0.2))
+            begin = time.time()
+            proc.run_cmd(cmd)
+            ws.recv()
+            latencies.append((time.time() - begin) * 1000.0)
+    finally:
+        ws.close()
+        proc.terminate()
+        proc.join()
+    return latencies
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    idx = int(round(pct / 100.0 * (len(values) - 1)))
+    return values[idx]
+
+
+def report(name, latencies):
+    print "%-8s n=%d min=%.3f p50=%.3f p90=%.3f p99=%.3f max=%.3f (ms)" % (
+        name, len(latencies), min(latencies),
+        percentile(latencies, 50), percentile(latencies, 90),
+        percentile(latencies, 99), max(latencies))
+    buckets = [0.5, 1.0, 5.0, 10.0, 25.0, 50.0, 75.0, 100.0, 1e9]
+    lower = 0.0
+    for upper in buckets:
+        count = len([l for l in latencies if lower <= l < upper])
+        label = "%6.1f-%-6.1f" % (lower, upper) if upper < 1e9 \
+            else "%6.1f+      " % lower
+        print "    %s %s" % (label, "#" * count)
+        lower = upper
+
+
+if __name__ == "__main__":
+    samples = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    report("poll", measure(PollingWSServerProcess, 8890, samples))
+    report("push", measure(WSServerProcess, 8891, samples))
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+""" Loopback benchmark of the two websocket server modes,
+the server in its own process (WSServerProcess) and on a thread
+of the HAL process (WSServerThread).  This script connects to
+the server as the hardware client and for each sample measures
+the command latency, from run_cmd to the command arriving on the
+websocket, and the status latency, from the client sending a
+packet to the HAL getting it off the status queue.
+The CPU time used by the whole run, server process included,
+is reported per sample.
+
+Run from the directory containing the pyelixys package:
+    python pyelixys/hal/tests/benchcommode.py [samples]
+"""
+import sys
+import time
+import random
+import resource
+import Queue
+import multiprocessing
+
+from pyelixys.hal.wsserver import WSServerProcess, WSServerThread
+from pyelixys.hal.cmds import cmd_lookup
+from pyelixys.hal.tests.benchcmdlatency import connect, report
+
+# About the size of a status packet, the server does not parse it
+test_packet = "\x00" * 300
+
+
+def cpu_time():
+    """ CPU seconds used by this process and its reaped children """
+    usage = [resource.getrusage(who) for who in
+             (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    return sum(u.ru_utime + u.ru_stime for u in usage)
+
+
+def measure(server_cls, status_queue, port, samples):
+    """ Return the command and status latencies in milliseconds
+    and the CPU milliseconds used per sample """
+    cpu_begin = cpu_time()
+    proc = server_cls(status_queue, port=port)
+    proc.start()
+    ws = connect(port)
+    cmd = cmd_lookup['Valves']['set_state0'](0xAA)
+    cmd_latencies = []
+    status_latencies = []
+    try:
+        for i in range(samples):
+            # Stay clear of the pacing delay after a send
+            time.sleep(random.uniform(0.07, 0.1))
+            begin = time.time()
+            proc.run_cmd(cmd)
+            ws.recv()
+            cmd_latencies.append((time.time() - begin) * 1000.0)
+
+            begin = time.time()
+            ws.send_binary(test_packet)
+            status_queue.get(timeout=1.0)
+            status_latencies.append((time.time() - begin) * 1000.0)
+    finally:
+        ws.close()
+        proc.terminate()
+        proc.join()
+    cpu = (cpu_time() - cpu_begin) * 1000.0 / samples
+    return cmd_latencies, status_latencies, cpu
+
+
+if __name__ == "__main__":
+    samples = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    for name, server_cls, status_queue, port in (
+            ("process", WSServerProcess, multiprocessing.Queue(), 8895),
+            ("thread", WSServerThread, Queue.Queue(), 8896)):
+        cmd_latencies, status_latencies, cpu = measure(
+            server_cls, status_queue, port, samples)
+        print "== %s mode, %.3f ms of CPU per sample" % (name, cpu)
+        report("cmd", cmd_latencies)
+        report("status", status_latencies)
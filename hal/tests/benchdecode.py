@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+""" Microbenchmark of the status packet decode.  The packet from
+pktdata is unpacked and placed in subsystem dicts by walking
+the config for every packet (Status.decode_walk, the previous
+parse_packet) and in the subsystem records by the function
+generated when the Status is created (Status.decode).  The time
+of a whole parse_packet is reported as well, with the records and
+with the lazy view (status_decode = lazy) reading three fields,
+and for recorded packets decoded in one go
+the per packet time of StatusMessageFormatFactory.unpack_array
+against struct.unpack in a loop.
+
+Run from the directory containing the pyelixys package:
+    python pyelixys/hal/tests/benchdecode.py [packets]
+"""
+import sys
+import timeit
+sys.path.append("pyelixys/hal")
+
+from pyelixys.hal.status import Status
+from pyelixys.hal.tests import pktdata
+
+
+def per_packet(fxn, packets):
+    """ Best of 3 runs, in microseconds per packet """
+    return min(timeit.repeat(fxn, number=packets, repeat=3)) \
+        * 1e6 / packets
+
+
+if __name__ == "__main__":
+    packets = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    status = Status()
+    data = status.struct.unpack(pktdata.test_packet)
+    assert status.decode(data) == status.decode_walk(data)
+
+    unpack = per_packet(lambda: status.struct.unpack(pktdata.test_packet),
+                        packets)
+    walk = per_packet(lambda: status.decode_walk(data), packets)
+    gen = per_packet(lambda: status.decode(data), packets)
+    parse = per_packet(lambda: status.parse_packet(pktdata.test_packet),
+                       packets)
+
+    def parse_read():
+        store = status.parse_packet(pktdata.test_packet)
+        thermocouples = store['Thermocouples']
+        return (store['DigitalInputs'].state, thermocouples[0].temperature,
+                thermocouples[1].temperature)
+
+    records_read = per_packet(parse_read, packets)
+    status.lazy = True
+    lazy_read = per_packet(parse_read, packets)
+    print "%d byte packet, %d fields" % (len(pktdata.test_packet), len(data))
+    print "unpack        %8.2f us" % unpack
+    print "decode walk   %8.2f us" % walk
+    print "decode gen    %8.2f us  (%.1fx)" % (gen, walk / gen)
+    print "parse_packet  %8.2f us" % parse
+    print "parse, read 3 fields"
+    print "records       %8.2f us" % records_read
+    print "lazy view     %8.2f us" % lazy_read
+
+    recording = pktdata.test_packet * 1000
+    size = len(pktdata.test_packet)
+    fmt = status.fmt
+    loop = per_packet(lambda: [status.struct.unpack_from(recording, i)
+                               for i in xrange(0, len(recording), size)],
+                      packets / 1000 or 1) / 1000
+    batch = per_packet(lambda: fmt.unpack_array(recording),
+                       packets / 1000 or 1) / 1000
+    print "1000 recorded packets"
+    print "unpack loop   %8.3f us" % loop
+    print "unpack_array  %8.3f us  (%.1fx)" % (batch, loop / batch)
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+""" Startup benchmark, the time to import the HAL modules in a
+fresh interpreter.  The cold start has no config cache, hwconf
+parses and validates the INI files and the derived tables are
+built, the warm start loads them all from the cache.  Imports
+of the modules alone (numpy, configobj, tornado...) are not
+cached, the import of hwconf is reported on its own.
+
+Run from the directory containing the pyelixys package:
+    python pyelixys/hal/tests/benchimport.py [runs]
+"""
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+
+# Imports and creates what a HAL process starts with
+startup = """
+import time
+start = time.time()
+import pyelixys.hal.hwconf
+hwconf = time.time()
+from pyelixys.hal.status import Status
+from pyelixys.hal.cmds import cmd_lookup
+Status()
+print (hwconf - start) * 1000, (time.time() - start) * 1000
+"""
+
+
+def run(cachefile):
+    """ Milliseconds for (hwconf, everything) in a new interpreter """
+    env = dict(os.environ, ELIXYS_HWCONF_CACHE=cachefile)
+    out = subprocess.check_output([sys.executable, "-c", startup], env=env)
+    return tuple(float(value) for value in out.split())
+
+
+def best(times):
+    return tuple(min(column) for column in zip(*times))
+
+
+if __name__ == "__main__":
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    tmpdir = tempfile.mkdtemp()
+    try:
+        cachefile = os.path.join(tmpdir, "hwconf.cache")
+        cold = []
+        warm = []
+        for i in range(runs):
+            if os.path.exists(cachefile):
+                os.remove(cachefile)
+            cold.append(run(cachefile))
+            warm.append(run(cachefile))
+        nocache = best([run("") for i in range(runs)])
+    finally:
+        shutil.rmtree(tmpdir)
+    cold = best(cold)
+    warm = best(warm)
+    print "best of %d runs      hwconf     total" % runs
+    print "no cache        %8.1f ms %8.1f ms" % nocache
+    print "cold cache      %8.1f ms %8.1f ms" % cold
+    print "warm cache      %8.1f ms %8.1f ms" % warm
@@ -1,35 +1,6 @@
 import sys
 sys.path.append("../")
-from statusfmt import config
-
-test_packet = ('?\x00\x00\x00\x10\x02\x00\x00\x00\x00\x00'
-               '\x00A\x00\x00\x00d\x00\x00\x00\x00\x00\x00'
-               '?d\x00\x00\x00\x00\x00\x00?d\x00\x00\x00'
-               '\x00\x00\x00?d\x00\x00\x00\x00\x00\x00?'
-               '\x00\x00\xaa\x00\xaa\x00\xaa\x00\x00\x00'
-               '\x00\x00\x00\x00\xc8A\x00\x00\x00\x00\x00'
-               '\x00\xc8A\x00\x00\x00\x00\x00\x00\xc8A\x00'
-               '\x00\x00\x00\x00\x00\xc8A\x00\x00\x00\x00'
-               '\x00\x00\xc8A\x00\x00\x00\x00\x00\x00\xc8A'
-               '\x00\x00\x00\x00\x00\x00\xc8A\x00\x00\x00'
-               '\x00\x00\x00\xc8A\x00\x00\x00\x00\x00\x00'
-               '\xc8A\x00\x00\x00\x00\x00\x00\xc8A\x00\x00'
-               '\x00\x00\x00\x00\xc8A\x00\x00\x00\x00\x00'
-               '\x00\xc8A\xf0\x00\x00\x00\x00\x00\xc8A\x00'
-               '\x00\x00\x00\x00\x00\xc8A\x00\x00\x00\x00'
-               '\x00\x00\xc8A\x00\x00\x00\x00\x00\x00 A'
-               '\x00\x00\xa0@\x00\x00 A\x00\x00\xa0@\xa0'
-               '\x00\x00\x00\xe8\x03\x00\x00\xd0\x07\x00'
-               '\x00\x00\x00\x00\x00\xe8\x03\x00\x00\xd0'
-               '\x07\x00\x00\x00\x00\x00\x00\xe8\x03\x00'
-               '\x00\xd0\x07\x00\x00\x00\x00\x00\x00\xe8'
-               '\x03\x00\x00\xd0\x07\x00\x00\x00\x00\x00'
-               '\x00\xe8\x03\x00\x00\xd0\x07\x00\x00\x00'
-               '\x00\x00\x00\x00\x00\xaa\xaa\x00\x00\x00'
-               '\x00\x00\x00\xc0?\x00\x00\xc0?\x00\x00'
-               '\xc0?\x00\x00\xc0?\x00\x00\xc0?\x00\x00'
-               '\xc0?\x00\x00\xc0?\x00\x00\xc0?')
-
+from statusfmt import config, StatusMessageFormatFactory
 
 test_data = []
 
@@ -43,6 +14,8 @@ test_data.append(528)
 # Zero means no error, not necessary error, could be just info!
 # error_code < 0 means hw exception!
 test_data.append(0)
+# Sequence id of the last command applied, none yet
+test_data.append(0)
 
 #--------#
 # Mixers #
@@ -90,6 +63,8 @@ test_data.append(0b11110000)
 #-------------------------#
 # Temperature Controllers #
 #-------------------------#
+# Temperature Controllers Error Code
+test_data.append(0)
 for i in range(config['TemperatureControllers']['count']):
     # Temperature Controller Error Code
     test_data.append('\x00')
@@ -141,3 +116,6 @@ test_data.append('\x00')
 # Liquid Sensors Analog In
 for i in range(config['LiquidSensors']['count']):
     test_data.append(1.5)
+
+# The test_data packed as the hardware sends it
+test_packet = StatusMessageFormatFactory().get_struct().pack(*test_data)
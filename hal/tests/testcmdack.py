@@ -0,0 +1,103 @@
+import sys
+sys.path.append("./")
+sys.path.append("../")
+import time
+import threading
+import unittest
+from pyelixys.hal.cmds import cmd_lookup
+from pyelixys.hal.cmdsched import CommandLane
+from pyelixys.hal.cmdack import CommandTracker, LatencyHistogram
+
+
+class AckStatus(object):
+    """ Just the part of a Status the tracker reads """
+
+    def __init__(self, last_cmd_seq):
+        self.store = {'Header': {'last_cmd_seq': last_cmd_seq}}
+
+
+class LatencyHistogramTest(unittest.TestCase):
+
+    def test_buckets(self):
+        hist = LatencyHistogram()
+        for seconds in (0.0003, 0.0008, 0.003, 0.003, 2.0):
+            hist.add(seconds)
+        self.assertEqual(hist.count, 5)
+        self.assertEqual(hist.counts[0], 1)
+        self.assertEqual(hist.counts[1], 1)
+        self.assertEqual(hist.counts[3], 2)
+        self.assertEqual(hist.counts[-1], 1)
+        self.assertEqual(hist.percentile(50), 5.0)
+        self.assertAlmostEqual(hist.percentile(100), 2000.0)
+
+
+class CommandTrackerTest(unittest.TestCase):
+    """ Tests for following commands from queued to applied """
+
+    def setUp(self):
+        self.tracker = CommandTracker(window=16)
+
+    def cmd(self, value, reg='set_state0'):
+        return self.tracker.enqueue(cmd_lookup['Valves'][reg](value))
+
+    def test_seq_ids(self):
+        orig = cmd_lookup['Valves']['set_state0'](1)
+        cmds = [self.tracker.enqueue(orig) for i in range(3)]
+        self.assertEqual([cmd.seq_id for cmd in cmds], [1, 2, 3])
+        self.assertEqual(orig.seq_id, 0)
+
+    def test_applied_in_wire_order(self):
+        # Queued 1, 2, 3 but the lanes sent them 3, 1, 2
+        cmds = [self.cmd(i) for i in range(3)]
+        self.tracker.on_wire([cmds[2], cmds[0]])
+        self.tracker.on_wire([cmds[1]])
+        self.tracker.on_status(AckStatus(1))
+        self.assertTrue(self.tracker.is_applied(3))
+        self.assertTrue(self.tracker.is_applied(1))
+        self.assertFalse(self.tracker.is_applied(2))
+        self.tracker.on_status(AckStatus(2))
+        self.assertTrue(self.tracker.is_applied(2))
+        self.assertFalse(self.tracker.is_applied(4))
+        hist = self.tracker.latency_report()['Valves']
+        self.assertEqual(hist['total'].count, 3)
+        self.assertEqual(hist['wire'].count, 3)
+
+    def test_superseded_applied(self):
+        lane = CommandLane()
+        old, new = self.cmd(1), self.cmd(2)
+        lane.append(old)
+        self.assertTrue(lane.append(new))
+        self.tracker.on_wire([lane.popleft()])
+        self.tracker.on_status(AckStatus(new.seq_id))
+        self.assertTrue(self.tracker.is_applied(old.seq_id))
+
+    def test_wait_applied(self):
+        cmd = self.cmd(1)
+        self.assertFalse(self.tracker.wait_applied(cmd.seq_id, timeout=0.01))
+        self.tracker.on_wire([cmd])
+        timer = threading.Timer(0.05, self.tracker.on_status,
+                                (AckStatus(cmd.seq_id),))
+        timer.start()
+        self.assertTrue(self.tracker.wait_applied(cmd.seq_id, timeout=2.0))
+        timer.join()
+        self.assertTrue(self.tracker.acking)
+
+    def test_no_acks_fallback(self):
+        # Firmware that never echoes a command keeps last_cmd_seq 0
+        self.tracker.fallback = 0.05
+        cmd = self.cmd(1)
+        self.tracker.on_wire([cmd])
+        self.tracker.on_status(AckStatus(0))
+        self.assertFalse(self.tracker.acking)
+        begin = time.time()
+        self.assertFalse(self.tracker.wait_applied(cmd.seq_id, timeout=5.0))
+        self.assertTrue(time.time() - begin < 1.0)
+
+    def test_window(self):
+        for i in range(40):
+            self.cmd(i)
+        self.assertTrue(len(self.tracker.pending) <= 16)
+        self.assertFalse(self.tracker.is_applied(1))
+
+if __name__ == '__main__':
+    unittest.main()
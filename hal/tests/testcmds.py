@@ -0,0 +1,111 @@
+import sys
+sys.path.append("./")
+sys.path.append("../")
+import pickle
+import unittest
+from pyelixys.hal.cmds import cmd_lookup, CommandBatch
+from pyelixys.elixysexceptions import ElixysValueError
+
+
+class CommandBatchTest(unittest.TestCase):
+    """ Tests for packing several commands in one frame """
+
+    def setUp(self):
+        from testelixyshw import ElixysSimulator
+        self.sim = ElixysSimulator()
+        self.cmds = [cmd_lookup['Valves']['set_state0'][0](0xAA),
+                     cmd_lookup['Mixers']['set_duty_cycle'][2](50.0),
+                     cmd_lookup['Fans']['turn_on'][1](),
+                     cmd_lookup['LinearActuators']['home_axis'][3](0)]
+
+    def test_single_frame(self):
+        parsed = self.sim.parse_frame(str(self.cmds[0]))
+        self.assertEqual(len(parsed), 1)
+        cb, dev_id, param, seq_id = parsed[0]
+        self.assertEqual(cb, self.sim.valves_set_state0)
+        self.assertEqual(param, (0xAA,))
+
+    def test_batch_frame(self):
+        batch = CommandBatch(self.cmds)
+        frame = str(batch)
+        self.assertEqual(len(frame), 8 + sum(len(str(cmd)) for cmd in self.cmds))
+        parsed = self.sim.parse_frame(frame)
+        self.assertEqual([cmd[0] for cmd in parsed],
+                         [self.sim.valves_set_state0,
+                          self.sim.mixers_set_duty_cycle,
+                          self.sim.fans_turn_on,
+                          self.sim.linacts_home_axis])
+        self.assertEqual([cmd[1] for cmd in parsed], [0, 2, 1, 3])
+        self.assertEqual([cmd[2] for cmd in parsed],
+                         [(0xAA,), (50.0,), ('\x00',), (0,)])
+
+    def test_run_batch(self):
+        batch = CommandBatch([cmd_lookup['Valves']['set_state1'][0](0x11),
+                              cmd_lookup['Valves']['set_state2'][0](0x22)])
+        self.sim.run_callback(str(batch))
+        self.assertEqual(self.sim.stat.Valves['state1'], 0x11)
+        self.assertEqual(self.sim.stat.Valves['state2'], 0x22)
+
+    def test_seq_id_acked(self):
+        cmd = cmd_lookup['Valves']['set_state0'][0](0x33)
+        cmd.seq_id = 41
+        self.assertEqual(self.sim.parse_frame(str(cmd))[0][3], 41)
+        self.sim.run_callback(str(CommandBatch([cmd])))
+        self.assertEqual(self.sim.stat.Header['last_cmd_seq'], 41)
+
+    def test_set_status_period(self):
+        cmd = cmd_lookup['System']['set_status_period'](20)
+        self.assertEqual(cmd.cmd_id, (15, 'I'))
+        self.sim.run_callback(str(cmd))
+        self.assertEqual(self.sim.status_period, 20)
+
+
+class CommandEncoderTest(unittest.TestCase):
+    """ The commands of a type share one compiled encoder """
+
+    def test_shared(self):
+        set_duty_cycle = cmd_lookup['Mixers']['set_duty_cycle']
+        cmd = set_duty_cycle[1](20.0)
+        self.assertTrue(cmd.encoder is set_duty_cycle.encoder)
+        self.assertTrue(cmd.struct_ is set_duty_cycle.struct_)
+        self.assertEqual(cmd.encoder.arity, 1)
+        # Bound to a device once, then the same command
+        self.assertTrue(set_duty_cycle[1] is set_duty_cycle[1])
+        self.assertFalse(cmd is set_duty_cycle[1])
+        self.assertEqual(set_duty_cycle[1].param, '\x00')
+
+    def test_bad_device(self):
+        set_duty_cycle = cmd_lookup['Mixers']['set_duty_cycle']
+        count = set_duty_cycle.encoder.count
+        self.assertRaises(ElixysValueError, lambda: set_duty_cycle[count])
+        self.assertRaises(ElixysValueError, lambda: set_duty_cycle[-1])
+
+    def test_bad_parameter(self):
+        cmd = cmd_lookup['Mixers']['set_duty_cycle'][0]('fast')
+        self.assertRaises(ElixysValueError, str, cmd)
+
+    def test_pickle(self):
+        cmd = cmd_lookup['Valves']['set_state0'](0xAA)
+        copied = pickle.loads(pickle.dumps(cmd, 2))
+        self.assertTrue(copied.encoder is cmd.encoder)
+        self.assertEqual(str(copied), str(cmd))
+
+    def test_pack_into(self):
+        cmds = [cmd_lookup['Valves']['set_state0'](0xAA),
+                cmd_lookup['Mixers']['set_duty_cycle'][2](50.0)]
+        batch = CommandBatch(cmds)
+        buf = bytearray(64)
+        self.assertEqual(batch.pack_into(buf, 4), 4 + batch.size)
+        self.assertEqual(str(buf[4:4 + batch.size]), str(batch))
+        self.assertEqual(str(batch)[8:], "".join(str(cmd) for cmd in cmds))
+
+    def test_read_only_table(self):
+        valves = cmd_lookup['Valves']
+        def replace():
+            valves['set_state0'] = None
+        self.assertRaises(ElixysValueError, replace)
+        self.assertRaises(ElixysValueError, valves.pop, 'set_state0')
+        self.assertTrue('set_state0' in cmd_lookup['Valves'])
+
+if __name__ == '__main__':
+    unittest.main()
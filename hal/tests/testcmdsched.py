@@ -0,0 +1,129 @@
+import sys
+sys.path.append("./")
+sys.path.append("../")
+import time
+import unittest
+import tornado.ioloop
+from pyelixys.hal.cmds import cmd_lookup, CommandBatch
+from pyelixys.hal.cmdsched import CommandScheduler, TokenBucket, \
+                                    CommandLane
+
+
+class TokenBucketTest(unittest.TestCase):
+    """ Tests for the command pacing token bucket """
+
+    def test_burst_then_gap(self):
+        bucket = TokenBucket(0.1, 3)
+        now = bucket.last
+        for i in range(3):
+            self.assertEqual(bucket.consume(now), 0.0)
+        self.assertAlmostEqual(bucket.consume(now), 0.1)
+        self.assertEqual(bucket.consume(now + 0.11), 0.0)
+
+
+class CommandLaneTest(unittest.TestCase):
+    """ Tests for coalescing the pending commands """
+
+    def drain(self, lane):
+        return [(cmd.cmd_name, cmd.device_id, cmd.param)
+                for cmd in [lane.popleft() for i in range(len(lane))]]
+
+    def test_last_writer_wins(self):
+        lane = CommandLane()
+        for value in range(5):
+            lane.append(cmd_lookup['Valves']['set_state0'][0](value))
+        lane.append(cmd_lookup['Valves']['set_state1'][0](7))
+        self.assertEqual(self.drain(lane), [('set_state0', 0, 4),
+                                            ('set_state1', 0, 7)])
+
+    def test_events_are_barriers(self):
+        lane = CommandLane()
+        lane.append(cmd_lookup['TemperatureControllers']['set_setpoint'][1](50.0))
+        lane.append(cmd_lookup['TemperatureControllers']['set_setpoint'][1](60.0))
+        lane.append(cmd_lookup['TemperatureControllers']['turn_on'][1]())
+        lane.append(cmd_lookup['TemperatureControllers']['set_setpoint'][1](70.0))
+        lane.append(cmd_lookup['TemperatureControllers']['turn_on'][1]())
+        names = [(name, param) for name, devid, param in self.drain(lane)]
+        self.assertEqual(names, [('set_setpoint', 60.0),
+                                 ('turn_on', '\x00'),
+                                 ('set_setpoint', 70.0),
+                                 ('turn_on', '\x00')])
+
+
+class CommandSchedulerTest(unittest.TestCase):
+    """ Tests for the IOLoop command scheduler """
+
+    def setUp(self):
+        self.ioloop = tornado.ioloop.IOLoop()
+        self.sent = []
+        self.scheduler = CommandScheduler(self.send, self.ioloop)
+
+    def tearDown(self):
+        self.ioloop.close()
+
+    def send(self, cmds):
+        for cmd in cmds:
+            self.sent.append((time.time(), cmd))
+
+    def test_paced_burst(self):
+        min_gap, burst = self.scheduler.get_pacing('Valves')
+        count = burst + 3
+        begin = time.time()
+        for i in range(count):
+            self.scheduler.put(cmd_lookup['Valves']['set_state0'][i](i))
+        # The burst goes out without waiting on the IOLoop
+        self.assertEqual(len(self.sent), burst)
+
+        def check():
+            if not self.scheduler.pending():
+                self.ioloop.stop()
+        tornado.ioloop.PeriodicCallback(check, 5, self.ioloop).start()
+        self.ioloop.start()
+
+        self.assertEqual([cmd.param for t, cmd in self.sent], range(count))
+        self.assertEqual(self.scheduler.counters['coalesced'], 0)
+        elapsed = self.sent[-1][0] - begin
+        self.assertTrue(elapsed >= (count - burst) * min_gap * 0.9)
+
+    def test_batch_not_paced(self):
+        min_gap, burst = self.scheduler.get_pacing('Valves')
+        for i in range(burst):
+            self.scheduler.put(cmd_lookup['Valves']['set_state2'](i))
+        self.scheduler.put(CommandBatch([
+            cmd_lookup['Valves']['set_state0'](0),
+            cmd_lookup['Valves']['set_state1'](1)]))
+        self.assertEqual(len(self.sent), burst)
+
+        def check():
+            if not self.scheduler.pending():
+                self.ioloop.stop()
+        tornado.ioloop.PeriodicCallback(check, 5, self.ioloop).start()
+        self.ioloop.start()
+
+        off, on = self.sent[-2:]
+        self.assertEqual((off[1].cmd_name, on[1].cmd_name),
+                         ('set_state0', 'set_state1'))
+        self.assertTrue(on[0] - off[0] < min_gap / 2)
+        self.assertEqual(self.scheduler.counters['sent'], burst + 2)
+
+    def test_coalesce_while_no_client(self):
+        self.scheduler.send = lambda cmds: False
+        for i in range(5):
+            self.scheduler.put(cmd_lookup['Mixers']['set_duty_cycle'][2](i))
+        self.scheduler.send = self.send
+        self.scheduler.flush()
+        self.assertEqual([cmd.param for t, cmd in self.sent], [4])
+        self.assertEqual(self.scheduler.counters.as_dict(),
+                         {'queued': 5, 'coalesced': 4, 'sent': 1})
+
+    def test_no_client_keeps_commands(self):
+        self.scheduler.send = lambda cmds: False
+        self.scheduler.put(cmd_lookup['Fans']['turn_on'][0]())
+        self.assertEqual(self.scheduler.pending(), 1)
+        self.scheduler.send = self.send
+        self.scheduler.flush()
+        self.assertEqual(self.scheduler.pending(), 0)
+        self.assertEqual(len(self.sent), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import sys
+sys.path.append("./")
+sys.path.append("../")
+import subprocess
+import unittest
+
+from pyelixys.hal.hwconf import config
+from pyelixys.hal.comms import CommStack
+from pyelixys.hal.tests.testwsserver import connect
+
+# What importing the HAL must not do
+imported = """
+import sys
+import threading
+import pyelixys.hal.hal
+print threading.active_count(), [name for name in
+    ('tornado', 'numpy', 'jinja2', 'pyelixys.hal.wsserver') if name in sys.modules]
+"""
+
+
+class CommStackTest(unittest.TestCase):
+    """ The comm stack is only built and run on demand """
+
+    def test_import(self):
+        out = subprocess.check_output([sys.executable, "-c", imported])
+        self.assertEqual(out.split(None, 1), ['1', '[]\n'])
+
+    def test_context(self):
+        from testelixyshw import StatusSimulator
+        conf = dict(config['WSServer'], mode='thread', port=8897,
+                    units=['a', 'b'])
+        sim = StatusSimulator()
+        sim.store['Header']['packet_id'] = 7
+        with CommStack(conf) as comms:
+            self.assertTrue(comms.server.is_alive())
+            self.assertTrue(comms.status() is comms.statuses['a'])
+            ws = connect("ws://localhost:8897/ws/b")
+            ws.send_binary(sim.generate_packet())
+            self.assertEqual(comms.status('b').wait_for_packet(timeout=2.0),
+                             7)
+            ws.close()
+        comms.server.join(2.0)
+        self.assertFalse(comms.server.is_alive())
+        self.assertFalse(comms.status('b').thread.is_alive())
+
+if __name__ == '__main__':
+    unittest.main()
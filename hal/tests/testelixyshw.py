@@ -20,6 +20,7 @@ from websocket import ABNF
 from pyelixys.logs import hwsimlog as log
 from pyelixys.hal.status import Status
 from pyelixys.hal.elixysobject import ElixysObject
+from pyelixys.hal.cmds import cmd_header_format, batch_header_format
 from threading import Timer
 
 
@@ -51,6 +52,7 @@ class StatusSimulator(Status):
         self.store['Header']['packet_id'] = 0
         self.store['Header']['packet_type'] = 63
         self.store['Header']['system_error_code'] = 0
+        self.store['Header']['last_cmd_seq'] = 0
 
         # Initialize Mixers
         mixers = []
@@ -220,6 +222,12 @@ class StatusSimulator(Status):
         return fmtstruct.pack(*data)
         #self.store[sub[0]]
 
+    def generate_delta_packet(self, prev_data):
+        """ Pack only the fields that changed since prev_data,
+        the data of the packet sent just before
+        """
+        return self.delta.pack(prev_data, self.generate_packet_data())
+
 
 
 class ElixysSimulator(ElixysObject):
@@ -237,6 +245,8 @@ class ElixysSimulator(ElixysObject):
         """
         self.stat = StatusSimulator()
         self.cb_map = {}
+        # Time between status packets in ms
+        self.status_period = self.sysconf['Header']['idle_status_period']
 
         log.debug("Initialize the ElixysSimulator, register callbacks")
 
@@ -298,6 +308,11 @@ class ElixysSimulator(ElixysObject):
                                'home_axis',
                                self.linacts_home_axis)
 
+        # Setup Callback for System commands
+        self.register_callback('System',
+                               'set_status_period',
+                               self.system_set_status_period)
+
         self.tempctrl_thread = thread.start_new_thread(self.run_tempctrls,())
 
     def parse_cmd(self, cmd_pkt):
@@ -308,20 +323,21 @@ class ElixysSimulator(ElixysObject):
         -second integer is the device_id
             You can think of this as a 2 integer
             long register we are writing too
+        -third (unsigned) integer is the host sequence id
         - the parameter type is variable,
             so we look it up and get the callback fxn that will change
             the proper state variable (or start a thread that will simulate
             some HW change)
         """
-        # Create struct for unpacking the cmd_id and dev_id
-        cmd_id_struct = struct.Struct("<ii")
+        # Create struct for unpacking the cmd_id, dev_id and seq_id
+        cmd_id_struct = struct.Struct(cmd_header_format)
 
         # Length of the packet
         len_cmd_id = cmd_id_struct.size
 
-        # Extract cmd_id and dev_id
-        cmd_id, dev_id = cmd_id_struct.unpack(cmd_pkt[:len_cmd_id])
-        log.debug("CMDID:#%d|DEVID:#%d", cmd_id, dev_id)
+        # Extract cmd_id, dev_id and seq_id
+        cmd_id, dev_id, seq_id = cmd_id_struct.unpack(cmd_pkt[:len_cmd_id])
+        log.debug("CMDID:#%d|DEVID:#%d|SEQID:#%d", cmd_id, dev_id, seq_id)
 
         # Look up callback and parameter type
         cb, param_fmt_str = self.cb_map[cmd_id]
@@ -333,10 +349,40 @@ class ElixysSimulator(ElixysObject):
         param = param_struct.unpack(cmd_pkt[len_cmd_id:])
         log.debug("PARAM:%s", param)
 
-        # Return the cb fxn, the dev_id and the param
+        # Return the cb fxn, the dev_id, the param and the seq_id
         # Something else can pass the dev_id and param in to callback
         # This simulates some HW action as a result of a user/host command
-        return (cb, dev_id, param)
+        return (cb, dev_id, param, seq_id)
+
+    def parse_frame(self, frame):
+        """
+        Parse a frame sent from the host, it is either
+        a single cmd or a batch of cmds.
+        A batch starts with a header packed like a cmd,
+        the cmd_id is the batch_cmd_id and the dev_id is the
+        number of cmds in the batch.  The cmds follow back to back,
+        each one only as long as its parameter type.
+        Returns a list of (cb, dev_id, param, seq_id)
+        """
+        hdr_struct = struct.Struct(batch_header_format)
+        cmd_struct = struct.Struct(cmd_header_format)
+        cmd_id, count = hdr_struct.unpack_from(frame)
+        if cmd_id != self.sysconf['Command Format']['batch_cmd_id']:
+            return [self.parse_cmd(frame)]
+
+        log.debug("BATCH:%d cmds", count)
+        cmds = []
+        offset = hdr_struct.size
+        for i in range(count):
+            cmd_id, dev_id, seq_id = cmd_struct.unpack_from(frame, offset)
+            cb, param_fmt_str = self.cb_map[cmd_id]
+            param_struct = struct.Struct("<" + param_fmt_str)
+            param = param_struct.unpack_from(frame, offset + cmd_struct.size)
+            log.debug("CMDID:#%d|DEVID:#%d|SEQID:#%d|PARAM:%s",
+                      cmd_id, dev_id, seq_id, param)
+            cmds.append((cb, dev_id, param, seq_id))
+            offset += cmd_struct.size + param_struct.size
+        return cmds
 
 
     def register_callback(self,sub_sys,cmd_name, fxn):
@@ -352,7 +398,10 @@ class ElixysSimulator(ElixysObject):
         associated with a sub_system (think "Mixers")
         and a cmd name (this will return some integer and
         parameter expected format!
+        The System commands are in the top level Commands section
         """
+        if sub_sys == 'System':
+            return self.sysconf['Commands'][cmd_name]
         return self.sysconf[sub_sys]['Commands'][cmd_name]
 
     def run_callback(self, cmdpkt):
@@ -364,10 +413,17 @@ class ElixysSimulator(ElixysObject):
 
         log.debug("Execute PKT: %s",repr(cmdpkt))
 
-        # Determine callback to exectue
-        cmdfxn, dev_id, param = self.parse_cmd(cmdpkt)
-        # Execute the callback
-        cmdfxn(dev_id, *param)
+        # Determine callbacks to exectue
+        for cmdfxn, dev_id, param, seq_id in self.parse_frame(cmdpkt):
+            # Execute the callback
+            cmdfxn(dev_id, *param)
+            # Acknowledge it in the next status packet
+            self.stat.store['Header']['last_cmd_seq'] = seq_id
+
+    def system_set_status_period(self, devid, period):
+        """ Set the time between status packets """
+        log.debug("Set status period = %d ms", period)
+        self.status_period = period
 
     def mixers_set_period(self, devid, period):
         """ Mixer set period callback """
@@ -607,11 +663,19 @@ def on_open(ws):
     i = 0
     def run(*args):
         i = 0
+        keyframe = e.sysconf['Header']['keyframe_interval']
+        prev_data = None
         while True:
             #print "Sent packet id: #%d" % i
-            pkt = e.stat.generate_packet()
+            e.stat.store['Header']['packet_id'] = i
+            # A full packet every keyframe, only the changes otherwise
+            if i % keyframe == 0:
+                pkt = e.stat.generate_packet()
+            else:
+                pkt = e.stat.generate_delta_packet(prev_data)
+            prev_data = e.stat.generate_packet_data()
             ws.send(pkt, ABNF.OPCODE_BINARY)
-            time.sleep(.2)
+            time.sleep(e.status_period / 1000.0)
             i+=1
         #ws.close()
         #print "thread terminating..."
@@ -630,8 +694,13 @@ if __name__ == "__main__":
     # Setup signal callback
     signal.signal(signal.SIGINT, exit_gracefully)
 
+    # Simulate a given synthesizer unit, i.e. testelixyshw.py 1
+    url = "ws://localhost:8888/ws"
+    if len(sys.argv) > 1:
+        url += "/" + sys.argv[1]
+
     #websocket.enableTrace(True) # Enable for websocket trace!
-    ws = websocket.WebSocketApp("ws://localhost:8888/ws",
+    ws = websocket.WebSocketApp(url,
                                 on_message=on_message,
                                 on_error=on_error,
                                 on_close=on_close)
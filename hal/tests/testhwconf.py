@@ -0,0 +1,89 @@
+import sys
+sys.path.append("./")
+sys.path.append("../")
+import os
+import shutil
+import tempfile
+import unittest
+from pyelixys.hal.hwconf import ConfigCache, load_config, config
+
+
+class ConfigCacheTest(unittest.TestCase):
+    """ Tests for the cache of the tables derived from the config """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.source = os.path.join(self.tmpdir, "hwconf.ini")
+        self.filename = os.path.join(self.tmpdir, "hwconf.cache")
+        self.write_source("a = 1\n")
+        self.builds = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_source(self, text):
+        with open(self.source, "w") as f:
+            f.write(text)
+
+    def build(self):
+        self.builds += 1
+        return {'table': [1, 2, 3]}
+
+    def cached(self):
+        cache = ConfigCache(self.filename, (self.source,))
+        table = cache.cached('table', self.build)
+        cache.save()
+        return table
+
+    def test_warm(self):
+        self.assertEqual(self.cached(), {'table': [1, 2, 3]})
+        self.assertEqual(self.cached(), {'table': [1, 2, 3]})
+        self.assertEqual(self.builds, 1)
+
+    def test_stale(self):
+        self.cached()
+        self.write_source("a = 2\n")
+        self.cached()
+        self.assertEqual(self.builds, 2)
+
+    def test_broken_file(self):
+        with open(self.filename, "w") as f:
+            f.write("not a pickle")
+        self.cached()
+        self.cached()
+        self.assertEqual(self.builds, 1)
+
+    def test_other_objects(self):
+        # A pickle naming anything but the configobj classes
+        with open(self.filename, "wb") as f:
+            f.write("cos\nsystem\n(S'exit 1'\ntR.")
+        self.assertEqual(self.cached(), {'table': [1, 2, 3]})
+        self.assertEqual(self.builds, 1)
+
+    def test_save_once(self):
+        cache = ConfigCache(self.filename, (self.source,))
+        cache.cached('table', self.build)
+        cache.cached('other', self.build)
+        self.assertFalse(os.path.exists(self.filename))
+        cache.save()
+        # Nothing built since, not written again
+        os.utime(self.filename, (1000, 1000))
+        cache.save()
+        self.assertEqual(os.path.getmtime(self.filename), 1000)
+        self.assertEqual(sorted(ConfigCache(self.filename,
+                                            (self.source,)).tables),
+                         ['other', 'table'])
+
+    def test_missing_source(self):
+        os.remove(self.source)
+        self.cached()
+        self.assertFalse(os.path.exists(self.filename))
+
+    def test_config(self):
+        fresh = load_config()[0]
+        self.assertEqual(fresh.keys(), config.keys())
+        self.assertEqual(fresh['Header'], config['Header'])
+        self.assertEqual(fresh['Commands']['set_status_period'], (15, 'I'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+import sys
+sys.path.append("./")
+sys.path.append("../")
+import time
+import Queue
+import unittest
+from pyelixys.hal.linkstats import PacketStats, ArrivalTimes
+
+
+class PacketStatsTest(unittest.TestCase):
+    """ Tests for the status packet accounting """
+
+    def setUp(self):
+        self.stats = PacketStats(window=8, reorder_window=4)
+
+    def feed(self, ids, period=0.01):
+        return [self.stats.on_packet(packet_id, now=i * period)
+                for i, packet_id in enumerate(ids)]
+
+    def test_in_order(self):
+        self.assertEqual(self.feed(range(10, 20)), [True] * 10)
+        self.assertEqual(self.stats.received, 10)
+        self.assertEqual(self.stats.lost, 0)
+        self.assertEqual(self.stats.connections, 1)
+        self.assertAlmostEqual(self.stats.jitter, 0.0)
+        self.assertEqual(self.stats.interval_histogram().count, 8)
+
+    def test_lost(self):
+        self.feed([0, 1, 4, 5])
+        self.assertEqual(self.stats.lost, 2)
+        self.assertAlmostEqual(self.stats.loss_rate, 2.0 / 6)
+        # The interval is per id step, a gap is not jitter
+        self.assertAlmostEqual(self.stats.intervals[1], 0.01 / 3)
+
+    def test_duplicate_and_reordered(self):
+        self.assertEqual(self.feed([0, 1, 3, 2, 3, 4]),
+                         [True, True, True, False, False, True])
+        self.assertEqual(self.stats.lost, 0)
+        self.assertEqual(self.stats.reordered, 1)
+        self.assertEqual(self.stats.duplicates, 1)
+        self.assertEqual(self.stats.received, 5)
+
+    def test_reconnect(self):
+        self.feed([100, 101, 103])
+        self.feed([0, 1])
+        self.assertEqual(self.stats.connections, 2)
+        self.assertEqual(self.stats.received, 2)
+        self.assertEqual(self.stats.lost, 0)
+
+    def test_jitter(self):
+        for i, now in enumerate([0.0, 0.01, 0.03, 0.04, 0.06]):
+            self.stats.on_packet(i, now)
+        self.assertTrue(self.stats.jitter > 0.0)
+        self.assertEqual(self.stats.as_dict()['interval']['count'], 4)
+
+
+class ArrivalTimesTest(unittest.TestCase):
+
+    def test_window(self):
+        arrivals = ArrivalTimes(window=4)
+        for i in range(6):
+            arrivals.on_packet(now=float(i))
+        self.assertEqual(arrivals.count, 6)
+        self.assertEqual(arrivals.get_time(5), 5.0)
+        self.assertEqual(arrivals.get_time(2), 2.0)
+        self.assertEqual(arrivals.get_time(1), None)
+        self.assertEqual(arrivals.get_time(6), None)
+
+
+class StatusThreadLagTest(unittest.TestCase):
+    """ The consumer catches up on the packets waiting """
+
+    def setUp(self):
+        from testelixyshw import StatusSimulator
+        from pyelixys.hal.status import Status, StatusThread
+        self.sim = StatusSimulator()
+        self.status = Status()
+        self.queue = Queue.Queue()
+        self.arrivals = ArrivalTimes(window=16)
+        self.thread = StatusThread(self.status, self.queue, self.arrivals)
+        self.parsed = []
+        self.status.add_packet_callback(
+            lambda status: self.parsed.append(
+                status.store['Header']['packet_id']))
+
+    def put(self, packet_id, delta=False, now=None):
+        prev_data = self.sim.generate_packet_data()
+        self.sim.store['Header']['packet_id'] = packet_id
+        self.sim.store['DigitalInputs']['state'] = packet_id
+        if delta:
+            pkt = self.sim.generate_delta_packet(prev_data)
+        else:
+            pkt = self.sim.generate_packet()
+        self.arrivals.on_packet(now)
+        self.queue.put(pkt)
+
+    def test_every(self):
+        self.thread.skip_to_latest = False
+        for i in range(3):
+            self.put(i)
+        self.thread.loop()
+        self.assertEqual(self.parsed, [0])
+        self.assertEqual(self.thread.lag.packets, 3)
+
+    def test_latest(self):
+        self.thread.skip_to_latest = True
+        self.put(0, now=time.time() - 0.5)
+        for i in range(1, 5):
+            self.put(i, delta=True)
+        self.thread.loop()
+        # Only the newest is decoded, the deltas before it applied
+        self.assertEqual(self.parsed, [4])
+        self.assertEqual(self.status.DigitalInputs['state'], 4)
+        self.assertEqual(self.status.packet_stats.received, 5)
+        self.assertEqual(len(self.status.ring), 5)
+        self.assertEqual(self.thread.lag.packets, 5)
+        self.assertEqual(self.thread.lag.skipped, 4)
+        self.assertTrue(0.0 <= self.thread.lag.last_age < 500.0)
+        self.put(5, delta=True)
+        self.thread.loop()
+        self.assertEqual(self.parsed, [4, 5])
+        self.assertEqual(self.thread.lag.packets, 1)
+
+    def test_no_fold(self):
+        self.thread.skip_to_latest = True
+        self.thread.fold_history = False
+        for i in range(3):
+            self.put(i)
+        self.thread.loop()
+        self.assertEqual(len(self.status.ring), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+import sys
+sys.path.append("./")
+sys.path.append("../")
+import time
+import unittest
+from Queue import Empty
+from multiprocessing import Process
+from pyelixys.hal.shmring import StatusRing, StatusSlot
+
+
+def write_packets(ring, count):
+    for i in range(count):
+        ring.put("pkt%03d" % i)
+
+
+class StatusRingTest(unittest.TestCase):
+    """ Tests for the shared memory status ring """
+
+    def test_put_get(self):
+        ring = StatusRing(slots=4, slot_size=16)
+        ring.put("hello")
+        ring.put("world")
+        self.assertEqual(ring.qsize(), 2)
+        self.assertEqual(str(ring.get()), "hello")
+        self.assertEqual(str(ring.get()), "world")
+        self.assertRaises(Empty, ring.get, False)
+
+    def test_get_timeout(self):
+        ring = StatusRing(slots=4, slot_size=16)
+        begin = time.time()
+        self.assertRaises(Empty, ring.get, True, 0.05)
+        self.assertTrue(time.time() - begin >= 0.05)
+
+    def test_overrun(self):
+        ring = StatusRing(slots=4, slot_size=16)
+        write_packets(ring, 10)
+        self.assertEqual([str(ring.get()) for i in range(4)],
+                         ["pkt006", "pkt007", "pkt008", "pkt009"])
+        self.assertEqual(ring.skipped, 6)
+
+    def test_packet_outlives_slot(self):
+        ring = StatusRing(slots=4, slot_size=16)
+        ring.put("first")
+        pkt = ring.get()
+        write_packets(ring, 4)
+        self.assertEqual(pkt, "first")
+
+    def test_oversized_packet_dropped(self):
+        ring = StatusRing(slots=4, slot_size=4)
+        ring.put("too long")
+        self.assertEqual(ring.dropped, 1)
+        self.assertTrue(ring.empty())
+
+    def test_across_processes(self):
+        ring = StatusRing(slots=64, slot_size=16)
+        writer = Process(target=write_packets, args=(ring, 20))
+        writer.start()
+        pkts = [str(ring.get(timeout=5.0)) for i in range(20)]
+        writer.join()
+        self.assertEqual(pkts, ["pkt%03d" % i for i in range(20)])
+
+class StatusSlotTest(unittest.TestCase):
+    """ Tests for the latest value status slot """
+
+    def test_latest_wins(self):
+        slot = StatusSlot(slot_size=16)
+        self.assertRaises(Empty, slot.get, False)
+        write_packets(slot, 5)
+        self.assertEqual(slot.get(), "pkt004")
+        self.assertEqual(slot.skipped, 4)
+        self.assertRaises(Empty, slot.get, True, 0.01)
+        slot.put("short")
+        self.assertEqual(slot.get(), "short")
+        self.assertEqual(slot.skipped, 4)
+
+    def test_across_processes(self):
+        slot = StatusSlot(slot_size=16)
+        writer = Process(target=write_packets, args=(slot, 200))
+        writer.start()
+        received = []
+        while not received or received[-1] != "pkt199":
+            received.append(slot.get(timeout=5.0))
+        writer.join()
+        numbers = [int(pkt[3:]) for pkt in received]
+        self.assertEqual(numbers, sorted(set(numbers)))
+        self.assertEqual(len(received) + slot.skipped, 200)
+
+if __name__ == '__main__':
+    unittest.main()
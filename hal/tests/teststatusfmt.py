@@ -1,7 +1,12 @@
 import sys
 sys.path.append("./")
 sys.path.append("../")
+import time
+import Queue
+import threading
 import unittest
+import numpy
+from pyelixys.elixysexceptions import ElixysValueError
 from statusfmt import StatusMessageFormatFactory
 
 
@@ -34,5 +39,350 @@ class StatusMessageFormatFactoryTest(unittest.TestCase):
         pkt = self.statstruct.pack(*self.test_data)
         self.assertEqual(pkt, self.test_packet)
 
+    def test_dtype(self):
+        statmsgfmt = StatusMessageFormatFactory()
+        self.assertEqual(statmsgfmt.get_dtype().itemsize, self.statstruct.size)
+        pkts = []
+        for i in range(5):
+            self.status.store['Header']['packet_id'] = i
+            self.status.store['Mixers'][2]['duty_cycle'] = i * 10.0
+            pkts.append(self.status.generate_packet())
+        arr = statmsgfmt.unpack_array("".join(pkts))
+        self.assertEqual(len(arr), 5)
+        self.assertEqual(list(arr['Header']['packet_id']), range(5))
+        self.assertEqual(list(arr['Mixers']['Subs']['duty_cycle'][:, 2]),
+                         [0.0, 10.0, 20.0, 30.0, 40.0])
+        # numpy strips the NUL of a 'c' field
+        self.assertEqual(arr['Valves']['error_code'][0], '')
+        # Same values as struct.unpack, in the same order
+        for pkt, rec in zip(pkts, arr):
+            flat = []
+            for sub in rec:
+                for value in sub:
+                    if isinstance(value, numpy.ndarray):
+                        flat.extend(v for unit in value for v in unit)
+                    else:
+                        flat.append(value)
+            self.assertEqual(flat, [value.rstrip('\x00')
+                                    if isinstance(value, str) else value
+                                    for value in self.statstruct.unpack(pkt)])
+
+
+class StatusDeltaTest(unittest.TestCase):
+    """ Tests for the delta status packets """
+
+    def setUp(self):
+        from testelixyshw import StatusSimulator
+        from pyelixys.hal.status import Status
+        self.sim = StatusSimulator()
+        self.status = Status()
+        self.prev_data = None
+
+    def send(self, packet_id, delta=True):
+        self.sim.store['Header']['packet_id'] = packet_id
+        if delta:
+            pkt = self.sim.generate_delta_packet(self.prev_data)
+        else:
+            pkt = self.sim.generate_packet()
+        self.prev_data = self.sim.generate_packet_data()
+        return pkt
+
+    def test_delta_applied(self):
+        self.status.parse_packet(self.send(1, delta=False))
+        self.sim.store['Mixers'][1]['duty_cycle'] = 50.0
+        self.sim.store['Valves']['state1'] = 0x55
+        pkt = self.send(2)
+        self.assertTrue(len(pkt) < len(self.sim.generate_packet()))
+        data = self.status.parse_packet(pkt)
+        self.assertEqual(data['Header']['packet_type'],
+                         self.sim.sysconf['Header']['delta_packet_type'])
+        self.assertEqual(data['Mixers'][1]['duty_cycle'], 50.0)
+        self.assertEqual(data['Valves']['state1'], 0x55)
+        self.assertEqual(self.status.last_data[1:],
+                         tuple(self.sim.generate_packet_data())[1:])
+
+    def test_unchanged(self):
+        self.status.parse_packet(self.send(1, delta=False))
+        pkt = self.send(2)
+        codec = self.status.delta
+        self.assertEqual(len(pkt), codec.header_struct.size + codec.bitmap_len)
+        self.assertEqual(self.status.parse_packet(pkt)['Header']['packet_id'], 2)
+
+    def test_lost_packet(self):
+        self.status.parse_packet(self.send(1, delta=False))
+        self.send(2)
+        self.assertEqual(self.status.parse_packet(self.send(3)), None)
+        self.assertEqual(self.status.deltas_dropped, 1)
+        self.assertEqual(self.status.packet_stats.lost, 1)
+        # Nothing applies until the next full packet
+        self.assertEqual(self.status.parse_packet(self.send(4)), None)
+        self.assertNotEqual(self.status.parse_packet(self.send(5, False)), None)
+        self.assertNotEqual(self.status.parse_packet(self.send(6)), None)
+
+    def test_malformed(self):
+        codec = self.status.delta
+        self.assertNotEqual(codec.spare_mask, 0)
+        self.status.parse_packet(self.send(1, delta=False))
+        # A bit past the last field
+        pkt = bytearray(self.send(2))
+        pkt[-1] |= 0x80
+        self.assertEqual(self.status.parse_packet(str(pkt)), None)
+        self.assertEqual(self.status.deltas_dropped, 1)
+        self.status.parse_packet(self.send(3, delta=False))
+        # Truncated in the field values
+        self.sim.store['Valves']['state1'] = 0x55
+        pkt = self.send(4)
+        self.assertEqual(self.status.parse_packet(pkt[:-1]), None)
+        self.assertEqual(self.status.deltas_dropped, 2)
+
+    def test_lazy(self):
+        self.status.lazy = True
+        self.status.parse_packet(self.send(1, delta=False))
+        self.sim.store['Mixers'][1]['duty_cycle'] = 50.0
+        data = self.status.parse_packet(self.send(2))
+        self.assertEqual(data['Mixers'][1]['duty_cycle'], 50.0)
+        self.assertEqual(self.status.Header.packet_id, 2)
+        self.assertEqual(data, self.status.decode(self.status.last_data))
+
+
+class StatusDecodeTest(unittest.TestCase):
+    """ The generated decode gives the same result
+    as walking the config """
+
+    def setUp(self):
+        from pyelixys.hal.status import Status
+        import pktdata
+        self.status = Status()
+        self.pkt = pktdata.test_packet
+        self.data = self.status.struct.unpack(self.pkt)
+
+    def test_fixture_layout(self):
+        # A layout change updates pktdata in the same commit
+        import pktdata
+        self.assertEqual(len(self.pkt), self.status.struct.size)
+        self.assertEqual(len(pktdata.test_data), len(self.data))
+        self.assertEqual(self.data[:4], (ord('?'), 528, 0, 0))
+
+    def test_same_as_walk(self):
+        self.assertEqual(self.status.decode(self.data),
+                         self.status.decode_walk(self.data))
+
+    def test_parse_packet(self):
+        data_dict = self.status.parse_packet(self.pkt)
+        self.assertEqual(data_dict, self.status.decode_walk(self.data))
+        self.assertEqual(data_dict['Header']['packet_id'], 528)
+        mixers = data_dict['Mixers']
+        self.assertTrue(mixers[3] is mixers['Subs'][3])
+        self.assertEqual(mixers[3]['duty_cycle'], 0.5)
+        self.assertEqual(self.status['LinearActuators'][4]['position'], 1000)
+
+    def test_records(self):
+        data_dict = self.status.decode(self.data)
+        thermocouples = data_dict['Thermocouples']
+        self.assertFalse(hasattr(thermocouples, '__dict__'))
+        self.assertEqual(thermocouples.Subs[3].temperature,
+                         thermocouples[3]['temperature'])
+        self.assertEqual(thermocouples['count'], len(thermocouples.Subs))
+        self.assertEqual(data_dict['Header'].get('last_cmd_seq'), 0)
+        self.assertEqual(data_dict['Header'].get('nothing', 1), 1)
+        self.assertRaises(KeyError, lambda: thermocouples['__class__'])
+        self.assertRaises(KeyError, lambda: thermocouples[thermocouples.count])
+        self.assertFalse('Subs' in data_dict['Header'])
+
+    def test_as_dict(self):
+        self.status.parse_packet(self.pkt)
+        data_dict = self.status.as_dict()
+        self.assertEqual(data_dict, self.status.decode_walk(self.data))
+        self.assertEqual(type(data_dict['Mixers'][3]), dict)
+
+    def test_view(self):
+        view = self.status.view(self.pkt)
+        self.assertEqual(view, self.status.decode_walk(self.data))
+        self.assertEqual(view['Thermocouples'][3].temperature,
+                         self.status.decode(self.data)
+                         ['Thermocouples'][3]['temperature'])
+        self.assertEqual(view['Mixers']['count'], 4)
+        self.assertEqual(len(view['Mixers'].Subs), 4)
+        self.assertEqual(view.get('Header').get('last_cmd_seq'), 0)
+        self.assertRaises(KeyError, lambda: view['Mixers'][4])
+        self.assertRaises(KeyError, lambda: view['Nothing'])
+
+
+class StatusSnapshotTest(unittest.TestCase):
+    """ Each packet is published as a read only snapshot """
+
+    def setUp(self):
+        from testelixyshw import StatusSimulator
+        from pyelixys.hal.status import Status
+        self.sim = StatusSimulator()
+        self.status = Status()
+
+    def send(self, packet_id):
+        self.sim.store['Header']['packet_id'] = packet_id
+        self.sim.store['DigitalInputs']['state'] = packet_id
+        self.status.parse_packet(self.sim.generate_packet())
+
+    def test_snapshot(self):
+        from pyelixys.hal.status import ElixysReadOnlyError
+        self.assertEqual(self.status.snapshot(), None)
+        self.send(1)
+        snap = self.status.snapshot()
+        self.send(2)
+        # The old snapshot still holds packet 1 only
+        self.assertEqual(snap.packet_id, 1)
+        self.assertEqual(snap.DigitalInputs['state'], 1)
+        self.assertEqual(snap['Header']['packet_id'], 1)
+        self.assertEqual(self.status.snapshot().DigitalInputs['state'], 2)
+        self.assertEqual(self.status.DigitalInputs['state'], 2)
+        self.assertTrue(self.status.snapshot().store is self.status.store)
+        self.assertRaises(ElixysReadOnlyError, setattr, snap, 'store', {})
+        self.assertRaises(AttributeError, getattr, snap, 'Nothing')
+
+
+class StatusSubscribeTest(unittest.TestCase):
+    """ Subscriptions to status field changes """
+
+    def setUp(self):
+        from testelixyshw import StatusSimulator
+        from pyelixys.hal.status import Status
+        import Queue
+        self.sim = StatusSimulator()
+        self.status = Status()
+        self.calls = Queue.Queue()
+        self.addCleanup(lambda: self.status.dispatcher and
+                        self.status.dispatcher.stop())
+
+    def callback(self, path, value, snap):
+        self.calls.put((path, value, snap.packet_id))
+
+    def send(self, packet_id, state=0, temperature=25.0):
+        self.sim.store['Header']['packet_id'] = packet_id
+        self.sim.store['DigitalInputs']['state'] = state
+        self.sim.store['Thermocouples'][2]['temperature'] = temperature
+        self.status.parse_packet(self.sim.generate_packet())
+
+    def got(self):
+        """ The callbacks run so far, they run in order so
+        once done is set they have all run """
+        done = threading.Event()
+        self.status.dispatcher.put(done.set)
+        self.assertTrue(done.wait(2.0))
+        calls = []
+        while not self.calls.empty():
+            calls.append(self.calls.get())
+        return calls
+
+    def test_field_index(self):
+        status = self.status
+        self.assertEqual(status.field_index(('Header', 'packet_id')), (1, None))
+        self.assertEqual(status.field_index('DigitalInputs.state.6'),
+                         status.field_index(('DigitalInputs', 'state', 6)))
+        idx, bit = status.field_index(('Thermocouples', 2, 'temperature'))
+        data = self.sim.generate_packet_data()
+        self.sim.store['Thermocouples'][2]['temperature'] = 99.0
+        changed = [i for i, (a, b) in enumerate(
+            zip(data, self.sim.generate_packet_data())) if a != b]
+        self.assertEqual(changed, [idx])
+        self.assertRaises(ElixysValueError, status.field_index,
+                          ('Thermocouples', 12, 'temperature'))
+        self.assertRaises(ElixysValueError, status.field_index,
+                          ('Valves', 'nothing'))
+        # No bits in a 'c' or float field
+        self.assertRaises(ElixysValueError, status.field_index,
+                          'Valves.error_code.0')
+        self.assertRaises(ElixysValueError, status.field_index,
+                          ('Thermocouples', 2, 'temperature', 0))
+
+    def test_triggers(self):
+        self.status.subscribe('DigitalInputs.state.6', self.callback,
+                              on='falling')
+        self.status.subscribe(('DigitalInputs', 'state'), self.callback)
+        self.status.subscribe(('Thermocouples', 2, 'temperature'),
+                              self.callback, on=lambda temp: temp > 100.0)
+        self.send(1, state=0x40)
+        self.send(2, state=0x40, temperature=50.0)
+        self.send(3, state=0x00, temperature=101.0)
+        self.send(4, state=0x00, temperature=120.0)
+        self.send(5, state=0x01, temperature=90.0)
+        self.assertEqual(sorted(self.got()), sorted([
+            ('DigitalInputs.state.6', 0, 3),
+            (('DigitalInputs', 'state'), 0, 3),
+            (('Thermocouples', 2, 'temperature'), 101.0, 3),
+            (('DigitalInputs', 'state'), 1, 5)]))
+
+    def test_failing_predicate(self):
+        def fail(temp):
+            raise ValueError("predicate")
+        self.status.subscribe(('Thermocouples', 2, 'temperature'),
+                              self.callback, on=fail)
+        self.status.subscribe(('DigitalInputs', 'state'), self.callback)
+        self.send(1)
+        self.send(2, state=1, temperature=50.0)
+        self.assertEqual(self.status.packet_count, 2)
+        self.assertEqual(self.got(), [(('DigitalInputs', 'state'), 1, 2)])
+
+    def test_unsubscribe(self):
+        sub = self.status.subscribe(('DigitalInputs', 'state'), self.callback,
+                                    on='rising')
+        self.send(1)
+        self.send(2, state=1)
+        self.status.unsubscribe(sub)
+        self.send(3)
+        self.send(4, state=1)
+        self.assertEqual(self.got(), [(('DigitalInputs', 'state'), 1, 2)])
+
+
+class StatusWaitTest(unittest.TestCase):
+    """ Waiting on the status wakes up on the packet """
+
+    def setUp(self):
+        from testelixyshw import StatusSimulator
+        from pyelixys.hal.status import Status
+        self.sim = StatusSimulator()
+        self.status = Status()
+
+    def send_later(self, delay, packet_id, state):
+        def send():
+            self.sim.store['Header']['packet_id'] = packet_id
+            self.sim.store['DigitalInputs']['state'] = state
+            self.status.parse_packet(self.sim.generate_packet())
+        timer = threading.Timer(delay, send)
+        timer.start()
+        self.addCleanup(timer.join)
+
+    def test_wait_for(self):
+        predicate = lambda: self.status.DigitalInputs['state'] == 0x10
+        # No packet yet, the status is not valid
+        self.assertFalse(self.status.wait_for(predicate, timeout=0.01))
+        self.send_later(0.02, 1, 0x01)
+        self.send_later(0.05, 2, 0x10)
+        begin = time.time()
+        self.assertTrue(self.status.wait_for(predicate, timeout=2.0))
+        self.assertTrue(time.time() - begin < 1.0)
+        self.assertEqual(self.status.packet_count, 2)
+
+    def test_wait_for_packet(self):
+        self.assertEqual(self.status.wait_for_packet(timeout=0.01), None)
+        self.send_later(0.02, 7, 0)
+        self.assertEqual(self.status.wait_for_packet(timeout=2.0), 7)
+        self.send_later(0.02, 7, 0)
+        self.send_later(0.05, 8, 0)
+        self.assertEqual(self.status.wait_for_packet(7, timeout=2.0), 8)
+
+    def test_thread_survives_errors(self):
+        def fail(status):
+            raise ValueError("callback")
+        self.status.add_packet_callback(fail)
+        queue = Queue.Queue()
+        self.status.update_from_queue(queue)
+        self.addCleanup(self.status.stop_update)
+        queue.put("bad")
+        self.sim.store['Header']['packet_id'] = 3
+        queue.put(self.sim.generate_packet())
+        self.assertEqual(self.status.wait_for_packet(timeout=2.0), 3)
+        self.sim.store['Header']['packet_id'] = 4
+        queue.put(self.sim.generate_packet())
+        self.assertEqual(self.status.wait_for_packet(3, timeout=2.0), 4)
+
 if __name__ == '__main__':
     unittest.main()
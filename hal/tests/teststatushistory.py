@@ -0,0 +1,91 @@
+import sys
+sys.path.append("./")
+sys.path.append("../")
+import time
+import unittest
+from pyelixys.hal.statushistory import StatusHistory
+
+
+class StatusHistoryTest(unittest.TestCase):
+    """ Tests for the ring of the last status packets """
+
+    def setUp(self):
+        from testelixyshw import StatusSimulator
+        self.sim = StatusSimulator()
+        self.ring = StatusHistory(capacity=8)
+
+    def add(self, packet_id, now=None):
+        self.sim.store['Header']['packet_id'] = packet_id
+        self.sim.store['Thermocouples'][3]['temperature'] = packet_id * 2.0
+        self.sim.store['DigitalInputs']['state'] = packet_id
+        self.ring.add(self.sim.generate_packet_data(), now)
+
+    def test_empty(self):
+        self.assertEqual(len(self.ring.window('Header', 'packet_id')), 0)
+
+    def test_window(self):
+        for i in range(5):
+            self.add(i)
+        self.assertEqual(list(self.ring.window('DigitalInputs', 'state')),
+                         range(5))
+        self.assertEqual(list(self.ring.history('Thermocouples', 3,
+                                                'temperature', n=2)),
+                         [6.0, 8.0])
+
+    def test_wraps(self):
+        for i in range(21):
+            self.add(i)
+        self.assertEqual(len(self.ring), 8)
+        self.assertEqual(list(self.ring.window('Header', 'packet_id')),
+                         range(13, 21))
+        self.assertEqual(list(self.ring.window('Header', 'packet_id', n=3)),
+                         [18, 19, 20])
+        self.assertEqual(len(self.ring.buf), 16 * self.ring.dtype.itemsize)
+
+    def test_view(self):
+        for i in range(10):
+            self.add(i)
+        values = self.ring.window('DigitalInputs', 'state', n=4)
+        self.assertFalse(values.flags['OWNDATA'])
+        self.add(10)
+        # Still the same packets, not overwritten yet
+        self.assertEqual(list(values), [6, 7, 8, 9])
+
+    def test_copy(self):
+        for i in range(10):
+            self.add(i)
+        values = self.ring.window('DigitalInputs', 'state', copy=True)
+        times = self.ring.get_times(n=2, copy=True)
+        for i in range(10, 18):
+            self.add(i)
+        self.assertEqual(list(values), range(2, 10))
+        self.assertEqual(len(times), 2)
+
+    def test_seconds(self):
+        now = time.time()
+        for i in range(6):
+            self.add(i, now - 10 + i)
+        self.assertEqual(list(self.ring.window('Header', 'packet_id',
+                                               seconds=7.5)), [3, 4, 5])
+        self.assertEqual(len(self.ring.get_times(seconds=7.5)), 3)
+
+
+class StatusHistoryParseTest(unittest.TestCase):
+    """ Packets parsed by the Status end up in its history """
+
+    def test_parse(self):
+        from testelixyshw import StatusSimulator
+        from pyelixys.hal.status import Status
+        sim = StatusSimulator()
+        status = Status()
+        for i in range(3):
+            sim.store['Header']['packet_id'] = i
+            sim.store['Thermocouples'][3]['temperature'] = 20.0 + i
+            status.parse_packet(sim.generate_packet())
+        self.assertEqual(list(status.history('Thermocouples', 3,
+                                             'temperature', seconds=60)),
+                         [20.0, 21.0, 22.0])
+        self.assertEqual(len(status.history_times(n=2)), 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+import sys
+sys.path.append("./")
+sys.path.append("../")
+import threading
+import unittest
+from pyelixys.hal.hal import ValveBank, Valve
+from pyelixys.hal.hwconf import config
+
+
+class ValveBankTest(unittest.TestCase):
+    """ Tests for the valve state words and transactions """
+
+    def setUp(self):
+        self.bank = ValveBank(48)
+        self.sent = []
+        self.batches = []
+        # Record the commands instead of sending them to a server
+        self.bank.run_cmd = self.sent.append
+        self.bank.run_cmds = self.run_cmds
+
+    def run_cmds(self, cmds):
+        self.batches.append(len(cmds))
+        self.sent.extend(cmds)
+
+    def words_sent(self):
+        return [(cmd.cmd_name, cmd.param) for cmd in self.sent]
+
+    def test_single(self):
+        self.bank[3].on = True
+        self.bank[20].on = True
+        self.bank[3].on = False
+        self.assertEqual(self.words_sent(), [('set_state0', 0x08),
+                                             ('set_state1', 0x10),
+                                             ('set_state0', 0)])
+        self.assertTrue(self.bank[20].bank is self.bank)
+
+    def test_transaction(self):
+        with self.bank.transaction():
+            self.bank[0].on = True
+            self.bank[1].on = True
+            self.bank[0].on = False
+            self.bank[33].on = True
+            self.assertEqual(self.sent, [])
+        self.assertEqual(self.words_sent(), [('set_state0', 0x02),
+                                             ('set_state2', 0x02)])
+        self.assertEqual(self.batches, [2])
+
+    def test_off_first(self):
+        # The up and down valves of a reactor are in different words
+        valves = config['Reactors']['Reactor0']['Valves']
+        up, down = valves['up'], valves['down']
+        self.assertNotEqual(up // 16, down // 16)
+        self.bank[down].on = True
+        del self.sent[:]
+        with self.bank.transaction():
+            self.bank[up].on = True
+            self.bank[down].on = False
+        self.assertEqual(self.words_sent(),
+                         [('set_state%d' % (down // 16), 0),
+                          ('set_state%d' % (up // 16), 1 << (up % 16))])
+        self.assertEqual(self.batches, [2])
+
+    def test_nested(self):
+        with self.bank.transaction():
+            with self.bank.transaction():
+                self.bank[5].on = True
+            self.bank[6].on = True
+            self.assertEqual(self.sent, [])
+        self.assertEqual(self.words_sent(), [('set_state0', 0x60)])
+
+    def test_rollback(self):
+        self.bank[2].on = True
+        def fail():
+            with self.bank.transaction():
+                self.bank[2].on = False
+                self.bank[40].on = True
+                raise ValueError("valve")
+        self.assertRaises(ValueError, fail)
+        self.assertEqual(self.bank.words, [0x04, 0, 0])
+        self.assertEqual(len(self.sent), 1)
+        self.assertTrue(self.bank[2].on_)
+        self.assertFalse(self.bank[40].on_)
+
+    def test_valve_on(self):
+        self.bank[4].on = True
+        self.bank[4].on = False
+        self.assertFalse(self.bank[4].on_)
+
+    def test_shared_bank(self):
+        # Standalone valves of a unit share its state words
+        self.addCleanup(ValveBank.banks.pop, 'test', None)
+        bank = ValveBank.get_bank('test')
+        bank.run_cmd = self.sent.append
+        Valve(3, 'test').on = True
+        Valve(5, 'test').on = True
+        self.assertEqual(self.words_sent(), [('set_state0', 0x08),
+                                             ('set_state0', 0x28)])
+        self.assertTrue(ValveBank.get_bank('test', 8) is bank)
+        self.assertEqual(len(bank), 8)
+
+    def test_other_thread_waits(self):
+        thread = threading.Thread(target=self.bank.set, args=(17, True))
+        with self.bank.transaction():
+            self.bank[1].on = True
+            thread.start()
+            thread.join(0.1)
+            self.assertEqual(self.sent, [])
+        thread.join(1.0)
+        self.assertEqual(self.words_sent(), [('set_state0', 0x02),
+                                             ('set_state1', 0x02)])
+
+if __name__ == '__main__':
+    unittest.main()
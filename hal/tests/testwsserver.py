@@ -0,0 +1,143 @@
+import unittest
+import time
+import Queue
+import multiprocessing
+
+from websocket import create_connection
+
+from pyelixys.hal.wsserver import WSServerProcess, WSServerThread, \
+                                  WSHandler
+from pyelixys.hal.cmds import cmd_lookup, CommandBatch
+from pyelixys.elixysexceptions import ElixysCommError
+
+
+def connect(url, retries=50):
+    for i in range(retries):
+        try:
+            return create_connection(url, timeout=2)
+        except Exception:
+            time.sleep(0.1)
+    raise RuntimeError("Could not connect to %s" % url)
+
+
+def wire(cmd, seq_id):
+    """ The bytes of cmd as sent with its sequence id """
+    cmd.seq_id = seq_id
+    return str(cmd)
+
+
+class WSServerUnitsTest(unittest.TestCase):
+    """ Two synthesizer units served by one server """
+
+    port = 8892
+    server_cls = WSServerProcess
+    queue_cls = staticmethod(multiprocessing.Queue)
+
+    def setUp(self):
+        self.queues = {'a': self.queue_cls(), 'b': self.queue_cls()}
+        self.proc = self.server_cls(self.queues, port=self.port)
+        self.proc.start()
+        self.ws_a = connect("ws://localhost:%d/ws/a" % self.port)
+        self.ws_b = connect("ws://localhost:%d/ws?unit=b" % self.port)
+
+    def tearDown(self):
+        self.ws_a.close()
+        self.ws_b.close()
+        self.proc.terminate()
+        self.proc.join()
+
+    def test_cmds_routed_by_unit(self):
+        cmd_b = cmd_lookup['Valves']['set_state0'](0xAA)
+        cmd_a = cmd_lookup['Valves']['set_state1'](0x55)
+        seq_b = self.proc.run_cmd(cmd_b, 'b')
+        seq_a = self.proc.run_cmd(cmd_a, 'a')
+        self.assertEqual((seq_a, seq_b), (1, 1))
+        self.assertEqual(self.ws_b.recv(), wire(cmd_b, seq_b))
+        self.assertEqual(self.ws_a.recv(), wire(cmd_a, seq_a))
+        # The counters are bumped just after the frame goes out
+        time.sleep(0.1)
+        self.assertEqual(self.proc.cmd_counters['a']['sent'], 1)
+        self.assertEqual(self.proc.cmd_counters['b']['sent'], 1)
+
+    def test_status_routed_by_unit(self):
+        self.ws_a.send_binary("from a")
+        self.ws_b.send_binary("from b")
+        self.assertEqual(self.queues['a'].get(timeout=2), "from a")
+        self.assertEqual(self.queues['b'].get(timeout=2), "from b")
+
+    def test_run_cmds(self):
+        cmds = [cmd_lookup['Valves']['set_state0'](0),
+                cmd_lookup['Valves']['set_state1'](2)]
+        seq = self.proc.run_cmds(cmds, 'a')
+        self.assertEqual(self.ws_a.recv(), wire(cmds[0], seq - 1))
+        self.assertEqual(self.ws_a.recv(), wire(cmds[1], seq))
+
+    def test_unknown_unit(self):
+        self.assertRaises(ElixysCommError, self.proc.run_cmd,
+                          cmd_lookup['Valves']['set_state0'](0), 'c')
+
+    def test_one_client_per_unit(self):
+        ws = connect("ws://localhost:%d/ws/a" % self.port)
+        # Frames of the rejected client are dropped
+        ws.send_binary("rejected")
+        self.assertEqual(ws.recv(), "Too many connections! Closing yours.")
+        ws.close()
+        self.ws_a.send_binary("from a")
+        self.assertEqual(self.queues['a'].get(timeout=2), "from a")
+        cmd = cmd_lookup['Valves']['set_state0'](1)
+        seq = self.proc.run_cmd(cmd, 'a')
+        self.assertEqual(self.ws_a.recv(), wire(cmd, seq))
+
+
+class WSServerProcessFeedTest(unittest.TestCase):
+    """ run_cmd never blocks on the command pipe """
+
+    def test_not_started(self):
+        server = WSServerProcess(multiprocessing.Queue(), port=8895)
+        # Far more than the pipe buffer holds
+        for i in range(2000):
+            server.run_cmd(cmd_lookup['Valves']['set_state0'](i))
+        self.assertFalse(server.is_alive())
+
+
+class SendBufferTest(unittest.TestCase):
+    """ The batch frames reuse the buffer of the handler """
+
+    def write_message(self, pkt):
+        self.sent.append(pkt)
+
+    def test_batches(self):
+        self.sent = []
+        self.send_buf = bytearray()
+        send_pkt = WSHandler.send_pkt.__func__
+        big = CommandBatch([cmd_lookup['Valves']['set_state0'](i)
+                            for i in range(4)])
+        small = CommandBatch([cmd_lookup['Valves']['set_state1'](1)])
+        send_pkt(self, big)
+        buf = self.send_buf
+        send_pkt(self, small)
+        self.assertTrue(self.send_buf is buf)
+        self.assertEqual(self.sent, [str(big), str(small)])
+
+
+class WSServerThreadTest(WSServerUnitsTest):
+    """ Same, with the server on a thread of this process """
+
+    port = 8893
+    server_cls = WSServerThread
+    queue_cls = Queue.Queue
+
+    def test_cmd_before_start(self):
+        server = WSServerThread(Queue.Queue(), port=8894)
+        cmd = cmd_lookup['Valves']['set_state0'](7)
+        seq = server.run_cmd(cmd)
+        server.start()
+        ws = connect("ws://localhost:8894/ws")
+        self.assertEqual(ws.recv(), wire(cmd, seq))
+        ws.close()
+        server.terminate()
+        self.assertFalse(server.is_alive())
+
+
+if __name__ == '__main__':
+    unittest.main()
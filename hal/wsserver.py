@@ -1,207 +1,462 @@
+import os
 import sys
 import time
 import signal
 import thread
+import threading
+import Queue
+import multiprocessing
 import tornado.httpserver
-from multiprocessing import Process, Event, Queue
-from Queue import Empty
+from multiprocessing import Process, Event, Pipe
 import tornado.websocket
 import tornado.ioloop
 import tornado.web
-from pyelixys.hal.status import Status
-from pyelixys.hal.cmds import cmd_lookup
+from pyelixys.hal.hwconf import config
+from pyelixys.hal.comms import get_comm_stack
+from pyelixys.hal.cmds import cmd_lookup, CommandBatch
+from pyelixys.hal.cmdsched import CommandScheduler, CommandCounters
+from pyelixys.hal.cmdack import CommandTracker
+from pyelixys.hal.linkstats import ArrivalTimes
+from pyelixys.hal.shmring import StatusRing, StatusSlot
+from pyelixys.elixysexceptions import ElixysCommError
 from pyelixys.logs import wsslog as log
 import datetime
 
-exit_event = Event()
-
-pkt_send_timeout = 0.1
+# Each synthesizer unit connects to /ws/<unit> (or /ws?unit=<unit>),
+# a client connecting to plain /ws is the first unit
+units = config['WSServer']['units']
+default_unit = units[0]
 
 class WSHandler(tornado.websocket.WebSocketHandler):
     """ This the the main websocket handler that deals with incoming
     connections from the elixys synthesizer hardware client.
     It reads the incoming status packets and make them available
-    but putting them onto a queue.  The handler also, periodically
-    send the commands from the software to the hardware.
+    but putting them onto a queue.  The handler also sends
+    the commands from the software to the hardware, as fast
+    as the command scheduler allows.
+    Several synthesizers can be connected at once, each one
+    is a unit with its own command scheduler and status queue.
     """
 
-    handler_instances = []
+    # The connected client of each unit
+    handler_instances = {}
 
-    def initialize(self, cmd_queue, status_queue):
-        """ Setup the cmd and statu queuse
-        The cmd_queue is in the outbound queue
+    def initialize(self, cmd_schedulers, status_queues, status_arrivals):
+        """ Setup the cmd schedulers and status queues
+        The cmd_schedulers hold the outbound commands,
         commands to the elixys synthesizer get placed
-        on this queue before being sent to the hardware.
-        The status_queue is the inbound queue, the
-        status of the system is received on this queue and
-        used to update the global system status.
+        on the scheduler of their unit before being paced
+        out to the hardware.
+        The status_queues are the inbound queues, the
+        status of each unit is received on its queue and
+        used to update that unit's system status, the
+        status_arrivals record when each packet came in.
         """
 
-        self.cmd_queue = cmd_queue
-        self.status_queue = status_queue
+        self.cmd_schedulers = cmd_schedulers
+        self.status_queues = status_queues
+        self.status_arrivals = status_arrivals
+        self.unit = None
+        # The batch frames are packed in this buffer, grown as needed
+        self.send_buf = bytearray()
 
-    def open(self):
+    def open(self, unit=None):
         """ The handler is run when the websocket
         connection from the client is first run.
-        Since only one client should connect at a time,
-        we track the number of clients and close an clients
-        to try to connect later.  In addition we also
-        set up a timed callback that will check to see i
-        if any commands have been place in the outbound
-        cmd_queue, and then sends any that are avalaible
+        The unit comes from the url path, or the unit query
+        argument, plain /ws is the default unit.
+        Since only one client per unit should connect at a time,
+        we track the clients and close any clients of that unit
+        trying to connect later.  Any commands that were
+        given to the unit's cmd_scheduler before the client
+        connected are sent immediately.
         """
 
         self.count = 0
-        if self in WSHandler.handler_instances:
-            WSHandler.handler_instances.remove(self)
-        WSHandler.handler_instances.append(self)
+        if unit is None:
+            unit = self.get_argument('unit', default_unit)
+        if not unit in self.status_queues:
+            log.error("Client for unknown unit %s", unit)
+            self.write_message("Unknown unit %s! Closing yours." % unit)
+            self.close()
+            return
 
-        log.debug("New client %d connected to wsserver" %
-                  len(WSHandler.handler_instances))
         # Handle case where we have two clients, which is not allowed!
-        if len(WSHandler.handler_instances) > 1:
-            log.error("Too many clients attempting to connect!")
+        if WSHandler.handler_instances.get(unit, self) is not self:
+            log.error("Too many clients attempting to connect to unit %s!",
+                      unit)
             self.write_message("Too many connections! Closing yours.")
-            WSHandler.handler_instances.pop()
             self.close()
             return
-        tornado.ioloop.IOLoop.instance().add_timeout(
-            datetime.timedelta(seconds=pkt_send_timeout), self.send_pkt)
+
+        self.unit = unit
+        self.cmd_scheduler = self.cmd_schedulers[unit]
+        self.status_queue = self.status_queues[unit]
+        self.arrivals = self.status_arrivals[unit]
+        WSHandler.handler_instances[unit] = self
+        log.debug("New client for unit %s connected to wsserver, "
+                  "%d clients" % (unit, len(WSHandler.handler_instances)))
+        self.cmd_scheduler.flush()
         #self.write_message("Hello client")
 
     def on_message(self, message):
         """ Upon receiving a message we place these
-        objects onto the status queue for consumption by
-        the rest of the system """
+        objects onto the status queue (or ring) for consumption by
+        the rest of the system.  A client closed in open (unknown
+        unit, second client) may still send frames, they are dropped """
+        if self.unit is None:
+            return
         self.count += 1
+        self.arrivals.on_packet()
         self.status_queue.put(message)
 
     def on_close(self):
         """ This handler deals with when we close a connection
-        from a client.  In this case we remove it from the list
-        of clients (which should always have a length of 1)
-        then log the connection being closed """
+        from a client.  In this case we remove it from the
+        clients then log the connection being closed """
 
-        WSHandler.handler_instances.remove(self)
+        if WSHandler.handler_instances.get(self.unit, None) is self:
+            del WSHandler.handler_instances[self.unit]
         log.debug('connection closed')
 
-    def send_pkt(self):
-        """ This callback is periodically called to send all
-        the commands on the cmd_queue out to the hardware.
-        First check to see if there is a client connected.
-        Then if we have a client see if there are commands on
-        the cmd_queue.  If we have commands, pop them off the queue
-        and send them, till none are left. Finally, reschedule
-        this handler to be run again in the near future """
+    def send_pkt(self, cmd):
+        """ This callback is called by the cmd_scheduler
+        when a command (or a CommandBatch) may be sent out
+        to the hardware.
+        It never sleeps, the pacing between commands is
+        done with IOLoop timeouts by the scheduler so status
+        packets keep being received.
+        A batch is packed in the handler's buffer, tornado takes
+        a byte string so it is copied out once.  A single command
+        already packs straight to its byte string. """
+
+        if isinstance(cmd, CommandBatch):
+            size = cmd.size
+            if len(self.send_buf) < size:
+                self.send_buf = bytearray(size)
+            cmd.pack_into(self.send_buf)
+            pkt = str(buffer(self.send_buf, 0, size))
+        else:
+            pkt = str(cmd)
+        #log.debug("CMD:%s" % repr(cmd))
+        log.debug("Wrote %d bytes" % len(pkt))
+        self.write_message(pkt)
+        #self.write_message("CMD:%s" % repr(cmd))
 
-        if len(WSHandler.handler_instances) == 0:
-            return
-        #print "Attempt to send pkt"
-        #print "ID in WSHandler %d" % id(self.cmd_queue)
-        try:
-            while True:
-                cmd = self.cmd_queue.get(block=False)
-                #log.debug("CMD:%s" % repr(cmd))
-                log.debug("Wrote %d bytes" % len(str(cmd)))
-                self.write_message(str(cmd))
-                #self.write_message("CMD:%s" % repr(cmd))
-                time.sleep(0.06)
-        except Empty:
-            pass
-        tornado.ioloop.IOLoop.instance().add_timeout(
-            datetime.timedelta(seconds=pkt_send_timeout), self.send_pkt)
-
-
-class WSServerProcess(Process):
-    """ The websocket hardware server runs in its own
-    process.  It accepts the cmd and status queues and
-    passes them to the tornado websock server.
+    @staticmethod
+    def send_to_client(unit, cmds):
+        """ Send the commands to the client of a unit, in
+        one batch frame if there are several and batch frames
+        are enabled. Returns False if there is no client to
+        send them to """
+        handler = WSHandler.handler_instances.get(unit, None)
+        if handler is None:
+            return False
+        if len(cmds) > 1 and config['WSServer']['batch_frames']:
+            handler.send_pkt(CommandBatch(cmds))
+        else:
+            for cmd in cmds:
+                handler.send_pkt(cmd)
+        return True
+
+
+class WSServerBase(object):
+    """ The parts of the websocket hardware server shared by
+    the process and the thread flavours.  It accepts the status
+    queues, one per unit, and passes them to the tornado websock server.
     This is the object the rest of the system interfaces
     with to communicate directly with the hardware.
-    Since it is a process we must use queues for all communication.
     """
 
-    stop_event = Event()
-
-    def __init__(self, cmd_queue, status_queue):
-        """ Initialize the process and queues """
-        super(WSServerProcess, self).__init__()
-        self.daemon = True
-        self.cmd_queue = cmd_queue
-        self.status_queue = status_queue
-        # Create a status object that parses the status packets
-        # on the queue
+    def init_server(self, status_queues, port=None):
+        """ status_queues maps each unit to its status queue,
+        a single queue is used for the default unit """
+        self.port = port if not port is None else config['WSServer']['port']
+        if not isinstance(status_queues, dict):
+            status_queues = {default_unit: status_queues}
+        self.status_queues = status_queues
+        # Queued, coalesced and sent command counts of each unit,
+        # readable from the HAL while the server updates them
+        self.cmd_counters = dict((unit, CommandCounters())
+                                 for unit in status_queues)
+        # Sequence ids, wire order and latencies of each unit's commands
+        self.cmd_trackers = dict((unit, CommandTracker())
+                                 for unit in status_queues)
+        # When the status packets of each unit came in
+        self.status_arrivals = dict((unit, ArrivalTimes())
+                                    for unit in status_queues)
 
     def run(self):
         """ Setup the tornado websocket server
+        hook the command dispatch up to the IOLoop and
         setup a periodic callback to see if the
         server should exit gracefully
         """
         log.debug("Running server")
+        self.ioloop = self.get_ioloop()
+        self.cmd_schedulers = dict()
+        for unit in self.status_queues:
+            self.cmd_schedulers[unit] = CommandScheduler(
+                self.client_sender(unit), ioloop=self.ioloop,
+                counters=self.cmd_counters[unit])
+        handler_args = dict(cmd_schedulers=self.cmd_schedulers,
+                            status_queues=self.status_queues,
+                            status_arrivals=self.status_arrivals)
         self.application = tornado.web.Application([
-            (r'/ws', WSHandler,
-             dict(cmd_queue=self.cmd_queue,
-             status_queue=self.status_queue)),
+            (r'/ws', WSHandler, handler_args),
+            (r'/ws/([^/]+)', WSHandler, handler_args),
         ])
-        self.http_server = tornado.httpserver.HTTPServer(self.application)
-        self.http_server.listen(8888)
-        tornado.ioloop.PeriodicCallback(self.periodic_exit, 50).start()
+        self.http_server = tornado.httpserver.HTTPServer(self.application,
+                                                         io_loop=self.ioloop)
+        self.http_server.listen(self.port)
+        self.setup_cmd_dispatch()
+        tornado.ioloop.PeriodicCallback(self.periodic_exit, 50,
+                                        io_loop=self.ioloop).start()
 
         try:
             log.debug("Tornado server IOLoop starting")
-            tornado.ioloop.IOLoop.instance().start()
+            self.ioloop.start()
         except (KeyboardInterrupt, SystemExit):
-            tornado.ioloop.IOLoop.instance().stop()
-
-
-    @staticmethod
-    def periodic_exit():
+            self.ioloop.stop()
+        # Free the port and forget the clients, an in process
+        # server may be started again
+        self.http_server.stop()
+        for unit in self.status_queues:
+            WSHandler.handler_instances.pop(unit, None)
+
+    def periodic_exit(self):
         """ Callback to stop the tornado
         web server
         """
         #log.debug("Checking Exit")
-        if WSServerProcess.stop_event.is_set():
+        if self.stop_event.is_set():
             log.debug("Stopping Tornado server")
-            tornado.ioloop.IOLoop.instance().stop()
-
-    def run_cmd(self, cmd):
-        self.cmd_queue.put(cmd)
+            self.ioloop.stop()
+
+    def client_sender(self, unit):
+        """ Returns the function the scheduler of a
+        unit uses to send commands to its client """
+        tracker = self.cmd_trackers[unit]
+        def send(cmds):
+            if WSHandler.send_to_client(unit, cmds) is False:
+                return False
+            tracker.on_wire(cmds)
+        return send
+
+    def run_cmd(self, cmd, unit=None):
+        """ Send a command for a unit (by default the
+        first one) to the server, this wakes the IOLoop
+        immediately.
+        Returns the sequence id given to the command """
+        unit = self.check_unit(unit)
+        cmd = self.cmd_trackers[unit].enqueue(cmd)
+        self.queue_cmd(unit, cmd)
+        return cmd.seq_id
+
+    def run_cmds(self, cmds, unit=None):
+        """ Send several commands for a unit as one unit,
+        in order and in a single scheduler put, they are
+        released together instead of being paced one by one.
+        Returns the sequence id given to the last command """
+        unit = self.check_unit(unit)
+        tracker = self.cmd_trackers[unit]
+        batch = CommandBatch([tracker.enqueue(cmd) for cmd in cmds])
+        self.queue_cmd(unit, batch)
+        return batch.cmds[-1].seq_id
+
+    def check_unit(self, unit):
+        """ Returns the unit a command goes to,
+        by default the first one """
+        if unit is None:
+            unit = default_unit
+        if not unit in self.status_queues:
+            raise ElixysCommError("No synthesizer unit %s" % unit)
+        return unit
+
+    def wait_applied(self, seq, unit=None, timeout=None):
+        """ Wait until the hardware acknowledged applying
+        the command run_cmd returned seq for, returns False
+        if the timeout expired first """
+        unit = self.check_unit(unit)
+        return self.cmd_trackers[unit].wait_applied(seq, timeout)
+
+    def is_acking(self, unit=None):
+        """ Whether the hardware of a unit acked a command yet """
+        return self.cmd_trackers[self.check_unit(unit)].acking
+
+    def latency_report(self, unit=None):
+        """ Per subsystem command latency histograms of a unit """
+        return self.cmd_trackers[self.check_unit(unit)].latency_report()
 
     def stop(self):
-        WSServerProcess.stop_event.set()
+        self.stop_event.set()
+
+
+class WSServerProcess(WSServerBase, Process):
+    """ The websocket hardware server running in its own
+    process. Since it is a process we must use queues for
+    all communication.
+    Commands are written to a pipe whose read end is registered
+    with the IOLoop, so the server wakes up as soon as a command
+    is sent instead of polling for it.  run_cmd puts them on a
+    queue a feeder thread writes to the pipe, it never blocks when
+    the server is not draining the pipe (not started, dead or busy).
+    A CommandBatch from run_cmds crosses the pipe as one item.
+    """
+
+    mode = 'process'
 
-command_queue = Queue()
-status_queue = Queue()
-wscomproc = WSServerProcess(command_queue, status_queue)
-status = Status()
-status.update_from_queue(status_queue)
+    def __init__(self, status_queues, port=None):
+        """ Initialize the process, the command pipe and queues """
+        super(WSServerProcess, self).__init__()
+        self.daemon = True
+        self.init_server(status_queues, port)
+        self.stop_event = Event()
+        # Commands cross the process boundary on this pipe,
+        # written by the feeder thread, started by the first run_cmd
+        self.cmd_pipe_r, self.cmd_pipe_w = Pipe(duplex=False)
+        self.cmd_feed = Queue.Queue()
+        self.cmd_feeder = None
+        self.cmd_feeder_lock = threading.Lock()
+
+    def get_ioloop(self):
+        return tornado.ioloop.IOLoop.instance()
+
+    def setup_cmd_dispatch(self):
+        """ Register the read end of the command pipe with
+        the IOLoop so commands are sent as they arrive """
+        self.ioloop.add_handler(
+            self.cmd_pipe_r.fileno(), self.on_cmd_ready,
+            tornado.ioloop.IOLoop.READ)
+
+    def on_cmd_ready(self, fd, events):
+        """ IOLoop handler for the command pipe, give every
+        available command (or batch) to the scheduler of its
+        unit which sends them out to the connected client """
+        while self.cmd_pipe_r.poll():
+            unit, cmd = self.cmd_pipe_r.recv()
+            self.cmd_schedulers[unit].put(cmd)
+
+    def queue_cmd(self, unit, cmd):
+        """ Hand a command to the feeder thread, the pipe
+        wakes the IOLoop of the server process """
+        self.cmd_feed.put((unit, cmd))
+        if self.cmd_feeder is None:
+            self.start_feeder()
+
+    def start_feeder(self):
+        """ Start the feeder thread, in the HAL process """
+        with self.cmd_feeder_lock:
+            if self.cmd_feeder is None:
+                self.cmd_feeder = threading.Thread(target=self.feed_cmds)
+                self.cmd_feeder.daemon = True
+                self.cmd_feeder.start()
+
+    def feed_cmds(self):
+        """ Feeder thread, writes the commands to the pipe,
+        blocking while the pipe is full """
+        while True:
+            self.cmd_pipe_w.send(self.cmd_feed.get())
+
+
+class WSServerThread(WSServerBase, threading.Thread):
+    """ The websocket hardware server running its IOLoop
+    on a thread of the HAL process, for when the HAL owns the
+    machine.  Commands are handed to the IOLoop with add_callback
+    and the status packets come back on in memory queues, nothing
+    is pickled or copied between processes.
+    It has the same interface as the WSServerProcess.
+    """
+
+    mode = 'thread'
+
+    def __init__(self, status_queues, port=None):
+        """ Initialize the thread and its own IOLoop """
+        super(WSServerThread, self).__init__()
+        self.daemon = True
+        self.init_server(status_queues, port)
+        self.stop_event = threading.Event()
+        # Created here so commands can be queued on it
+        # before the thread is started
+        self.ioloop = tornado.ioloop.IOLoop()
+        self.cmd_schedulers = None
+
+    def get_ioloop(self):
+        self.ioloop.make_current()
+        return self.ioloop
+
+    def setup_cmd_dispatch(self):
+        """ Commands are put straight on the schedulers
+        from the IOLoop thread, nothing to register """
+        pass
+
+    def put_cmd(self, unit, cmd):
+        self.cmd_schedulers[unit].put(cmd)
+
+    def queue_cmd(self, unit, cmd):
+        """ Give a command to the IOLoop, add_callback is
+        thread safe and wakes the IOLoop immediately """
+        self.ioloop.add_callback(self.put_cmd, unit, cmd)
+
+    def terminate(self):
+        """ Threads can not be killed, stop the IOLoop
+        and wait for the thread to finish """
+        self.stop()
+        if self.is_alive():
+            self.join()
+
+
+def create_server(status_queues, conf=config['WSServer']):
+    """ Create the websocket hardware server in the
+    configured mode, its own process or a thread of this one """
+    if conf['mode'] == 'thread':
+        return WSServerThread(status_queues, conf['port'])
+    return WSServerProcess(status_queues, conf['port'])
+
+
+def create_status_queue(conf=config['WSServer']):
+    """ Create the transport for the status packets,
+    the shared memory ring and slot need the server process to
+    be forked, otherwise fall back to a Queue.  An in process
+    server hands the packets over on a plain in memory queue """
+    if conf['mode'] == 'thread':
+        return Queue.Queue()
+    if hasattr(os, 'fork'):
+        if conf['status_transport'] == 'ring':
+            return StatusRing(conf['status_slots'], conf['status_slot_size'])
+        if conf['status_transport'] == 'latest':
+            return StatusSlot(conf['status_slot_size'])
+    return multiprocessing.Queue()
 
 def start_server():
-    """ Helper function to start the server """
+    """ Helper function to start the server
+    of the shared comm stack """
     log.debug("Starting wsserver process")
-    wscomproc.start()
+    get_comm_stack().start()
 
 
 def stop_server():
     """ Helper function to stop the server """
     log.debug("Stopping wsserver")
-    wscomproc.terminate()
+    get_comm_stack().stop()
+    get_comm_stack().server.terminate()
 
 def exit_gracefully(signum, frame):
     """ Callback for when we want to shut down the process
     and server threads
     """
     print "Exit Gracefully, Ctrl+C pressed"
-    log.debug("Ask the status update thread to quit")
-    status.stop_update()
     log.debug("Set the stop event in main thread")
     exit_event.set()
-    wscomproc.stop()
-    log.debug("Ask the wscommproc to terminate")
+    log.debug("Ask the status update threads and wscommproc to quit")
+    get_comm_stack().stop()
     sys.exit(0)
 
 if __name__ == "__main__":
+    exit_event = Event()
     signal.signal(signal.SIGINT, exit_gracefully)
+    wscomproc = get_comm_stack().server
+    status = get_comm_stack().status()
 
 
     def send_test_cmds():